@@ -0,0 +1,220 @@
+#
+# ASYNCSERVER.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# asyncio engine for the ( name ) server, selected with Server.py --async.
+# Runs the listener, one control reader per client socket, one audio pump
+# per channel and the stdin admin console as tasks on a single event loop,
+# instead of re-scanning every socket with select() on each tick. Sockets
+# are nonblocking: control packets go through a per-socket outbound queue
+# drained by a writer task, and audio through the server's FanOut outboxes,
+# so one slow client never stalls the others.
+#
+
+#!/usr/bin/python3
+
+import sys
+import time
+import asyncio
+
+import Packet as pack
+import Snapshot
+from Server import Server
+
+
+# class AsyncServer
+# Server that keeps the Packet protocol and Channel semantics, but is
+# driven by an asyncio event loop
+#
+class AsyncServer(Server):
+    outboxes: dict  # client socket -> asyncio.Queue of outgoing bytes
+    tasks: dict     # client socket -> [reader task, writer task]
+
+    def __init__(self, host_port, *args):
+        super().__init__(host_port, *args)
+        self.host_s.setblocking(False)
+        self.loop = None
+        self.outboxes = {}
+        self.tasks = {}
+        self.done = None    # set once the admin console asks to close
+        self.listening = {} # channel -> Event set when a listener joins it
+
+
+    # send_packet()
+    # queues a control packet on the socket's outbox; the socket's writer
+    # task sends it without blocking the event loop
+    def send_packet(self, this_sock, type, data):
+        packet_bytes = pack.construct_packet(type, data, self.codec(this_sock))
+        if packet_bytes == b"\0":
+            return False
+        outbox = self.outboxes.get(this_sock)
+        if outbox is None:
+            return False
+        outbox.put_nowait(packet_bytes)
+        return True
+
+
+    # disconnect_client()
+    # stops a client's tasks before the base class closes its sockets
+    def disconnect_client(self, session):
+        self.close_outbox(session.com)
+        self.close_outbox(session.aud)
+        super().disconnect_client(session)
+
+
+    # drop_socket()
+    # stops a hung-up socket's tasks before the base class drops it
+    def drop_socket(self, this_sock):
+        self.close_outbox(this_sock)
+        super().drop_socket(this_sock)
+
+
+    # close_outbox()
+    # cancels a socket's reader and writer tasks and discards its outbox
+    def close_outbox(self, this_sock):
+        self.outboxes.pop(this_sock, None)
+        current = asyncio.current_task()
+        for task in self.tasks.pop(this_sock, []):
+            if task is not current:
+                task.cancel()
+
+
+    # move_client()
+    # wakes the new channel's pump, in case it was idle
+    def move_client(self, session, new_ch):
+        super().move_client(session, new_ch)
+        self.wake(new_ch)
+
+
+    # add_client()
+    # wakes the lobby channel's pump, in case it was idle
+    def add_client(self, com_sock, aud_sock, name):
+        super().add_client(com_sock, aud_sock, name)
+        self.wake(self.channels[0])
+
+
+    # wake()
+    # lets an idle channel's pump task resume it
+    def wake(self, channel):
+        listening = self.listening.get(channel)
+        if listening is not None:
+            listening.set()
+
+
+    # read_client()
+    # control reader task: receives into the socket's PacketDecoder without
+    # blocking the loop, and handles every packet each read completes
+    async def read_client(self, this_sock):
+        decoder = self.decoders[this_sock]
+        try:
+            while self.handle_packets(this_sock):
+                view = decoder.space()
+                try:
+                    num = await self.loop.sock_recv_into(this_sock, view)
+                finally:
+                    view.release()
+                decoder.received(num)
+        except (ConnectionError, OSError):
+            pass
+        self.drop_socket(this_sock)
+
+
+    # write_client()
+    # writer task: drains one socket's outbox in order
+    async def write_client(self, this_sock, outbox):
+        try:
+            while True:
+                data = await outbox.get()
+                await self.loop.sock_sendall(this_sock, data)
+        except (ConnectionError, OSError):
+            self.drop_socket(this_sock)
+
+
+    # listen()
+    # listener task: accepts clients and starts their reader and writer
+    async def listen(self):
+        while True:
+            new_c_s, c_addr = await self.loop.sock_accept(self.host_s)
+            new_c_s.setblocking(False)
+
+            outbox = asyncio.Queue()
+            self.outboxes[new_c_s] = outbox
+            self.tasks[new_c_s] = [
+                self.loop.create_task(self.read_client(new_c_s)),
+                self.loop.create_task(self.write_client(new_c_s, outbox)),
+            ]
+            self.register_client(new_c_s)
+
+
+    # pump_channel()
+    # audio pump task: streams one channel's song to its listeners, sending
+    # whatever frames its Pacer says are due
+    async def pump_channel(self, channel):
+        listening = self.listening[channel] = asyncio.Event()
+        while True:
+            if not channel.clients:     # idle: sleep until someone joins
+                channel.pause(time.monotonic())
+                listening.clear()
+                await listening.wait()
+            num_due = channel.due()
+            if num_due > 0:
+                self.loop_lag.observe(channel.pacer.late)
+            for _ in range(num_due):
+                self.write_song_packets(channel)
+            if channel.updates:
+                self.send_updates(channel)
+            await asyncio.sleep(channel.wait_time())
+
+
+    # snapshot_channels()
+    # snapshot task: saves the channels' state every SNAPSHOT_INTERVAL
+    async def snapshot_channels(self):
+        while True:
+            await asyncio.sleep(Snapshot.SNAPSHOT_INTERVAL)
+            self.save_snapshot()
+
+
+    # read_console()
+    # stdin reader callback: passes each admin line to handle_admin_input
+    def read_console(self):
+        line = sys.stdin.readline()
+        if len(line) == 0:  # stdin closed: stop watching it
+            self.loop.remove_reader(sys.stdin)
+            return
+        str_in = line.lower()[:-1]
+        if not self.handle_admin_input(str_in) and not self.done.done():
+            self.done.set_result(True)
+
+
+    # serve()
+    # runs every engine task until the admin console closes the server
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+
+        tasks = [self.loop.create_task(self.listen()),
+                 self.loop.create_task(self.snapshot_channels())]
+        tasks += [self.loop.create_task(self.pump_channel(channel))
+                  for channel in self.channels]
+        try:
+            self.loop.add_reader(sys.stdin, self.read_console)
+        except (OSError, ValueError):
+            print("Admin console unavailable: stdin can't be polled.")
+
+        try:
+            await self.done
+        finally:
+            self.loop.remove_reader(sys.stdin)
+            for task in tasks:
+                task.cancel()
+            for this_sock in list(self.tasks):
+                self.close_outbox(this_sock)
+            self.save_snapshot()
+
+
+    # run_server()
+    # builds the channels, then hands control to the event loop
+    def run_server(self, num_channels=4):
+        print("We've initialized our server (asyncio engine).")
+        self.build_channels(num_channels)
+        asyncio.run(self.serve())
@@ -0,0 +1,99 @@
+#
+# AUDIOCODEC.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Audio wire formats a client can negotiate at C_INIT. Raw 16-bit stereo
+# PCM costs about 1.4 Mbit/s per listener; the other formats cut that:
+#   FORMAT_ULAW   8-bit G.711 mu-law, half the bytes, lossy
+#   FORMAT_DELTA  lossless: per-channel sample deltas, split into low and
+#                 high byte planes and zlib'd, so size varies by frame
+# Both are vectorized with NumPy table lookups / array ops, and each frame
+# is coded on its own, so a listener that has frames dropped or skipped
+# can still decode the next one. Every frame except FORMAT_PCM's goes out
+# as [ payload len, 2 bytes ] [ payload ]; FORMAT_PCM is the raw, unframed
+# stream clients got before formats were negotiated. In the framed formats
+# an empty payload (FLUSH) marks a channel switch: the client drops the
+# audio it has buffered from the old channel.
+#
+
+import zlib
+import struct
+
+import numpy as np
+
+FORMAT_PCM = "pcm16"
+FORMAT_ULAW = "ulaw"
+FORMAT_DELTA = "delta"
+FORMATS = [FORMAT_ULAW, FORMAT_DELTA, FORMAT_PCM]   # supported, most compact first
+
+FRAME_LEN = struct.Struct(">H")     # length prefix of each framed payload
+FLUSH = FRAME_LEN.pack(0)           # channel switch marker, in framed formats
+DELTA_LEVEL = 1     # zlib level for FORMAT_DELTA: fastest, most of the gain
+
+ULAW_BIAS = 0x21     # G.711 reference coder, on 14-bit samples
+ULAW_CLIP = 8159
+ULAW_SEGMENTS = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+
+
+# ulaw_tables()
+# builds the mu-law encode table (every int16 sample, indexed as uint16,
+# to its code byte) and the decode table (code byte to int16 sample)
+def ulaw_tables():
+    samples = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32) >> 2
+    mask = np.where(samples < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(samples), ULAW_CLIP) + ULAW_BIAS
+    segment = np.searchsorted(ULAW_SEGMENTS, magnitude)
+    code = (segment << 4) | ((magnitude >> (segment + 1)) & 0x0F)
+    code = np.where(segment >= len(ULAW_SEGMENTS), 0x7F, code)    # out of range
+    encode = (code ^ mask).astype(np.uint8)
+
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    segment = (codes >> 4) & 0x07
+    magnitude = (((codes & 0x0F) << 3) + (ULAW_BIAS << 2) << segment) - (ULAW_BIAS << 2)
+    decode = np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+    return encode, decode
+
+ULAW_ENCODE, ULAW_DECODE = ulaw_tables()
+
+
+# encode()
+# encodes one frame of 16-bit PCM with the given number of channels in
+# fmt, ready to send
+def encode(frame, fmt, channels=2):
+    if fmt == FORMAT_PCM:
+        return frame
+    samples = np.frombuffer(frame, dtype=np.int16)
+    if fmt == FORMAT_ULAW:
+        payload = ULAW_ENCODE[samples.view(np.uint16)].tobytes()
+    elif fmt == FORMAT_DELTA:
+        interleaved = samples.reshape(-1, channels)
+        deltas = np.diff(interleaved, axis=0, prepend=np.zeros((1, channels), np.int16))
+        planes = deltas.view(np.uint8).reshape(-1, 2).T     # low bytes, then high
+        payload = zlib.compress(planes.tobytes(), DELTA_LEVEL)
+    else:
+        raise ValueError(f"unknown audio format {fmt}")
+    return FRAME_LEN.pack(len(payload)) + payload
+
+
+# decode()
+# decodes one frame's payload (without its length prefix) back into
+# 16-bit PCM bytes with the given number of channels
+def decode(payload, fmt, channels=2):
+    if fmt == FORMAT_PCM:
+        return bytes(payload)
+    if fmt == FORMAT_ULAW:
+        return ULAW_DECODE[np.frombuffer(payload, dtype=np.uint8)].tobytes()
+    if fmt == FORMAT_DELTA:
+        planes = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+        deltas = planes.reshape(2, -1).T.copy().view(np.int16).reshape(-1, channels)
+        return np.cumsum(deltas, axis=0, dtype=np.int16).tobytes()
+    raise ValueError(f"unknown audio format {fmt}")
+
+
+# pick()
+# returns the first format offered (in the client's order) that is
+# supported, or FORMAT_PCM
+def pick(offered):
+    if not isinstance(offered, list):
+        return FORMAT_PCM
+    return next((fmt for fmt in offered if fmt in FORMATS), FORMAT_PCM)
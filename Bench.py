@@ -0,0 +1,613 @@
+#
+# BENCH.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Benchmarks for ( name ). Run one benchmark by name, e.g.
+#   python3 Bench.py fetch [tracks]
+#   python3 Bench.py packet [seconds]
+#   python3 Bench.py decode [packets]
+#   python3 Bench.py audio [seconds]
+#   python3 Bench.py ingest [tracks] [error %]
+#   python3 Bench.py dsp [seconds]
+#   python3 Bench.py variants [seconds]
+#   python3 Bench.py micro [seconds]
+#   python3 Bench.py baseline [seconds]
+#
+
+#!/usr/bin/python3
+
+import io
+import sys
+import time
+
+INGEST_BANDWIDTH = 2 * 1024 * 1024  # bytes/sec per response in bench_ingest
+BASELINE_FILE = "bench_baseline.json"   # bench_micro's stored baseline
+REGRESSION = 0.25       # fraction slower than baseline that fails bench_micro
+ALLOC_SLACK = 64        # bytes/op of allocation growth always tolerated
+MICRO_LISTENERS = [1, 10, 100, 1000]    # listeners per fan-out case
+MICRO_SONGS = 4         # songs the micro benchmark's channels cycle through
+MICRO_SONG_SECONDS = 2
+
+
+# bench_fetch()
+# downloads num_tracks tracks' HLS segments from a local FakeSoundCloud,
+# first the old way (one fresh connection per segment, one at a time),
+# then through SongFetcher's pooled, parallel fetch_segments; prints
+# tracks/minute for both
+def bench_fetch(num_tracks=5):
+    import requests
+    import FakeSoundCloud as fake
+    import SongFetcher as sf
+
+    server = fake.start()
+    host, port = server.server_address
+
+    def segment_urls(track):
+        playlist = requests.get(f"http://{host}:{port}/playlist/{track}.m3u8").text
+        return [line for line in playlist.split("\n") if line and not line.startswith("#")]
+
+    # before: a fresh requests.get per segment, in order
+    start = time.perf_counter()
+    for track in range(num_tracks):
+        f = io.BytesIO()
+        for url in segment_urls(f"before{track}"):
+            f.write(requests.get(url, timeout=5).content)
+    before = time.perf_counter() - start
+
+    # after: shared connection pool, SEGMENT_WORKERS segments in flight
+    start = time.perf_counter()
+    for track in range(num_tracks):
+        f = io.BytesIO()
+        sf.fetch_segments(segment_urls(f"after{track}"), f)
+    after = time.perf_counter() - start
+
+    server.shutdown()
+    print(f"fetch before: {num_tracks / before * 60:8.1f} tracks/min")
+    print(f"fetch after:  {num_tracks / after * 60:8.1f} tracks/min "
+          f"({before / after:.1f}x)")
+
+
+# sample control packets: (name, type, data)
+def sample_packets():
+    import Packet as pack
+    names = [f"listener{n:05d}" for n in range(2000)]
+    channels = ["PokéCenter", "lofi", "city pop", "acoustic", "study", "jazz"]
+    return [
+        ("S_INIT 2k names", pack.S_INIT, {"c": channels, "n": names}),
+        ("C_INIT", pack.C_INIT, ["com", "AbC4", "listener00042"]),
+        ("C_MSG", pack.C_MSG, "anyone know the name of this song? it slaps"),
+        ("S_LIST", pack.S_LIST, channels),
+    ]
+
+
+# rate()
+# calls fn repeatedly for about seconds; returns calls per second
+def rate(fn, seconds):
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _ in range(100):
+            fn()
+        calls += 100
+    return calls / (time.perf_counter() - start)
+
+
+# bench_packet()
+# encode / decode throughput and packet size of each control packet codec
+def bench_packet(seconds=1):
+    import Packet as pack
+
+    print(f"{'packet':<16} {'codec':<5} {'bytes':>7} {'encode/s':>10} {'decode/s':>10}")
+    for name, type, data in sample_packets():
+        for codec in [pack.CODEC_JSON, pack.CODEC_BIN]:
+            packet_bytes = pack.construct_packet(type, data, codec)
+            if codec == pack.CODEC_JSON:    # JSON decode takes the body only
+                extra, _ = pack.body_len(packet_bytes[:pack.DATA_BYTE], codec)
+                body = packet_bytes[pack.DATA_BYTE + extra:]
+            else:
+                body = packet_bytes
+
+            encode = rate(lambda: pack.construct_packet(type, data, codec), seconds / 2)
+            decode = rate(lambda: pack.deconstruct_packet(body, codec), seconds / 2)
+            print(f"{name:<16} {codec:<5} {len(packet_bytes):>7} {encode:>10.0f} {decode:>10.0f}")
+
+
+# bench_decode()
+# reads num_packets pipelined chat packets off a socket, first with one
+# blocking read_packet per packet, then with a PacketDecoder that decodes
+# every packet each recv_into brings in; prints packets/sec and syscalls
+def bench_decode(num_packets=100000):
+    import socket
+    import threading
+    import Packet as pack
+
+    stream = pack.construct_packet(pack.C_MSG, "anyone know the name of this song?") * num_packets
+
+    def timed(read_all):
+        reader, writer = socket.socketpair()
+        sender = threading.Thread(target=writer.sendall, args=(stream,))
+        start = time.perf_counter()
+        sender.start()
+        reads = read_all(reader)
+        elapsed = time.perf_counter() - start
+        sender.join()
+        reader.close()
+        writer.close()
+        return num_packets / elapsed, reads
+
+    def read_each(reader):
+        for _ in range(num_packets):
+            pack.read_packet(reader)
+        return 2 * num_packets  # header, then body
+
+    def read_decoder(reader):
+        decoder = pack.PacketDecoder()
+        got = reads = 0
+        while got < num_packets:
+            decoder.recv(reader)
+            reads += 1
+            got += sum(1 for _ in decoder.packets())
+        return reads
+
+    for name, read_all in [("read_packet", read_each), ("PacketDecoder", read_decoder)]:
+        rate, reads = timed(read_all)
+        print(f"{name:<14} {rate:>10.0f} packets/s {reads:>8} recv calls")
+
+
+# sample_song()
+# seconds of synthetic 16-bit stereo music: a few detuned chords with
+# note envelopes, a little noise, and the channels slightly apart
+def sample_song(seconds=10):
+    import numpy as np
+    import Packet as pack
+
+    t = np.arange(int(seconds * pack.SAMPLE_RATE)) / pack.SAMPLE_RATE
+    rng = np.random.default_rng(112)
+    left = np.zeros_like(t)
+    for beat in range(int(seconds * 2)):
+        start = beat / 2
+        envelope = np.exp(-3 * np.clip(t - start, 0, None)) * (t >= start)
+        for freq in 110 * 2 ** (rng.integers(0, 24, 3) / 12):
+            left += envelope * np.sin(2 * np.pi * freq * t) * 0.2
+    left += rng.normal(0, 0.003, len(t))
+    right = np.roll(left, 40) * 0.9
+    stereo = np.stack([left, right], axis=1)
+    return (np.clip(stereo, -1, 1) * 20000).astype(np.int16).tobytes()
+
+
+# bench_audio()
+# encode and decode time per pack.AUDIO_PACK frame, and bytes sent per
+# frame, for each audio wire format
+def bench_audio(seconds=10):
+    import Packet as pack
+    import AudioCodec as ac
+
+    song = sample_song(seconds)
+    frames = [song[i : i + pack.AUDIO_PACK]
+              for i in range(0, len(song) - pack.AUDIO_PACK + 1, pack.AUDIO_PACK)]
+    print(f"{'format':<7} {'bytes/frame':>11} {'kbit/s':>7} {'encode us':>9} {'decode us':>9}")
+    for fmt in ac.FORMATS:
+        start = time.perf_counter()
+        encoded = [ac.encode(frame, fmt) for frame in frames]
+        encode_us = (time.perf_counter() - start) / len(frames) * 1e6
+
+        header = 0 if fmt == ac.FORMAT_PCM else ac.FRAME_LEN.size
+        start = time.perf_counter()
+        for data in encoded:
+            ac.decode(data[header:], fmt)
+        decode_us = (time.perf_counter() - start) / len(frames) * 1e6
+
+        frame_bytes = sum(len(data) for data in encoded) / len(frames)
+        kbps = frame_bytes / pack.AUDIO_PACK * pack.BYTE_RATE * 8 / 1000
+        print(f"{fmt:<7} {frame_bytes:>11.0f} {kbps:>7.0f} {encode_us:>9.1f} {decode_us:>9.1f}")
+
+
+# bench_variants()
+# CPU time each Resample variant costs a channel per frame (and as a share
+# of one core, in real time) against the bandwidth it saves per listener,
+# as raw PCM and as mu-law
+def bench_variants(seconds=10):
+    import Packet as pack
+    import AudioCodec as ac
+    from Resample import Resampler, RATES, CHANNEL_COUNTS
+
+    song = sample_song(seconds)
+    frames = [song[i : i + pack.AUDIO_PACK]
+              for i in range(0, len(song) - pack.AUDIO_PACK + 1, pack.AUDIO_PACK)]
+    frame_time = pack.AUDIO_PACK / pack.BYTE_RATE
+    print(f"{'variant':<14} {'us/frame':>8} {'% core':>6} {'pcm kbit/s':>10} "
+          f"{'ulaw kbit/s':>11} {'saved':>6}")
+    for rate in RATES:
+        for channels in CHANNEL_COUNTS:
+            variant = (rate, channels)
+            start = time.process_time()
+            if variant == (pack.SAMPLE_RATE, pack.CHANNELS):
+                out = frames    # the songs' own format: passed through
+            else:
+                resampler = Resampler((pack.SAMPLE_RATE, pack.CHANNELS), variant)
+                out = [resampler.convert(frame) for frame in frames]
+            cpu = (time.process_time() - start) / len(frames)
+
+            pcm_kbps = sum(len(frame) for frame in out) / seconds * 8 / 1000
+            ulaw = sum(len(ac.encode(frame, ac.FORMAT_ULAW, channels)) for frame in out)
+            saved = 1 - pcm_kbps / (pack.BYTE_RATE * 8 / 1000)
+            name = f"{rate} {'stereo' if channels == 2 else 'mono'}"
+            print(f"{name:<14} {cpu * 1e6:>8.1f} {cpu / frame_time:>6.1%} {pcm_kbps:>10.0f} "
+                  f"{ulaw / seconds * 8 / 1000:>11.0f} {saved:>6.0%}")
+
+
+# bench_dsp()
+# seconds of audio Dsp.process trims, levels and prepares crossfades for
+# per CPU-second, over seconds of synthetic music, and the CPU time one
+# crossfade takes at a song boundary
+def bench_dsp(seconds=60):
+    import Dsp as dsp
+    import Packet as pack
+
+    pcm = dsp.samples(sample_song(seconds), pack.CHANNELS)
+    start = time.process_time()
+    done = dsp.process(pcm, pack.SAMPLE_RATE, lambda data: None)
+    cpu = time.process_time() - start
+    print(f"process:   {seconds / cpu:8.0f} s of audio per CPU-second "
+          f"(gain {done.gain:+.1f} dB, trimmed {len(pcm) - done.length} samples)")
+
+    tail = head = bytes(done.tail * pack.CHANNELS * pack.SAMPLE_WIDTH)
+    start = time.process_time()
+    for _ in range(100):
+        dsp.crossfade(tail, head)
+    cpu = (time.process_time() - start) / 100
+    print(f"crossfade: {cpu * 1e6:8.0f} us per song boundary "
+          f"({dsp.CROSSFADE_SECONDS} s overlap)")
+
+
+# rss_bytes()
+# the process's resident memory now, or its peak so far where /proc
+# isn't available
+def rss_bytes():
+    import os
+    import resource
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# bench_ingest()
+# fetches and ingests num_tracks tracks from a FakeSoundCloud serving real
+# MP3 fixtures, through the whole SongFetcher path (client ID scrape,
+# search, transcoding url, playlist, segments), first as full downloads
+# converted by pydub, then as StreamIngest streams; Prefetch.WORKERS
+# tracks at a time. error_pct percent of API requests fail with a 500,
+# and half as many with a 401. prints tracks/minute, seconds until the
+# first song is playable and peak resident memory for each
+def bench_ingest(num_tracks=6, error_pct=0):
+    import os
+    import shutil
+    import tempfile
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    import FakeSoundCloud as fake
+    import SongFetcher as sf
+    import SongStore
+    import StreamIngest
+    from Prefetch import WORKERS
+
+    server = fake.start(audio=True, bandwidth=INGEST_BANDWIDTH,
+                        error_rate=error_pct / 100, unauthorized=error_pct / 200)
+    home = os.getcwd()
+    work = tempfile.mkdtemp(prefix="requestify-bench-")
+    os.chdir(work)  # the scraped client ID's .env goes here too
+    sf.API_BASE = sf.SITE_BASE = server.base
+    sf.SONG_DIR = os.path.join(work, "songs")
+    SongStore.STORE_DIR = os.path.join(sf.SONG_DIR, "store")
+    sf.CACHE = SongStore.STORE = sf.CLIENT_ID = None
+    sf.SEARCHES = sf.SearchCache()
+
+    runs = [("download", sf.search("bench download", num_tracks)),
+            ("stream", sf.search("bench stream", num_tracks))]
+    print(f"generating {sum(len(tracks) for _, tracks in runs)} fixtures...")
+    for _, tracks in runs:
+        for track in tracks:
+            server.fixture(str(track["id"]))
+
+    def download(track, playable):
+        song = sf.download_song(track)
+        if song is not None:
+            SongStore.get_store().ingest(song)
+            playable()
+        return song
+
+    def stream(track, playable):
+        song = StreamIngest.stream_song(track)
+        if song is None:
+            return None
+        song.started.wait()
+        if not song.failed:
+            playable()
+        song.done.wait()
+        return song.final
+
+    print(f"{'mode':<9} {'tracks':>6} {'tracks/min':>10} {'first s':>7} {'peak MB':>7}")
+    for (name, tracks), ingest in zip(runs, [download, stream]):
+        first = []
+        peak = [rss_bytes()]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.05):
+                peak[0] = max(peak[0], rss_bytes())
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+
+        start = time.perf_counter()
+        playable = lambda: first.append(time.perf_counter() - start)
+        with ThreadPoolExecutor(WORKERS) as pool:
+            songs = list(pool.map(lambda track: ingest(track, playable), tracks))
+        elapsed = time.perf_counter() - start
+        done.set()
+        sampler.join()
+
+        stored = sum(song is not None for song in songs)
+        first_s = f"{min(first):7.2f}" if first else f"{'-':>7}"
+        print(f"{name:<9} {stored:>6} {stored / elapsed * 60:>10.1f} {first_s} "
+              f"{peak[0] / 2 ** 20:>7.0f}")
+
+    print("served: " + " ".join(f"{k}={v}" for k, v in server.counts.items()))
+    server.shutdown()
+    os.chdir(home)
+    shutil.rmtree(work, ignore_errors=True)
+
+
+# measure()
+# runs op in batches for about seconds, timing only the batches; between,
+# if given, runs untimed after each batch. returns ops per second
+def measure(op, seconds, batch=100, between=None):
+    ops = 0
+    elapsed = 0.0
+    while ops == 0 or elapsed < seconds:
+        start = time.perf_counter()
+        for _ in range(batch):
+            op()
+        elapsed += time.perf_counter() - start
+        ops += batch
+        if between is not None:
+            between()
+    return ops / elapsed
+
+
+# alloc_per_op()
+# average bytes of Python heap one call of op allocates above what was
+# live before it (tracemalloc's peak), over num calls
+def alloc_per_op(op, num=50, between=None):
+    import tracemalloc
+    op()    # warm caches, so one-time allocations don't count
+    if between is not None:
+        between()
+    tracemalloc.start()
+    total = 0
+    for _ in range(num):
+        live, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        op()
+        total += tracemalloc.get_traced_memory()[1] - live
+        if between is not None:
+            between()
+    tracemalloc.stop()
+    return total / num
+
+
+# micro_songs()
+# writes num_songs seconds-long WAVs of distinct noise into a temporary
+# song cache and stores them, returning their filenames
+def micro_songs(num_songs, seconds):
+    import os
+    import wave
+    import tempfile
+    import SongFetcher as sf
+    import SongStore
+    import Packet as pack
+
+    work = tempfile.mkdtemp(prefix="requestify-micro-")
+    sf.SONG_DIR = work
+    SongStore.STORE_DIR = os.path.join(work, "store")
+    sf.CACHE = SongStore.STORE = None
+
+    songs = []
+    for n in range(num_songs):
+        song = f"micro{n:03d}.wav"
+        with wave.open(os.path.join(work, song), "wb") as f:
+            f.setnchannels(pack.CHANNELS)
+            f.setsampwidth(pack.SAMPLE_WIDTH)
+            f.setframerate(pack.SAMPLE_RATE)
+            f.writeframes(os.urandom(int(seconds * pack.BYTE_RATE) & ~3))
+        SongStore.get_store().ingest(song)
+        songs.append(song)
+    return work, songs
+
+
+# micro_cases()
+# the streaming hot paths bench_micro times, as (name, op, bytes per op,
+# between, cleanup): op does one unit of work (a packet, a frame, a song
+# switch), between runs untimed after each batch of ops
+def micro_cases(songs):
+    import socket
+    import Packet as pack
+    import AudioCodec as ac
+    import Prefetch
+    from CircBuff import CircBuff
+    from LoadGen import raise_fd_limit
+    from Server import Server, Channel
+    from Session import ClientSession
+
+    # channels over a fixed playlist; a scheduler without workers takes
+    # their requests for more songs and never fetches
+    Prefetch.SCHEDULER = Prefetch.FetchScheduler(workers=0)
+
+    class Playlist(Channel):
+        def fill(self, num_songs):
+            self.songs = list(songs)
+
+    msg = "anyone know the name of this song? it slaps"
+    packet = pack.construct_packet(pack.C_MSG, msg)
+    body = packet[pack.DATA_BYTE + pack.body_len(packet[:pack.DATA_BYTE], pack.CODEC_JSON)[0]:]
+    cases = [
+        ("construct_packet", lambda: pack.construct_packet(pack.C_MSG, msg),
+         len(packet), None, None),
+        ("deconstruct_packet", lambda: pack.deconstruct_packet(body),
+         len(packet), None, None),
+    ]
+
+    writer, reader = socket.socketpair()
+    def round_trip():
+        pack.write_packet(writer, pack.C_MSG, msg)
+        pack.read_packet(reader)
+    def close_pair():
+        writer.close()
+        reader.close()
+    cases.append(("write+read_packet", round_trip, len(packet), None, close_pair))
+
+    buff = CircBuff(pack.AUDIO_PACK * 16)
+    frame = bytes(pack.AUDIO_PACK)
+    def append_consume():
+        buff.append(frame)
+        buff.consume(pack.AUDIO_PACK)
+    cases.append(("CircBuff append+consume", append_consume, pack.AUDIO_PACK, None, None))
+
+    switching = Playlist("micro switch")
+    cases.append(("Channel.next", switching.next, 0, None, None))
+
+    raise_fd_limit()
+    scratch = bytearray(256 * 1024)
+    for num_listeners in MICRO_LISTENERS:
+        server = Server(None)
+        channel = Playlist(f"micro fan-out {num_listeners}")
+        server.channels = [channel]
+        pairs = [socket.socketpair() for _ in range(num_listeners)]
+        for n, (aud, listener) in enumerate(pairs):
+            listener.setblocking(False)
+            # listen-only: the audio socket stands in for the control one
+            session = ClientSession(aud, aud, f"listener{n}", ac.FORMAT_PCM)
+            server.fanout.add(aud, session.audio)
+            server.sessions.add(session, channel)
+
+        def drain(pairs=pairs):
+            for _, listener in pairs:
+                try:
+                    while listener.recv_into(scratch):
+                        pass
+                except BlockingIOError:
+                    pass
+        def close_all(pairs=pairs):
+            for pair in pairs:
+                pair[0].close()
+                pair[1].close()
+        cases.append((f"write_song_packets x{num_listeners}",
+                      lambda server=server, channel=channel: server.write_song_packets(channel),
+                      pack.AUDIO_PACK * num_listeners, drain, close_all))
+    return cases
+
+
+# bench_micro()
+# ops/sec, bytes/sec and bytes allocated per op of each streaming hot
+# path, compared with the baseline in BASELINE_FILE: the run fails (exit
+# status 1) if any case is more than REGRESSION slower, or allocates that
+# much more, than its baseline. with save, records this run as the baseline.
+# a missing baseline also fails, unless no_baseline says to only measure
+def bench_micro(seconds=1, save=False, no_baseline=False):
+    import os
+    import json
+    import shutil
+
+    baseline = {}
+    if not save and os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, "r") as f:
+            baseline = json.load(f)
+
+    work, songs = micro_songs(MICRO_SONGS, MICRO_SONG_SECONDS)
+    results = {}
+    regressions = []
+    print(f"{'case':<25} {'ops/s':>10} {'MB/s':>8} {'alloc B/op':>10} {'vs base':>8}")
+    for name, op, num_bytes, between, cleanup in micro_cases(songs):
+        batch = 64 if between is not None else 100  # 64 frames fit a socket buffer
+        ops = measure(op, seconds, batch, between)
+        alloc = alloc_per_op(op, between=between)
+        if cleanup is not None:
+            cleanup()
+        results[name] = {"ops": round(ops, 1), "alloc": round(alloc)}
+
+        versus = ""
+        base = baseline.get(name)
+        if base is not None:
+            versus = f"{ops / base['ops'] - 1:+8.0%}"
+            if ops < base["ops"] * (1 - REGRESSION):
+                regressions.append(f"{name}: {ops:.0f} ops/s, baseline {base['ops']:.0f}")
+            if alloc > base["alloc"] * (1 + REGRESSION) + ALLOC_SLACK:
+                regressions.append(f"{name}: {alloc:.0f} B/op allocated, baseline {base['alloc']}")
+        print(f"{name:<25} {ops:>10.0f} {ops * num_bytes / 2 ** 20:>8.1f} {alloc:>10.0f} {versus:>8}")
+    shutil.rmtree(work, ignore_errors=True)
+
+    if save:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"Saved baseline to {BASELINE_FILE}")
+    elif not baseline and not no_baseline:
+        print(f"No baseline in {BASELINE_FILE}; record one with python3 Bench.py micro --save-baseline,")
+        print("or pass --no-baseline to only measure")
+        sys.exit(1)
+    elif regressions:
+        print(f"Regressed more than {REGRESSION:.0%} from baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+# bench_baseline()
+# runs bench_micro and records it as the baseline later runs compare with
+def bench_baseline(seconds=1):
+    bench_micro(seconds, save=True)
+
+
+BENCHES = {
+    "fetch": bench_fetch,
+    "packet": bench_packet,
+    "decode": bench_decode,
+    "audio": bench_audio,
+    "ingest": bench_ingest,
+    "dsp": bench_dsp,
+    "variants": bench_variants,
+    "micro": bench_micro,
+    "baseline": bench_baseline,
+}
+
+# flags a benchmark takes as keyword arguments
+FLAGS = {
+    "micro": {"--save-baseline": "save", "--no-baseline": "no_baseline"},
+}
+
+# number()
+# parses a benchmark argument: counts are ints, durations may be floats
+def number(arg):
+    try:
+        return int(arg)
+    except ValueError:
+        return float(arg)
+
+
+def main():
+    usage = f"Usage: python3 Bench.py <{'|'.join(BENCHES)}> [args] [flags]"
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHES:
+        print(usage)
+        quit()
+
+    flags = FLAGS.get(sys.argv[1], {})
+    kwargs = {flags[arg]: True for arg in sys.argv[2:] if arg in flags}
+    try:
+        args = [number(arg) for arg in sys.argv[2:] if arg not in flags]
+    except ValueError:
+        print(usage)
+        quit()
+    BENCHES[sys.argv[1]](*args, **kwargs)
+
+if __name__ == "__main__":
+    main()
@@ -1,100 +1,105 @@
 #
-# SERVER.PY
+# CIRCBUFF.PY
 # (Soundcloud / Application name )
 # Skylar Gilfeather, CS112 Fall 2022
-# 
-# Implementation of circular buffer for Client class; will be made private
-# inner class after testing.
+#
+# Circular byte buffer between the Client's network thread, which writes
+# received audio into it (straight from the socket, with recv_into), and
+# its audio callback, which copies it out. Safe for one producer and one
+# consumer thread without a lock: each side only moves its own counter.
 
 #!/usr/bin/python3
 
-# 
-# inner class CircBuff: 
-# (description)
+#
+# class CircBuff:
+# preallocated ring of buff_len bytes. written and read count every byte
+# ever appended and consumed, so the buffer is empty when they are equal
+# and full when they are buff_len apart; only the producer moves written,
+# and only the consumer moves read
 
 class CircBuff:
     def __init__(self, len):
-        # TODO: enforce non-negative length?
+        if len <= 0:
+            raise ValueError("CircBuff length must be positive")
         self.buff_len = len
-        self.circ_buff = [0] * len
+        self.circ_buff = bytearray(len)
+        self.view = memoryview(self.circ_buff)
 
-        self.buff_head = self.buff_len # init
-        self.buff_tail = 0
+        self.written = 0    # bytes ever appended (producer)
+        self.read = 0       # bytes ever consumed (consumer)
+
+    # sublen()
+        # gets the number of bytes buffered and not yet consumed
+    def sublen(self):
+        return self.written - self.read
+
+    # space()
+        # gets the number of bytes that can be appended without overwriting
+        # unconsumed data
+    def space(self):
+        return self.buff_len - (self.written - self.read)
+
+    # recv_into()
+        # producer: receives up to the free space from sock straight into
+        # the buffer (up to its end, if the free space wraps around)
+        # returns the number of bytes received, 0 once the peer hangs up
+    def recv_into(self, sock):
+        tail = self.written % self.buff_len
+        num = min(self.space(), self.buff_len - tail)
+        if num == 0:
+            raise BufferError("CircBuff is full")
+        got = sock.recv_into(self.view[tail : tail + num])
+        self.written += got
+        return got
 
     # append()
-        # append given data to the tail of circular buffer; assumes 
-        # there's enough empty space in circ_buff to hold data, e.g.
-        # checked with a call to sublen()
-        # returns True if append is successful, False if buffer is full
+        # producer: appends data to the tail of the circular buffer
+        # returns True if append is successful, False if there isn't room
     def append(self, data):
         len_data = len(data)
-
-        # if buffer doesn't have enough room for len_data bytes
-        if len_data > self.sublen(self.buff_tail, self.buff_head):
+        if len_data > self.space():
             return False
 
-        # set buff_head to 0 after reset
-        self.buff_head = self.buff_head % self.buff_len
-
-        # if data will wrap around end of circ_buff
-        if self.buff_tail + len_data > self.buff_len:
-            bytes_to_end = self.buff_len - self.buff_tail
-
-            # write this many bytes of data into end of circ_buff 
-            self.circ_buff[self.buff_tail :] = data[: bytes_to_end]
-
-            # write rest of data buffer into start of circ_buff
-            self.circ_buff[: len_data - bytes_to_end] = data[bytes_to_end :]
-            # set buff tail
-            self.buff_tail = len_data - bytes_to_end
-        else:
-        # write data into circular buffer
-            self.circ_buff[self.buff_tail : self.buff_tail + len_data] = data
-            self.buff_tail = self.buff_tail + len_data
-
+        tail = self.written % self.buff_len
+        bytes_to_end = min(len_data, self.buff_len - tail)
+        # write into end of circ_buff, then the rest (if any) into its start
+        self.view[tail : tail + bytes_to_end] = data[: bytes_to_end]
+        self.view[: len_data - bytes_to_end] = data[bytes_to_end :]
+        self.written += len_data
         return True
 
+    # consume_into()
+        # consumer: copies up to len(out) buffered bytes into out, e.g. an
+        # audio device's buffer, and consumes them
+        # returns the number of bytes copied
+    def consume_into(self, out, num=None):
+        num = min(len(out) if num is None else num, self.sublen())
+        head = self.read % self.buff_len
+        bytes_to_end = min(num, self.buff_len - head)
+        out[: bytes_to_end] = self.view[head : head + bytes_to_end]
+        out[bytes_to_end : num] = self.view[: num - bytes_to_end]
+        self.read += num
+        return num
+
     # consume()
-        # consumes num elements from circular buffer, shifting up
-        # buff_head to match
-        # returns data if sucessful, empty list if num > number of items
-        # currently in CircBuffer
+        # consumer: consumes num bytes from the circular buffer
+        # returns them as bytes if sucessful, b"" if num > number of bytes
+        # currently in CircBuff
     def consume(self, num):
-        if num > self.sublen(self.buff_head, self.buff_tail):
-            return []
-        
-        if self.buff_head + num > self.buff_len:
-            bytes_to_end = self.buff_len - self.buff_head
-
-            # take this many bytes of data from end of circ_buff 
-            got_data = self.circ_buff[self.buff_head :]
-            # take rest of data from start of circ_buff
-            more_data = self.circ_buff[: num - bytes_to_end]
-            got_data = got_data + more_data
-            # set buff_head
-            self.buff_head = num - bytes_to_end
-        else:
-            got_data = self.circ_buff[self.buff_head : self.buff_head + num]
-
-            self.circ_buff[self.buff_head : self.buff_head + num] = [0] * num
-            self.buff_head = self.buff_head + num
-
-        return got_data
+        if num > self.sublen():
+            return b""
+        data = bytearray(num)
+        self.consume_into(data)
+        return bytes(data)
+
+    # skip()
+        # consumer: discards up to num buffered bytes; returns how many
+    def skip(self, num):
+        num = min(num, self.sublen())
+        self.read += num
+        return num
 
     # reset()
-        # clear circular buffer
+        # consumer: clear circular buffer
     def reset(self):
-        self.circ_buff = [0] * self.buff_len
-        self.buff_head = self.buff_len # init
-        self.buff_tail = 0
-
-
-    # sublen()
-        # gets number of elements from [from_ind, to_ind)
-    def sublen(self, from_ind, to_ind):
-        if to_ind == from_ind:
-            return 0
-        elif to_ind > from_ind:
-            return to_ind - from_ind
-        else:
-            return (self.buff_len - from_ind) + to_ind + 1
\ No newline at end of file
+        self.skip(self.sublen())
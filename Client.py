@@ -14,16 +14,24 @@ import json
 import time
 import string
 import random
+import threading
 
 import select
 import socket as socket
 import sounddevice as sd
 import Packet as pack 
+import AudioCodec as ac
+import Resample
+from JitterBuffer import JitterBuffer
 
 
 SELF = "127.0.0.1"  # loopback for hosting oneself
 NONCE_VALS = string.ascii_uppercase + string.ascii_lowercase + string.digits
 MSG_MAX = 140
+REQUEST_STATUS = {  # S_REQ statuses, as shown to the user
+    "queued": "queued", "fetching": "finding songs", "done": "now playing",
+    "failed": "no songs found", "replaced": "replaced by a newer request",
+}
 
 #
 # class Client
@@ -36,7 +44,8 @@ class Client:
     curr_channel: int   # initialized to 0, lobby
 
 
-    def __init__(self, host_addr, host_port):
+    def __init__(self, host_addr, host_port, audio_format=ac.FORMAT_PCM,
+                 rate=pack.SAMPLE_RATE, channels=pack.CHANNELS):
         self.aud_s = -1     # receives audio data
         self.com_s = -1     # writes and reads messages to / from server
         self.nonce = ''.join(random.choices(''.join(NONCE_VALS), k=4))
@@ -46,6 +55,11 @@ class Client:
 
         self.curr_channel = 0
         self.chan_list = []
+        self.decoder = None     # PacketDecoder for com socket
+        self.audio_format = audio_format    # preferred, then as negotiated
+        self.rate = rate            # sample rate asked for, then as negotiated
+        self.channels = channels    # ...and channels
+        self.jitter = JitterBuffer()    # audio received, waiting to play
 
         self.open_socket("com")  
 
@@ -61,6 +75,7 @@ class Client:
             if which == "com":
                 self.com_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.com_s.connect((self.host_addr, self.host_port))
+                self.decoder = pack.PacketDecoder()
             elif which == "aud":
                 self.aud_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.aud_s.connect((self.host_addr, self.host_port))
@@ -68,15 +83,14 @@ class Client:
             print(f"Client network error for socket: {str(e)}.")
             sys.exit(0) 
 
+    # stream_callback()
+    # audio device callback: only copies out of the jitter buffer, so the
+    # network never stalls the audio thread
     def stream_callback(self, outdata, frames, time, status):
         if status:
             print(status, file=sys.stderr)
-        new_data = self.read_frame()
-
-        if len(new_data) == 0:
+        if not self.jitter.fill(outdata):
             raise sd.CallbackStop
-        outdata[:len(new_data)] = new_data
-        outdata[len(new_data):] = b'\0' * (len(outdata) - len(new_data))
 
 
     # setup_protocol()
@@ -93,11 +107,32 @@ class Client:
             self.open_socket("com")
             return  # will receive a new S_INIT packet with names
  
-        # associate both aud_s and com_s on serverside with given nonce
-        pack.write_packet(self.com_s, pack.C_INIT, ["com", self.nonce, try_name])
+        # associate both aud_s and com_s on serverside with given nonce,
+        # offering the packet codecs and audio formats this client speaks,
+        # and asking for audio at the rate and channels it plays at
+        audio = [self.audio_format] + [f for f in ac.FORMATS if f != self.audio_format]
+        options = {"codecs": pack.CODECS, "audio": audio,
+                   "rate": self.rate, "channels": self.channels}
+        pack.write_packet(self.com_s, pack.C_INIT, ["com", self.nonce, try_name, options])
+
+        # server confirms the codec (in JSON) before switching to it
+        type, data = self.decoder.read_packet(self.com_s)
+        if type == pack.S_YES and data.get("codec") in pack.CODECS:
+            self.decoder.codec = data["codec"]
+            self.audio_format = ac.pick([data.get("audio")])
+            self.rate = data.get("rate", pack.SAMPLE_RATE)
+            self.channels = data.get("channels", pack.CHANNELS)
+            self.jitter = JitterBuffer(self.rate * self.channels * pack.SAMPLE_WIDTH)
+        elif type == pack.S_ERR:
+            print(data)
+            self.com_s.close()  # close and try to reopen socket
+            self.open_socket("com")
+            return
 
-        # setup new port for communications
+        # setup new port for communications; the server greets it with its
+        # own S_INIT, which must be read before any audio
         self.open_socket("aud")
+        pack.read_packet(self.aud_s)
         pack.write_packet(self.aud_s, pack.C_INIT, ["aud", self.nonce, try_name])
 
 
@@ -110,22 +145,23 @@ class Client:
         print("\tlist")
         print("\trequest [ query ]")
         print("\tchat [ message ]")
+        print("\tstats")
     
     # join_channel()
     # wrapper to send C_JOIN packet to Server to join new channel
     def join_channel(self, query):
-        pack.write_packet(self.com_s, pack.C_JOIN, query)
+        pack.write_packet(self.com_s, pack.C_JOIN, query, self.decoder.codec)
         # TODO: update internal "curr_channel"
 
     # request_channels
     # wrapper to send C_LIST packet and ask Server for updated channel list
     def request_channels(self):
-        pack.write_packet(self.com_s, pack.C_LIST, "")
+        pack.write_packet(self.com_s, pack.C_LIST, "", self.decoder.codec)
 
     # request_song
     # wrapper to send C_REQ packet and ask Server to add a song from query
     def request_song(self, query):
-        pack.write_packet(self.com_s, pack.C_REQ, query)
+        pack.write_packet(self.com_s, pack.C_REQ, query, self.decoder.codec)
 
     # write_chat()
     # writes a chat of maximum MSG_MAX characters to all other clients on
@@ -134,7 +170,7 @@ class Client:
         if len(message) > MSG_MAX:
             print(f"Error: message \"{message[:20]}...\" too long.\n")
             return
-        pack.write_packet(self.com_s, pack.C_MSG, message)
+        pack.write_packet(self.com_s, pack.C_MSG, message, self.decoder.codec)
 
 
     # client_handle_packet()
@@ -158,6 +194,21 @@ class Client:
             print(data)
             print("\n* ", end="", flush=True)
 
+        # switched channels: a pcm16 stream has no room for the FLUSH
+        # marker framed formats get, so the old channel's audio is dropped
+        # up to the offset the new channel's starts at
+        elif type == pack.S_FLUSH:
+            if self.audio_format == ac.FORMAT_PCM:
+                self.jitter.flush(data)
+
+        # progress of a vibe request
+        elif type == pack.S_REQ:
+            status = REQUEST_STATUS.get(data["s"], data["s"])
+            if data["s"] == "fetching" and data["n"] > 0:
+                status += f" ({data['n']}/{data['of']} songs ready)"
+            print(f"Request \"{data['q']}\": {status}")
+            print("\n* ", end="", flush=True)
+
 
     # client_handle_user_input()
     # reads a single line from user and parses it for command input
@@ -177,6 +228,9 @@ class Client:
             self.curr_channel = -1
         elif line.startswith("chat "):
             self.write_chat(line[5:])
+        elif line == "stats":
+            print(" ".join(f"{k}={v}" for k, v in self.jitter.stats().items()))
+            print("\n* ", end="", flush=True)
         elif line == "help":
             self.print_menu()
             print("\n* ", end="", flush=True)
@@ -198,19 +252,22 @@ class Client:
     # run_client()
     # executes loop for recieving streamed server data
     def run_client(self):
-        stream = sd.RawOutputStream(
-            samplerate=44100, blocksize=int(pack.AUDIO_PACK / 4),
-            channels=2, dtype='int16',
-            callback=self.stream_callback)
-   
         # listen for init packets: first packet on com_s stream should
         # contain setup com port with channel options
-        type, data = pack.read_packet(self.com_s)
+        type, data = self.decoder.read_packet(self.com_s)
         if type != pack.S_INIT:
             print(f"Error: did not recieve init packet from server.")
             return
         
         self.setup_protocol(data["c"], data["n"])  # confirm username and setup audio socket
+        if isinstance(self.aud_s, socket.socket):
+            threading.Thread(target=self.receive_audio, daemon=True).start()
+
+        # play at the sample rate and channels the server agreed to
+        stream = sd.RawOutputStream(
+            samplerate=self.rate, blocksize=int(pack.AUDIO_PACK / 4),
+            channels=self.channels, dtype='int16',
+            callback=self.stream_callback)
 
         print("˖⁺｡˚⋆˙" * 10)
         print(f"\nWelcome to the client!")
@@ -227,8 +284,12 @@ class Client:
                     # read a communications packet from Server 
                     if s == self.com_s:
                         print("")
-                        type, data = pack.read_packet(s)
-                        self.client_handle_packet(type, data)
+                        self.decoder.recv(s)
+                        for type, data in self.decoder.packets():
+                            self.client_handle_packet(type, data)
+                        if self.decoder.closed:
+                            print("Lost connection to server.")
+                            self.curr_channel = -1
                         
                     # if input from the user, parse and handle input!
                     elif s == sys.stdin:
@@ -236,39 +297,60 @@ class Client:
                         
                     
 
-    # read_frame()
-        # reads a single audio frame from the server's audio socket to the
-        # client's audio socket, returning the byte data read
-    def read_frame(self):
-        if not isinstance(self.aud_s, socket.socket):
-            print("Error: client socket not initialized")
-            return b""
-        
+    # receive_audio()
+    # network thread: reads the server's audio stream into the jitter
+    # buffer, decoding frames of compressed formats back to PCM, until
+    # the connection drops
+    def receive_audio(self):
         try:
-            data = self.aud_s.recv(pack.AUDIO_PACK) # make list
+            if self.audio_format == ac.FORMAT_PCM:
+                while True:
+                    num = self.jitter.recv_into(self.aud_s)
+                    if num == 0:
+                        break
+                    elif num is None:   # buffer full: let the player catch up
+                        time.sleep(pack.SEND_DELAY)
+            else:
+                while True:
+                    header = pack.recv_exactly(self.aud_s, ac.FRAME_LEN.size)
+                    (payload_len,) = ac.FRAME_LEN.unpack(header)
+                    if payload_len == 0:    # FLUSH: we switched channels
+                        self.jitter.flush()
+                        continue
+                    payload = pack.recv_exactly(self.aud_s, payload_len)
+                    data = ac.decode(payload, self.audio_format, self.channels)
+                    while not self.jitter.add(data):
+                        time.sleep(pack.SEND_DELAY)
         except Exception as e:
             print(f"Read error: {str(e)}.\n")
-            STATE = -1
-            return b"" # client connection may have dropped out
-
-        len_data = len(list(data))
-        if len_data == 0: # no data recieved, return buffer of zeros
-            return b"\0" * pack.AUDIO_PACK
-        
-        return data
+        self.jitter.close()
 
 #
 # MAIN: get cmd-line arguments and run client
 #
 def main():
-    if len(sys.argv) != 3:
-        print(f"Usage: python {sys.argv[0]} <server address> <server port>")
+    usage = (f"Usage: python {sys.argv[0]} <server address> <server port> "
+             f"[{'|'.join(ac.FORMATS)}] [{'|'.join(map(str, Resample.RATES))}] [mono|stereo]")
+    if len(sys.argv) < 3:
+        print(usage)
         exit(1)
 
-    host_addr = sys.argv[1]
-    host_port = sys.argv[2]
+    audio_format = ac.FORMAT_PCM
+    rate = pack.SAMPLE_RATE
+    channels = pack.CHANNELS
+    # optional args, in any order: audio format, sample rate, mono|stereo
+    for arg in sys.argv[3:]:
+        if arg in ac.FORMATS:
+            audio_format = arg
+        elif arg in ("mono", "stereo"):
+            channels = 1 if arg == "mono" else 2
+        elif arg.isdigit() and int(arg) in Resample.RATES:
+            rate = int(arg)
+        else:
+            print(usage)
+            exit(1)
 
-    client = Client(host_addr, int(host_port))
+    client = Client(sys.argv[1], int(sys.argv[2]), audio_format, rate, channels)
     client.run_client()
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+#
+# DSP.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Ingest-time audio processing, so the live loop never touches samples.
+# When a song is packed into the SongStore, its whole PCM array is measured
+# and processed with NumPy, a chunk at a time so memory stays bounded:
+# leading and trailing silence are trimmed, a gain levels its loudness to
+# TARGET_LOUDNESS, and a faded-in copy of its first CROSSFADE_SECONDS
+# (its head) and a faded-out copy of its last (its tail) are stored next
+# to it. At a song boundary a Channel only sums the finished song's tail
+# with the next song's head, once per song, instead of fading every frame.
+# Loudness is BS.1770-style gated mean square over 400 ms blocks, without
+# the K-weighting filter. Only 16-bit PCM is processed.
+#
+
+import numpy as np
+from collections import namedtuple
+
+TARGET_LOUDNESS = -16.0     # dBFS songs are levelled to
+MAX_GAIN = 12.0             # dB a quiet song may be boosted, at most
+PEAK_CEILING = -1.0         # dBFS; gain never pushes a peak past this
+SILENCE = -50.0             # dBFS; ends whose peaks stay below are trimmed
+MIN_GAIN = 0.1              # dB; smaller gains aren't worth applying
+WINDOW_SECONDS = 0.01       # resolution of silence trimming
+BLOCK_WINDOWS = 40          # windows per loudness block (400 ms)
+ABSOLUTE_GATE = -70.0       # dBFS; quieter blocks don't count toward loudness
+RELATIVE_GATE = -10.0       # dB below the gated loudness; quieter blocks don't count
+CROSSFADE_SECONDS = 1.5
+CROSSFADE_MIN = 4           # songs shorter than this many crossfades get none
+CHUNK_SECONDS = 10          # audio processed at a time
+FULL_SCALE = 32768.0
+PCM_MIN, PCM_MAX = -32768, 32767
+
+# what process() did to a song: gain in dB; lead (samples trimmed from
+# the start), length (samples kept), head and tail (samples in each)
+Processed = namedtuple("Processed", ["gain", "lead", "length", "head", "tail"])
+
+
+# supports()
+# True if songs in the wav.WavFormat fmt can be processed
+def supports(fmt):
+    return fmt.bits == 16 and fmt.block_align == 2 * fmt.channels
+
+
+# samples()
+# views a buffer of 16-bit PCM as a (samples, channels) array, no copy
+def samples(buffer, channels):
+    return np.frombuffer(buffer, np.int16).reshape(-1, channels)
+
+
+# db()
+# a power ratio in decibels; silence comes out very negative, not -inf
+def db(power):
+    return 10 * np.log10(np.maximum(power, 1e-20))
+
+
+# window_levels()
+# mean square and peak of every whole window of window samples
+def window_levels(pcm, window, chunk):
+    num = len(pcm) // window
+    mean_sq = np.empty(num)
+    peak = np.empty(num)
+    per_chunk = max(1, chunk // window)
+    for first in range(0, num, per_chunk):
+        last = min(num, first + per_chunk)
+        block = pcm[first * window : last * window].reshape(last - first, -1)
+        block = block.astype(np.float32)
+        mean_sq[first:last] = np.mean(np.square(block), axis=1, dtype=np.float64)
+        peak[first:last] = np.max(np.abs(block), axis=1)
+    return mean_sq, peak
+
+
+# trim_bounds()
+# first sample and end of the audible part of a song: whole windows at
+# either end whose peaks are below SILENCE are trimmed. a silent song is
+# kept whole
+def trim_bounds(peak, window, num_samples):
+    loud = np.flatnonzero(db(np.square(peak / FULL_SCALE)) > SILENCE)
+    if len(loud) == 0:
+        return 0, num_samples
+    end = num_samples if loud[-1] == len(peak) - 1 else (loud[-1] + 1) * window
+    return int(loud[0]) * window, int(end)
+
+
+# loudness()
+# gated loudness in dBFS of a song's window mean squares, or None if the
+# song is silent
+def loudness(mean_sq):
+    if len(mean_sq) == 0:
+        return None
+    num = max(1, len(mean_sq) // BLOCK_WINDOWS)
+    blocks = np.array([chunk.mean() for chunk in np.array_split(mean_sq, num)])
+    blocks = blocks[db(blocks / FULL_SCALE ** 2) > ABSOLUTE_GATE]
+    if len(blocks) == 0:
+        return None
+    gate = db(blocks.mean() / FULL_SCALE ** 2) + RELATIVE_GATE
+    blocks = blocks[db(blocks / FULL_SCALE ** 2) > gate]
+    return float(db(blocks.mean() / FULL_SCALE ** 2))
+
+
+# pick_gain()
+# dB of gain that brings level (dBFS) to TARGET_LOUDNESS, within MAX_GAIN
+# and without pushing peak (dBFS) past PEAK_CEILING
+def pick_gain(level, peak):
+    if level is None:
+        return 0.0
+    gain = min(TARGET_LOUDNESS - level, MAX_GAIN, PEAK_CEILING - peak)
+    return 0.0 if abs(gain) < MIN_GAIN else gain
+
+
+# apply_gain()
+# returns pcm scaled by a linear gain, as 16-bit samples
+def apply_gain(pcm, gain):
+    if gain == 1.0:
+        return np.ascontiguousarray(pcm)
+    out = pcm.astype(np.float32)
+    out *= gain
+    np.clip(out, PCM_MIN, PCM_MAX, out=out)
+    return out.astype(np.int16)
+
+
+# fade()
+# returns pcm faded in (or out) over its whole length, along an
+# equal-power curve, so a faded-out tail and a faded-in head sum to
+# about the same loudness throughout a crossfade
+def fade(pcm, fade_in):
+    t = (np.arange(len(pcm)) + 0.5) / len(pcm) * (np.pi / 2)
+    curve = np.sin(t) if fade_in else np.cos(t)
+    return (pcm * curve[:, None].astype(np.float32)).astype(np.int16)
+
+
+# process()
+# trims, levels and prepares crossfades for a song's PCM, a
+# (samples, channels) int16 array (e.g. a memmap of its WAV), at
+# sample_rate. write() is called with the processed song, then its head
+# and tail, as arrays of 16-bit PCM
+# returns what was done as Processed
+def process(pcm, sample_rate, write):
+    window = max(1, int(sample_rate * WINDOW_SECONDS))
+    chunk = max(window, int(sample_rate * CHUNK_SECONDS))
+    mean_sq, peak = window_levels(pcm, window, chunk)
+
+    start, end = trim_bounds(peak, window, len(pcm))
+    first, last = start // window, -(-end // window)
+    top = peak[first:last].max() if last > first else 0.0
+    gain_db = pick_gain(loudness(mean_sq[first:last]), float(db((top / FULL_SCALE) ** 2)))
+    gain = 10 ** (gain_db / 20)
+
+    for pos in range(start, end, chunk):
+        write(apply_gain(pcm[pos : min(end, pos + chunk)], gain))
+
+    crossfade = int(sample_rate * CROSSFADE_SECONDS)
+    if end - start < CROSSFADE_MIN * crossfade:
+        crossfade = 0
+    else:
+        write(fade(apply_gain(pcm[start : start + crossfade], gain), True))
+        write(fade(apply_gain(pcm[end - crossfade : end], gain), False))
+    return Processed(round(gain_db, 2), start, end - start, crossfade, crossfade)
+
+
+# crossfade()
+# mixes a song's faded-out tail with the next song's faded-in head (both
+# 16-bit PCM buffers in the same format); returns the mix as bytes, as
+# long as the tail, and the number of bytes of head it used
+def crossfade(tail, head):
+    mix = np.frombuffer(tail, np.int16).astype(np.int32)
+    overlap = min(len(tail), len(head)) // 2
+    mix[:overlap] += np.frombuffer(head, np.int16, count=overlap)
+    np.clip(mix, PCM_MIN, PCM_MAX, out=mix)
+    return mix.astype(np.int16).tobytes(), overlap * 2
@@ -0,0 +1,239 @@
+#
+# FAKESOUNDCLOUD.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Local HTTP stand-in for the SoundCloud endpoints SongFetcher uses, so
+# fetching can be benchmarked and exercised offline:
+#   /                               page whose last script holds the client_id
+#   /assets/app.js                  ...the script, with ,client_id:"..."
+#   /search/tracks?q=&limit=        {"collection": [track, ...]}
+#   /media/<track>/stream/hls       transcoding url: {"url": playlist url}
+#   /playlist/<track>.m3u8          HLS playlist of the track's segments
+#   /segment/<track>/<n>.mp3        one segment
+# With audio on, a track's segments are the pieces of a real MP3 fixture,
+# generated once per track by ffmpeg (two sine tones, a different pair per
+# track, so tracks don't dedupe in the SongCache); otherwise they are
+# deterministic filler. Every request can be slowed by a fixed latency, a
+# per-connection cost (standing in for the TCP + TLS handshake), and a
+# bandwidth cap, and fail at a configurable rate with a 500 or a 401;
+# requests made with a stale client_id always get a 401.
+#
+
+#!/usr/bin/python3
+
+import sys
+import json
+import time
+import zlib
+import random
+import threading
+import subprocess
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEGMENTS = 30           # HLS segments per track (~6 s each in a real track)
+SEGMENT_LEN = 64 * 1024 # bytes per filler segment
+LATENCY = 0.02          # seconds added to every request
+CONNECT_COST = 0.05     # seconds added to every new connection
+TRACK_SECONDS = 30      # length of each generated audio fixture
+BITRATE = "128k"        # MP3 bitrate of the fixtures
+WRITE_CHUNK = 16 * 1024 # bytes written at a time under a bandwidth cap
+CLIENT_ID = "fakeclientid0000"
+
+
+# class FakeHandler
+# serves the endpoints listed above
+#
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep connections alive
+
+    def setup(self):
+        super().setup()
+        time.sleep(self.server.connect_cost)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        server.count("requests")
+
+        # injected failures, then authentication, like the real API; the
+        # site pages the client_id is scraped from always load
+        site = url.path == "/" or parts[0] == "assets"
+        if not site and random.random() < server.error_rate:
+            server.count("errors")
+            return self.send_body(b"internal error", "text/plain", 500)
+        client_id = query.get("client_id", [None])[0]
+        if not site and (random.random() < server.unauthorized
+                         or client_id not in (None, server.client_id)):
+            server.count("unauthorized")
+            return self.send_body(b"unauthorized", "text/plain", 401)
+
+        if url.path == "/":
+            page = f'<html><script crossorigin src="{server.base}/assets/app.js"></script></html>'
+            self.send_body(page.encode(), "text/html")
+        elif parts == ["assets", "app.js"]:
+            script = f'window.app={{env:"fake",client_id:"{server.client_id}",ver:1}};'
+            self.send_body(script.encode(), "application/javascript")
+        elif parts == ["search", "tracks"]:
+            q = query.get("q", [""])[0]
+            limit = int(query.get("limit", ["10"])[0])
+            body = {"collection": [server.track(q, i) for i in range(limit)]}
+            self.send_body(json.dumps(body).encode(), "application/json")
+        elif len(parts) == 4 and parts[0] == "media" and parts[2:] == ["stream", "hls"]:
+            body = {"url": f"{server.base}/playlist/{parts[1]}.m3u8"}
+            self.send_body(json.dumps(body).encode(), "application/json")
+        elif len(parts) == 2 and parts[0] == "playlist":
+            track = parts[1].split(".")[0]
+            self.send_body(self.playlist(track), "application/vnd.apple.mpegurl")
+        elif len(parts) == 3 and parts[0] == "segment":
+            self.send_body(server.segment(parts[1], int(parts[2].split(".")[0])), "audio/mpeg")
+        else:
+            self.send_body(b"not found", "text/plain", 404)
+
+    # playlist()
+    # returns an HLS playlist of the track's segment urls
+    def playlist(self, track):
+        lines = ["#EXTM3U"]
+        for n in range(self.server.segments):
+            lines.append(f"#EXTINF:{TRACK_SECONDS / self.server.segments:.1f},")
+            lines.append(f"{self.server.base}/segment/{track}/{n}.mp3")
+        lines.append("#EXT-X-ENDLIST")
+        return ("\n".join(lines) + "\n").encode()
+
+    # send_body()
+    # writes a response, at no more than the server's bandwidth cap
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.server.bandwidth <= 0:
+            self.wfile.write(body)
+            return
+        for pos in range(0, len(body), WRITE_CHUNK):
+            chunk = body[pos : pos + WRITE_CHUNK]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / self.server.bandwidth)
+
+
+# class FakeServer
+# the stand-in's settings, its fixtures, and counts of what it served
+#
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, latency=LATENCY, connect_cost=CONNECT_COST,
+                 segments=SEGMENTS, audio=False, bandwidth=0, error_rate=0.0,
+                 unauthorized=0.0, client_id=CLIENT_ID):
+        super().__init__(("127.0.0.1", port), FakeHandler)
+        host, port = self.server_address
+        self.base = f"http://{host}:{port}"
+        self.latency = latency
+        self.connect_cost = connect_cost
+        self.segments = segments
+        self.audio = audio              # serve real MP3 fixtures
+        self.bandwidth = bandwidth      # bytes/sec per response, 0 for no cap
+        self.error_rate = error_rate    # fraction of requests that get a 500
+        self.unauthorized = unauthorized    # ...that get a 401
+        self.client_id = client_id
+
+        self.fixtures = {}      # track id -> MP3 bytes
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "errors": 0, "unauthorized": 0}
+
+    # count()
+    # adds one to a served-request counter
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    # track()
+    # the i-th search result for q, shaped like a SoundCloud track
+    def track(self, q, i):
+        id = zlib.crc32(q.encode()) % 100000 * 1000 + i
+        return {
+            "id": id, "title": f"{q} #{i}", "kind": "track",
+            "duration": TRACK_SECONDS * 1000,
+            "media": {"transcodings": [{
+                "url": f"{self.base}/media/{id}/stream/hls",
+                "preset": "mp3_0_0",
+                "format": {"protocol": "hls", "mime_type": "audio/mpeg"},
+            }]},
+        }
+
+    # fixture()
+    # returns a track's MP3 fixture, generating it on first use
+    def fixture(self, track):
+        with self.lock:
+            data = self.fixtures.get(track)
+        if data is None:
+            data = generate_mp3(zlib.crc32(str(track).encode()))
+            with self.lock:
+                self.fixtures[track] = data
+        return data
+
+    # segment()
+    # returns the n-th of a track's segments
+    def segment(self, track, n):
+        if not self.audio:
+            return segment_bytes(track, n)
+        data = self.fixture(track)
+        size = -(-len(data) // self.segments)
+        return data[n * size : (n + 1) * size]
+
+
+# generate_mp3()
+# encodes TRACK_SECONDS of a stereo pair of sine tones, picked by seed, to
+# MP3 with ffmpeg
+def generate_mp3(seed, seconds=TRACK_SECONDS):
+    left = 110 + seed % 440
+    right = left * 3 // 2
+    result = subprocess.run(
+        ["ffmpeg", "-loglevel", "error",
+         "-f", "lavfi", "-i", f"sine=frequency={left}:duration={seconds}",
+         "-f", "lavfi", "-i", f"sine=frequency={right}:duration={seconds}",
+         "-filter_complex", "amerge=inputs=2", "-ar", "44100",
+         "-b:a", BITRATE, "-f", "mp3", "pipe:1"],
+        stdout=subprocess.PIPE, check=True)
+    return result.stdout
+
+
+# segment_bytes()
+# deterministic filler content for one segment
+def segment_bytes(track, n):
+    return (f"{track}:{n}:".encode() * SEGMENT_LEN)[:SEGMENT_LEN]
+
+
+# start()
+# starts a stand-in server on a background thread, returning it; the
+# server's base url is server.base. see FakeServer for the options
+def start(port=0, **options):
+    server = FakeServer(port, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+#
+# MAIN: run the stand-in on a given port until interrupted
+#
+def main():
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != "--audio"):
+        print("Usage: python3 FakeSoundCloud.py <port> [--audio]")
+        quit()
+
+    server = start(int(sys.argv[1]), audio=len(sys.argv) == 3)
+    print(f"Fake SoundCloud listening on {server.base}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
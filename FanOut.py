@@ -0,0 +1,313 @@
+#
+# FANOUT.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Encode-once fan-out of a channel's audio frames. Each frame is read once,
+# encoded once per AudioCodec format its listeners use, and shared as a
+# read-only memoryview by every listener's Outbox; the
+# outboxes write to nonblocking audio sockets and keep track of partially
+# written frames, so one client with a full send buffer only falls behind
+# itself. A slow-consumer policy decides what happens to a client that
+# falls more than max_behind_ms behind live.
+#
+# Each channel keeps its last RING_SECONDS of frames in a FrameRing, with
+# the encodings broadcast() made of them. A listener that joins a channel
+# is sent the ring at once, so its client's playback buffer fills right
+# away instead of at live pace. The ring is resampled for the listener by
+# the same resampler that carries on with its live frames, so the burst
+# runs into the live stream without a click. A listener switching channels first has
+# the old channel's backlog dropped and, in the framed formats, an
+# AudioCodec.FLUSH marker queued, telling its client to drop the old
+# channel's audio it has buffered. The server also sends every switching
+# client an S_FLUSH control packet with the byte offset of its audio
+# stream where the new channel starts, which is how a pcm16 client, whose
+# raw stream has no room for a marker, knows what to drop.
+#
+
+import time
+import socket
+from collections import deque
+
+import Packet as pack
+import AudioCodec as ac
+import Resample
+from Metrics import get_metrics
+
+# slow-consumer policies
+POLICY_DROP = "drop"    # drop new frames until the client drains its backlog
+POLICY_SKIP = "skip"    # discard the client's backlog and jump to live
+POLICY_DISCONNECT = "disconnect"    # disconnect the client
+SLOW_POLICIES = [POLICY_DROP, POLICY_SKIP, POLICY_DISCONNECT]
+
+MAX_BEHIND_MS = 500     # backlog a listener may build before the policy applies
+SOURCE = (pack.SAMPLE_RATE, pack.CHANNELS)  # (rate, channels) of frames, by default
+RING_SECONDS = 0.25     # recent audio a channel keeps to send listeners who join
+FLUSH_VIEW = memoryview(ac.FLUSH).toreadonly()
+
+
+# class Outbox
+# frames waiting to be written to one listener's audio socket; the first
+# frame may already be partially written, up to offset
+#
+class Outbox:
+    __slots__ = ("sock", "format", "variant", "frames", "offset", "queued", "dropped",
+                 "sent", "frames_sent", "partials", "join_at", "join_mark", "switching")
+
+    def __init__(self, sock, format=ac.FORMAT_PCM, variant=None):
+        self.sock = sock
+        self.format = format    # AudioCodec format frames are sent in
+        self.variant = variant  # Resample variant (rate, channels), or None
+        self.frames = deque()   # memoryviews of shared frames
+        self.offset = 0         # bytes of frames[0] already written
+        self.queued = 0         # bytes still to write
+        self.dropped = 0        # frames dropped by the slow-consumer policy
+        self.sent = 0           # bytes ever written
+        self.frames_sent = 0    # frames ever fully written
+        self.partials = 0       # writes the socket only partly accepted
+        self.join_at = None     # time of the last channel join, until its first frame is out
+        self.join_mark = 0      # frames_sent just before that first frame is out
+        self.switching = False  # that join was a move from another channel
+
+    # push()
+    # queues a shared frame for this listener
+    def push(self, frame):
+        self.frames.append(frame)
+        self.queued += len(frame)
+
+    # flush()
+    # writes as much of the backlog as the socket accepts without blocking
+    # returns the number of bytes written; raises OSError if the peer is gone
+    def flush(self):
+        sent = 0
+        while self.frames:
+            frame = self.frames[0]
+            try:
+                num_sent = self.sock.send(frame[self.offset:])
+            except BlockingIOError:
+                break
+            sent += num_sent
+            self.offset += num_sent
+            if self.offset < len(frame):
+                self.partials += 1
+                break   # socket buffer is full
+            self.frames.popleft()
+            self.offset = 0
+            self.frames_sent += 1
+
+        self.queued -= sent
+        self.sent += sent
+        return sent
+
+    # skip_to_live()
+    # discards the backlog, except a frame that is partially written (which
+    # must be finished to keep the stream sample- and frame-aligned)
+    # returns the number of frames discarded
+    def skip_to_live(self):
+        keep = 1 if self.offset > 0 else 0
+        skipped = len(self.frames) - keep
+        while len(self.frames) > keep:
+            frame = self.frames.pop()
+            self.queued -= len(frame)
+        return max(0, skipped)
+
+
+# class FrameRing
+# a channel's most recent frames: each one's PCM, the (rate, channels) it
+# is in, its PCM converted by variant and its encodings by (variant,
+# format), shared with broadcast()
+#
+class FrameRing:
+    frames: deque   # (pcm, source, converted, encodings), oldest first
+
+    def __init__(self, seconds=RING_SECONDS, frame_time=pack.SEND_DELAY):
+        self.frames = deque(maxlen=max(1, int(seconds / frame_time)))
+
+    # add()
+    # keeps a frame just broadcast; its PCM is copied, since it may be a
+    # view of a store segment
+    def add(self, pcm, source, converted, encoded):
+        self.frames.append((bytes(pcm), source, converted, encoded))
+
+    # clear()
+    # forgets every frame, once they no longer lead up to the live stream
+    def clear(self):
+        self.frames.clear()
+
+    # burst()
+    # up to the last num frames, as shared views in a listener's variant
+    # and format, oldest first. encodings broadcast() didn't make are made
+    # now, and kept for the next listener who joins. variants is the
+    # channel's Variants: if it is already converting to variant, only the
+    # frames it converted are sent; if not, the frames are resampled here
+    # and the resampler handed to it, to carry on with the live frames
+    def burst(self, variant, format, num, variants=None):
+        key = (variant, format)
+        frames = list(self.frames)[-num:]
+        live = variants is not None and variant in variants.resamplers
+        if live:
+            # only the frames since the channel's resampler last started
+            start = len(frames)
+            while start > 0 and variant in frames[start - 1][2]:
+                start -= 1
+            frames = frames[start:]
+
+        resampler = None
+        views = []
+        for pcm, source, converted, encoded in frames:
+            view = encoded.get(key)
+            if variant is not None and variant != source and not live:
+                if resampler is None or resampler.source != source:
+                    resampler = Resample.Resampler(source, variant)
+                converted.setdefault(variant, resampler.convert(pcm))
+            if view is None:
+                if variant is not None and variant != source:
+                    pcm = converted[variant]
+                channels = source[1] if variant is None else variant[1]
+                view = memoryview(ac.encode(pcm, format, channels)).toreadonly()
+                encoded[key] = view
+            views.append(view)
+
+        if resampler is not None and variants is not None and frames:
+            variants.resamplers[variant] = resampler
+        return views
+
+
+# class FanOut
+# one Outbox per listener's audio socket, and the policy for listeners
+# that fall behind
+#
+class FanOut:
+    outboxes: dict      # audio socket -> Outbox
+    policy: str         # one of SLOW_POLICIES
+    max_behind_ms: int
+    bytes_sent: int     # audio bytes ever written, to every listener
+
+    def __init__(self, policy=POLICY_DROP, max_behind_ms=MAX_BEHIND_MS):
+        if policy not in SLOW_POLICIES:
+            raise ValueError(f"unknown slow-consumer policy {policy}")
+        self.outboxes = {}
+        self.policy = policy
+        self.max_behind_ms = max_behind_ms
+        self.bytes_sent = 0
+        self.first_audio = get_metrics().histogram("first_audio_seconds")
+        self.switch_time = get_metrics().histogram("channel_switch_seconds")
+
+    # add()
+    # starts an outbox for a listener that takes audio in the given
+    # AudioCodec format and Resample variant, switching its audio socket
+    # to nonblocking writes. sent is how many bytes its stream has carried
+    # already (from its last shard worker), so S_FLUSH offsets line up
+    def add(self, aud_sock: socket.socket, format=ac.FORMAT_PCM, variant=None, sent=0):
+        aud_sock.setblocking(False)
+        outbox = self.outboxes[aud_sock] = Outbox(aud_sock, format, variant)
+        outbox.sent = sent
+
+    # remove()
+    # forgets a listener's outbox and any frames still queued for it
+    def remove(self, aud_sock):
+        self.outboxes.pop(aud_sock, None)
+
+    # join()
+    # starts a listener's stream on the channel whose FrameRing is ring. if
+    # switch, it's moving from another channel: its backlog is dropped and
+    # a FLUSH marker queued (PCM's raw stream has no room for one). partial
+    # is the rest of a frame its last shard worker started writing, which
+    # must go out first. the ring's frames (resampled through the channel's
+    # Variants, variants) are then queued and written at once; the time
+    # until the first is out is its time to first audio. the old channel's
+    # backlog isn't counted as dropped: the listener asked to leave it
+    # returns the byte offset of the listener's audio stream where the
+    # ring's frames start, for S_FLUSH; None if the listener is gone
+    def join(self, aud_sock, ring, switch=False, partial=b"", variants=None):
+        outbox = self.outboxes.get(aud_sock)
+        if outbox is None:
+            return None
+        outbox.join_at = time.monotonic()
+        outbox.switching = switch
+        if switch:
+            outbox.skip_to_live()
+        if len(partial) > 0:
+            outbox.push(memoryview(partial))
+        if switch and outbox.format != ac.FORMAT_PCM:
+            outbox.push(FLUSH_VIEW)
+        outbox.join_mark = outbox.frames_sent + len(outbox.frames)
+        start = outbox.sent + outbox.queued
+
+        # at most half the backlog the slow-consumer policy allows
+        num = int(self.max_behind_ms / 1000 / pack.SEND_DELAY / 2)
+        for view in ring.burst(outbox.variant, outbox.format, num, variants):
+            outbox.push(view)
+        try:
+            self.bytes_sent += outbox.flush()
+        except OSError:
+            return None     # broadcast() will find it gone
+        self.joined(outbox)
+        return start
+
+    # joined()
+    # observes a listener's time to first audio, once the first frame
+    # queued after it joined is out
+    def joined(self, outbox):
+        if outbox.join_at is not None and outbox.frames_sent > outbox.join_mark:
+            elapsed = time.monotonic() - outbox.join_at
+            self.first_audio.observe(elapsed)
+            if outbox.switching:
+                self.switch_time.observe(elapsed)
+            outbox.join_at = None
+
+    # broadcast()
+    # queues one frame of PCM for every listener in clients (ClientSessions),
+    # converting it once per Resample variant and encoding it once per
+    # format they use, and flushes their sockets. the frame is in source
+    # format (rate, channels), and variants is the channel's Variants.
+    # frame_time is the seconds of audio in one frame, used to measure how
+    # far behind each listener is
+    # returns the clients that must be disconnected
+    def broadcast(self, frame, clients, frame_time, variants=None, source=SOURCE, ring=None):
+        converted = {}  # variant -> the frame's PCM in that variant
+        encoded = {}    # (variant, format) -> shared view of the frame in that format
+        max_frames = self.max_behind_ms / 1000 / frame_time
+
+        gone = []
+        for client in clients:
+            outbox = self.outboxes.get(client.aud)
+            if outbox is None:
+                continue
+            key = (outbox.variant, outbox.format)
+            view = encoded.get(key)
+            if view is None:
+                pcm = converted.get(outbox.variant)
+                if pcm is None:
+                    pcm = frame
+                    if variants is not None:
+                        pcm = variants.convert(frame, outbox.variant, source)
+                    converted[outbox.variant] = pcm
+                channels = source[1] if outbox.variant is None else outbox.variant[1]
+                view = memoryview(ac.encode(pcm, outbox.format, channels)).toreadonly()
+                encoded[key] = view
+
+            if len(outbox.frames) >= max_frames:
+                if self.policy == POLICY_DISCONNECT:
+                    gone.append(client)
+                    continue
+                elif self.policy == POLICY_SKIP:
+                    outbox.dropped += outbox.skip_to_live()
+                    outbox.push(view)
+                else:
+                    outbox.dropped += 1
+            else:
+                outbox.push(view)
+
+            try:
+                self.bytes_sent += outbox.flush()
+            except OSError:
+                gone.append(client)
+                continue
+            self.joined(outbox)
+
+        if variants is not None:
+            variants.keep(converted)
+        if ring is not None:
+            resampled = {v: pcm for v, pcm in converted.items() if v is not None and v != source}
+            ring.add(frame, source, resampled, encoded)
+        return gone
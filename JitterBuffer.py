@@ -0,0 +1,161 @@
+#
+# JITTERBUFFER.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Adaptive jitter buffer for the Client's audio. The network thread adds
+# PCM to a CircBuff as it arrives and times each arrival; the audio
+# callback only copies out of it, and never waits on the network. Playback
+# starts (and restarts after an underrun) once the buffer holds its target,
+# and the target follows the measured arrival jitter: the difference
+# between how long each read took to arrive and how much audio the read
+# before it held (the transit variation of RFC 3550). The largest recent
+# variation sets the target, decaying over JITTER_DECAY seconds, so one
+# stall keeps a deeper buffer for a while after it. A buffer that runs far
+# over its target is trimmed back to it, so latency can't grow unbounded.
+# On a channel switch the server sends the new channel's recent audio in a
+# burst; flush() drops everything buffered before it, and playback starts
+# over from the burst, trimmed to the target first. Framed formats flush
+# at the marker in their stream; a pcm16 stream is flushed up to the byte
+# offset the server sends in S_FLUSH, which may arrive before or after the
+# audio it points at.
+#
+
+import time
+
+import Packet as pack
+from CircBuff import CircBuff
+
+RING_SECONDS = 2.0          # audio the ring can hold
+MIN_TARGET = 0.04           # seconds buffered before playback, at least
+MAX_TARGET = 1.0            # ...and at most
+JITTER_MULT = 1.5           # target = MIN_TARGET + JITTER_MULT * jitter
+JITTER_DECAY = 10.0         # seconds for the jitter estimate to halve
+BLOCK_ALIGN = pack.CHANNELS * pack.SAMPLE_WIDTH
+
+
+# class JitterBuffer
+# CircBuff of PCM plus the playout policy around it. add() / recv_into()
+# are called by one producer thread, fill() by one consumer
+#
+class JitterBuffer:
+    ring: CircBuff
+    playing: bool       # False while (re)filling up to target
+    closed: bool        # True once the producer has no more audio
+    jitter: float       # largest recent arrival jitter, seconds, decaying
+    underruns: int      # times playback ran dry
+    overruns: int       # times the buffer ran too far over target and was trimmed
+    flush_at: int       # stream offset of the last flush(); the consumer drops up to it
+
+    def __init__(self, byte_rate=pack.BYTE_RATE, seconds=RING_SECONDS):
+        self.byte_rate = byte_rate
+        self.ring = CircBuff(align(int(byte_rate * seconds)))
+        self.playing = False
+        self.closed = False
+
+        self.jitter = 0.0
+        self.last_arrival = None
+        self.last_len = 0
+
+        self.underruns = 0
+        self.overruns = 0
+        self.trimmed = 0    # bytes trimmed by overruns
+        self.flush_at = 0
+        self.flushes = 0
+
+    # arrived()
+    # producer: records that num bytes of audio just arrived, updating the
+    # jitter estimate
+    def arrived(self, num, now=None):
+        now = time.monotonic() if now is None else now
+        if self.last_arrival is not None:
+            elapsed = now - self.last_arrival
+            delta = elapsed - self.last_len / self.byte_rate
+            self.jitter = max(abs(delta), self.jitter * 0.5 ** (elapsed / JITTER_DECAY))
+        self.last_arrival = now
+        self.last_len = num
+
+    # recv_into()
+    # producer: receives PCM from sock straight into the ring
+    # returns the number of bytes received: 0 once the peer hangs up, or
+    # None if the ring is full
+    def recv_into(self, sock):
+        if self.ring.space() == 0:
+            return None
+        num = self.ring.recv_into(sock)
+        self.arrived(num)
+        return num
+
+    # add()
+    # producer: appends decoded PCM; returns False if the ring is full
+    def add(self, data):
+        if not self.ring.append(data):
+            return False
+        self.arrived(len(data))
+        return True
+
+    # flush()
+    # drops the audio received so far (the old channel's, on a switch), or
+    # up to byte offset at of the stream, received yet or not. only the
+    # consumer moves the ring's read counter, so it drops it in fill()
+    def flush(self, at=None):
+        self.flush_at = self.ring.written if at is None else at
+        self.flushes += 1
+
+    # target()
+    # bytes to buffer before playing, from the jitter estimate
+    def target(self):
+        seconds = min(MIN_TARGET + JITTER_MULT * self.jitter, MAX_TARGET)
+        return align(int(seconds * self.byte_rate))
+
+    # fill()
+    # consumer: fills out (an audio device buffer) with buffered PCM, or
+    # silence while buffering; returns False once the producer has closed
+    # and the buffer is drained
+    def fill(self, out):
+        if self.flush_at > self.ring.read:
+            self.ring.skip(self.flush_at - self.ring.read)
+            self.playing = False
+        buffered = self.ring.sublen()
+        target = self.target()
+
+        if self.closed and buffered == 0:
+            return False
+        if not self.playing:
+            if buffered >= target or self.closed:
+                self.playing = True
+        if self.playing and buffered > 2 * target + len(out):
+            # far over target: drop the oldest audio to get back to it
+            self.trimmed += self.ring.skip(align(buffered - target))
+            self.overruns += 1
+
+        num = 0
+        if self.playing:
+            num = self.ring.consume_into(out, align(min(len(out), self.ring.sublen())))
+            if num < len(out) and not self.closed:
+                self.underruns += 1
+                self.playing = False
+        out[num:] = bytes(len(out) - num)
+        return True
+
+    # close()
+    # producer: no more audio will arrive
+    def close(self):
+        self.closed = True
+
+    # stats()
+    # returns the buffer's state and counters
+    def stats(self):
+        return {
+            "buffered_ms": round(self.ring.sublen() / self.byte_rate * 1000),
+            "target_ms": round(self.target() / self.byte_rate * 1000),
+            "jitter_ms": round(self.jitter * 1000, 1),
+            "underruns": self.underruns, "overruns": self.overruns,
+            "trimmed_ms": round(self.trimmed / self.byte_rate * 1000),
+            "flushes": self.flushes,
+        }
+
+
+# align()
+# rounds num bytes down to whole sample frames
+def align(num):
+    return num - num % BLOCK_ALIGN
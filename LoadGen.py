@@ -0,0 +1,409 @@
+#
+# LOADGEN.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Headless load generator for the ( name ) server. Simulates many
+# protocol-correct clients with no audio device or terminal: each one runs
+# the S_INIT / C_INIT nonce handshake on its com and audio sockets, then
+# joins channels, chats, lists and requests on a randomized schedule while
+# reading its audio stream. Clients run as tasks on one asyncio loop per
+# process, spread over a few processes, so thousands fit on one machine.
+#
+# Prints (and optionally writes) a JSON summary to compare across builds:
+# join latency (connect to first audio byte), channel switch latency
+# (C_JOIN sent to the switch marker, in the framed formats), received
+# bitrate, arrival jitter of the audio stream, and disconnects.
+#
+#   python3 LoadGen.py <server address> <port> [--clients=N] [--procs=N]
+#       [--seconds=N] [--ramp=N] [--audio=ulaw|delta|pcm16] [--discard]
+#       [--join=S] [--chat=S] [--list=S] [--request=S] [--out=FILE]
+#
+
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import multiprocessing
+
+import Packet as pack
+import AudioCodec as ac
+
+CLIENTS = 100       # simulated clients, over every process
+SECONDS = 30        # how long each client stays connected
+RAMP = 5            # seconds over which clients connect
+HANDSHAKE_TIMEOUT = 10
+AUD_READ = 64 * 1024
+CHAT_LINES = ["hi", "this song slaps", "skip pls", "who picked this", "vibes"]
+
+# mean seconds between each scripted action, per client (0 turns it off)
+SCHEDULE = {"join": 10.0, "chat": 15.0, "list": 20.0, "request": 60.0}
+
+LOAD_FLAGS = ["clients", "procs", "seconds", "ramp", "audio", "discard", "out"] + list(SCHEDULE)
+
+
+# class SimClient
+# one simulated client: handshake, scripted actions, and audio stats
+#
+class SimClient:
+    def __init__(self, loop, host, port, name, audio, schedule, discard):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.name = name
+        self.nonce = name
+        self.audio = audio
+        self.schedule = schedule
+        self.discard = discard
+        self.com_s = None
+        self.aud_s = None
+        self.decoder = pack.PacketDecoder()
+        self.channels = []
+        self.channel = None     # channel last joined; the lobby's, at first
+        self.join_sent = None   # when the last C_JOIN was sent, until its switch shows up
+
+        self.result = {"connected": False, "disconnected": False, "error": None,
+                       "join_ms": None, "switch_ms": [], "bytes": 0, "audio_s": 0.0,
+                       "jitter_ms": 0.0, "max_jitter_ms": 0.0, "seconds": 0.0,
+                       "actions": {action: 0 for action in schedule}, "packets": 0}
+
+    # connect()
+    # opens a nonblocking socket to the server
+    async def connect(self):
+        this_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        this_sock.setblocking(False)
+        await self.loop.sock_connect(this_sock, (self.host, self.port))
+        return this_sock
+
+    # read_packet()
+    # reads the next control packet from this_sock through decoder
+    async def read_packet(self, this_sock, decoder):
+        while True:
+            packet = decoder.next_packet()
+            if packet is not None:
+                return packet
+            if decoder.closed:
+                raise ConnectionError("server closed the connection")
+            view = decoder.space()
+            try:
+                num = await self.loop.sock_recv_into(this_sock, view)
+            finally:
+                view.release()
+            decoder.received(num)
+
+    # send()
+    # writes one control packet on the com socket
+    async def send(self, type, data):
+        packet = pack.construct_packet(type, data, self.decoder.codec)
+        await self.loop.sock_sendall(self.com_s, packet)
+
+    # handshake()
+    # C_INIT on both sockets, negotiating a codec and audio format the way
+    # Client.setup_protocol does
+    async def handshake(self):
+        self.com_s = await self.connect()
+        type, data = await self.read_packet(self.com_s, self.decoder)
+        if type != pack.S_INIT:
+            raise ConnectionError(f"expected S_INIT, got {type}")
+        self.channels = data["c"]
+        self.channel = self.channels[0] if self.channels else None
+
+        options = {"codecs": pack.CODECS, "audio": [self.audio]}
+        await self.send(pack.C_INIT, ["com", self.nonce, self.name, options])
+        type, data = await self.read_packet(self.com_s, self.decoder)
+        if type != pack.S_YES:
+            raise ConnectionError(f"handshake refused: {data}")
+        self.decoder.codec = data["codec"]
+        self.audio = ac.pick([data.get("audio")])
+
+        # the audio socket gets its own S_INIT before any audio
+        self.aud_s = await self.connect()
+        aud_decoder = pack.PacketDecoder()
+        await self.read_packet(self.aud_s, aud_decoder)
+        packet = pack.construct_packet(pack.C_INIT, ["aud", self.nonce, self.name])
+        await self.loop.sock_sendall(self.aud_s, packet)
+        return aud_decoder.pending()
+
+    # read_control()
+    # counts the server's control packets, keeping the channel list fresh
+    async def read_control(self):
+        while True:
+            type, data = await self.read_packet(self.com_s, self.decoder)
+            self.result["packets"] += 1
+            if type == pack.S_LIST and isinstance(data, list):
+                self.channels = data
+
+    # read_audio()
+    # reads the audio stream until the server hangs up, counting bytes and,
+    # unless discarding, frames of audio. each read's arrival is compared
+    # with how much audio the read before it held, as in JitterBuffer
+    async def read_audio(self, started, leftover):
+        buf = bytearray(AUD_READ)
+        view = memoryview(buf)
+        have = len(leftover)
+        buf[:have] = leftover
+        last_arrival = None
+        last_audio = 0.0
+        jitter_sum = 0.0
+        reads = 0
+
+        while True:
+            num = await self.loop.sock_recv_into(self.aud_s, view[have:])
+            now = time.monotonic()
+            if num == 0:
+                raise ConnectionError("audio stream closed")
+            if self.result["join_ms"] is None:
+                self.result["join_ms"] = (now - started) * 1000
+            self.result["bytes"] += num
+            if self.discard:
+                continue
+
+            have += num
+            frames, used, switched = self.count_frames(view, have)
+            if switched and self.join_sent is not None:
+                self.result["switch_ms"].append((now - self.join_sent) * 1000)
+                self.join_sent = None
+            view[:have - used] = view[used:have]
+            have -= used
+            audio = frames * pack.SEND_DELAY
+            self.result["audio_s"] += audio
+
+            if last_arrival is not None and frames > 0:
+                jitter = abs((now - last_arrival) - last_audio)
+                jitter_sum += jitter
+                reads += 1
+                self.result["max_jitter_ms"] = max(self.result["max_jitter_ms"], jitter * 1000)
+                self.result["jitter_ms"] = jitter_sum / reads * 1000
+            if frames > 0:
+                last_arrival, last_audio = now, audio
+
+    # count_frames()
+    # counts the whole frames in view[:have]; returns (frames, bytes used,
+    # whether a FLUSH switch marker was among them)
+    def count_frames(self, view, have):
+        if self.audio == ac.FORMAT_PCM:
+            frames = have // pack.AUDIO_PACK
+            return frames, frames * pack.AUDIO_PACK, False
+        frames = 0
+        pos = 0
+        switched = False
+        header = ac.FRAME_LEN.size
+        while pos + header <= have:
+            (payload_len,) = ac.FRAME_LEN.unpack_from(view, pos)
+            if pos + header + payload_len > have:
+                break
+            pos += header + payload_len
+            if payload_len == 0:
+                switched = True
+            else:
+                frames += 1
+        return frames, pos, switched
+
+    # act()
+    # sends one scripted action
+    async def act(self, action):
+        if action == "join" and self.channels:
+            query = random.choice(self.channels)
+            if query != self.channel:   # rejoining sends no switch marker
+                self.channel = query
+                self.join_sent = time.monotonic()
+            await self.send(pack.C_JOIN, query)
+        elif action == "chat":
+            await self.send(pack.C_MSG, random.choice(CHAT_LINES))
+        elif action == "list":
+            await self.send(pack.C_LIST, "")
+        elif action == "request":
+            await self.send(pack.C_REQ, random.choice(request_queries()))
+        self.result["actions"][action] += 1
+
+    # script()
+    # runs every action on its own randomized (exponential) schedule
+    async def script(self, action, mean):
+        while True:
+            await asyncio.sleep(random.expovariate(1 / mean))
+            await self.act(action)
+
+    # run()
+    # connects, plays the script for seconds, then hangs up
+    async def run(self, seconds):
+        started = time.monotonic()
+        tasks = []
+        try:
+            leftover = await asyncio.wait_for(self.handshake(), HANDSHAKE_TIMEOUT)
+            self.result["connected"] = True
+            tasks = [self.loop.create_task(self.read_control()),
+                     self.loop.create_task(self.read_audio(started, leftover))]
+            tasks += [self.loop.create_task(self.script(action, mean))
+                      for action, mean in self.schedule.items() if mean > 0]
+            done, _ = await asyncio.wait(tasks, timeout=seconds,
+                                         return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                error = task.exception()
+                if error is not None:
+                    self.result["disconnected"] = True
+                    self.result["error"] = f"{type(error).__name__}: {error}"
+        except (OSError, ConnectionError, asyncio.TimeoutError, ValueError) as e:
+            self.result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for this_sock in (self.com_s, self.aud_s):
+                if this_sock is not None:
+                    this_sock.close()
+        self.result["seconds"] = time.monotonic() - started
+        return self.result
+
+
+REQUEST_QUERIES = None
+
+# request_queries()
+# queries for scripted C_REQs: the server's seed file, if it's here
+def request_queries():
+    global REQUEST_QUERIES
+    if REQUEST_QUERIES is None:
+        REQUEST_QUERIES = ["lofi", "jazz", "city pop"]
+        if os.path.exists("seeds.txt"):
+            with open("seeds.txt") as f:
+                REQUEST_QUERIES = [line for line in f.read().splitlines() if line] or REQUEST_QUERIES
+    return REQUEST_QUERIES
+
+
+# run_process()
+# runs one process's share of the clients, ramping their connects up over
+# ramp seconds; returns every client's result
+def run_process(proc, num_clients, host, port, options):
+    raise_fd_limit()
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        tag = f"{random.randrange(36 ** 4):04x}"
+        clients = [SimClient(loop, host, port, f"lg{proc}-{i}-{tag}", options["audio"],
+                             options["schedule"], options["discard"])
+                   for i in range(num_clients)]
+
+        async def start(client, delay):
+            await asyncio.sleep(delay)
+            return await client.run(options["seconds"])
+
+        ramp = options["ramp"]
+        return await asyncio.gather(*[start(c, ramp * i / max(num_clients, 1))
+                                      for i, c in enumerate(clients)])
+
+    return asyncio.run(main())
+
+
+# raise_fd_limit()
+# lets a process open as many sockets as the hard limit allows
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+# percentiles()
+# summarizes a list of numbers
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"min": round(values[0], 2), "p50": round(pick(0.5), 2),
+            "p90": round(pick(0.9), 2), "p99": round(pick(0.99), 2),
+            "max": round(values[-1], 2), "mean": round(sum(values) / len(values), 2)}
+
+
+# summarize()
+# folds every client's result into the run's summary
+def summarize(results, options, elapsed):
+    connected = [r for r in results if r["connected"]]
+    errors = {}
+    for r in results:
+        if r["error"] is not None:
+            kind = r["error"].split(":")[0]
+            errors[kind] = errors.get(kind, 0) + 1
+    actions = {action: sum(r["actions"][action] for r in results) for action in options["schedule"]}
+
+    summary = {
+        "clients": len(results),
+        "connected": len(connected),
+        "failed": len(results) - len(connected),
+        "disconnects": sum(r["disconnected"] for r in results),
+        "audio": options["audio"],
+        "seconds": options["seconds"],
+        "elapsed_s": round(elapsed, 2),
+        "join_latency_ms": percentiles([r["join_ms"] for r in connected if r["join_ms"] is not None]),
+        "switch_latency_ms": percentiles([ms for r in connected for ms in r["switch_ms"]]),
+        "bitrate_kbps": percentiles([r["bytes"] * 8 / 1000 / r["seconds"] for r in connected if r["seconds"] > 0]),
+        "actions": actions,
+        "control_packets": sum(r["packets"] for r in results),
+        "errors": errors,
+    }
+    if not options["discard"]:
+        # audio seconds received per second connected: 1.0 keeps up with live
+        summary["realtime_ratio"] = percentiles([r["audio_s"] / r["seconds"] for r in connected if r["seconds"] > 0])
+        summary["jitter_ms"] = percentiles([r["jitter_ms"] for r in connected if r["audio_s"] > 0])
+        summary["max_jitter_ms"] = percentiles([r["max_jitter_ms"] for r in connected if r["audio_s"] > 0])
+    return summary
+
+
+# run_load()
+# spreads num_clients over num_procs processes and returns the summary
+def run_load(host, port, num_clients=CLIENTS, num_procs=None, seconds=SECONDS,
+             ramp=RAMP, audio=ac.FORMAT_ULAW, discard=False, schedule=None):
+    num_procs = num_procs or min(os.cpu_count() or 1, max(1, num_clients // 250))
+    options = {"audio": audio, "seconds": seconds, "ramp": ramp, "discard": discard,
+               "schedule": dict(SCHEDULE if schedule is None else schedule)}
+    shares = [num_clients // num_procs + (1 if p < num_clients % num_procs else 0)
+              for p in range(num_procs)]
+
+    start = time.monotonic()
+    if num_procs == 1:
+        results = run_process(0, num_clients, host, port, options)
+    else:
+        with multiprocessing.Pool(num_procs) as pool:
+            per_proc = pool.starmap(run_process, [(p, shares[p], host, port, options)
+                                                  for p in range(num_procs)])
+        results = [r for proc_results in per_proc for r in proc_results]
+    return summarize(results, options, time.monotonic() - start)
+
+
+#
+# MAIN: get cmd-line arguments and run the load
+#
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = dict((arg[2:].split("=", 1) + [""])[:2]
+                 for arg in sys.argv[1:] if arg.startswith("--"))
+    if (len(args) != 2 or any(flag not in LOAD_FLAGS for flag in flags)
+            or flags.get("audio", ac.FORMAT_ULAW) not in ac.FORMATS):
+        print("Usage: python3 LoadGen.py <server address> <port> [--clients=N] "
+              "[--procs=N] [--seconds=N] [--ramp=N] "
+              f"[--audio={'|'.join(ac.FORMATS)}] [--discard] "
+              "[--join=S] [--chat=S] [--list=S] [--request=S] [--out=FILE]")
+        quit()
+
+    schedule = {action: float(flags.get(action, mean)) for action, mean in SCHEDULE.items()}
+    summary = run_load(args[0], int(args[1]),
+                       num_clients=int(flags.get("clients", CLIENTS)),
+                       num_procs=int(flags["procs"]) if "procs" in flags else None,
+                       seconds=float(flags.get("seconds", SECONDS)),
+                       ramp=float(flags.get("ramp", RAMP)),
+                       audio=flags.get("audio", ac.FORMAT_ULAW),
+                       discard="discard" in flags, schedule=schedule)
+
+    text = json.dumps(summary, indent=2)
+    print(text)
+    if "out" in flags:
+        with open(flags["out"], "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
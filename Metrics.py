@@ -0,0 +1,248 @@
+#
+# METRICS.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# In-process metrics for the server. Events are counted in a Metrics
+# registry, and latencies go into fixed-bucket Histograms that hot paths
+# hold on to, so recording one costs a bisect and two adds. Figures that
+# already live on objects (a channel's frames sent, a listener's outbox
+# bytes, the song cache's hits) are only read when metrics are collected,
+# by collector callbacks, so the audio loop pays nothing extra for them.
+# Collected metrics are printed by the "stats" admin command, and served
+# in the Prometheus text format by an optional HTTP endpoint on localhost
+# (Server.py --metrics-port=N).
+#
+
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PREFIX = "requestify_"
+METRICS_HOST = "127.0.0.1"  # the endpoint is for local scrapers only
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+
+# name -> (Prometheus type, help) of every metric the server exports
+HELP = {
+    "channel_frames_sent_total": ("counter", "Audio frames fanned out by a channel"),
+    "channel_bytes_sent_total": ("counter", "Audio bytes written to a channel's listeners"),
+    "channel_listeners": ("gauge", "Clients listening to a channel"),
+    "channel_variants": ("gauge", "Resampled audio variants a channel is producing"),
+    "channel_idle": ("gauge", "1 while a channel is paused for lack of listeners"),
+    "channel_behind_seconds": ("gauge", "How far a channel's stream is behind real time"),
+    "channel_skipped_frames_total": ("counter", "Frames a channel skipped to resync after a stall"),
+    "client_bytes_sent_total": ("counter", "Audio bytes written to a client"),
+    "client_frames_sent_total": ("counter", "Audio frames fully written to a client"),
+    "client_partial_writes_total": ("counter", "Audio writes a client's socket only partly accepted"),
+    "client_dropped_frames_total": ("counter", "Frames dropped by the slow-consumer policy"),
+    "client_queued_bytes": ("gauge", "Audio bytes waiting in a client's outbox"),
+    "client_packets_total": ("counter", "Control packets handled for a client"),
+    "clients": ("gauge", "Connected clients"),
+    "fanout_seconds": ("histogram", "Time to encode and write one channel frame to every listener"),
+    "loop_lag_seconds": ("histogram", "How late the server loop woke for a due frame"),
+    "first_audio_seconds": ("histogram", "Time from joining a channel to its first whole frame written"),
+    "channel_switch_seconds": ("histogram", "Time from moving to another channel to its first whole frame written"),
+    "fetch_seconds": ("histogram", "Duration of one channel's background fetch"),
+    "fetch_queue_depth": ("gauge", "Channels waiting for a fetch worker"),
+    "fetch_failures_total": ("counter", "Background fetches that raised"),
+    "fetches_coalesced_total": ("counter", "Channels served by another channel's fetch of the same query"),
+    "vibe_requests_total": ("counter", "Vibe requests (C_REQ) received"),
+    "vibe_requests_replaced_total": ("counter", "Vibe requests replaced by a newer one before their fetch began"),
+    "song_cache_hits_total": ("counter", "Song cache lookups that found the song on disk"),
+    "song_cache_misses_total": ("counter", "Song cache lookups that had to download"),
+    "search_cache_hits_total": ("counter", "Searches answered from the search cache"),
+    "search_cache_misses_total": ("counter", "Searches sent to SoundCloud"),
+    "packet_decode_errors_total": ("counter", "Control packets that failed to decode"),
+}
+
+
+# class Histogram
+# counts of observed values per bucket; counts[i] holds values up to
+# bounds[i], and the last count everything larger. fetch workers observe
+# into shared histograms, so updates and snapshots take its lock
+#
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count", "lock")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # observe()
+    # records one value
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # snapshot()
+    # returns a copy that observations made meanwhile don't change, so its
+    # count always agrees with its buckets
+    def snapshot(self):
+        copy = Histogram(self.bounds)
+        with self.lock:
+            copy.counts = list(self.counts)
+            copy.sum = self.sum
+            copy.count = self.count
+        return copy
+
+    # quantile()
+    # upper bound of the bucket holding quantile q of the values observed
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for bound, num in zip(self.bounds, self.counts):
+            seen += num
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+# class Metrics
+# named counters and histograms, each under a tuple of (label, value)
+# pairs, plus collectors: callables returning [(name, labels, value)]
+# read from live objects whenever metrics are collected
+#
+class Metrics:
+    counters: dict      # (name, labels) -> count
+    histograms: dict    # (name, labels) -> Histogram
+    collectors: list
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self.http = None
+        self.lock = threading.Lock()    # counters are bumped from worker threads
+
+    # inc()
+    # adds num to a counter
+    def inc(self, name, num=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + num
+
+    # histogram()
+    # returns the named histogram, creating it on first use
+    def histogram(self, name, labels=(), bounds=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(bounds)
+            return hist
+
+    # collect()
+    # returns every counter and collected figure as (name, labels, value),
+    # and every histogram as (name, labels, Histogram)
+    def collect(self):
+        with self.lock:
+            samples = list(self.counters.items())
+            histograms = list(self.histograms.items())
+        samples = [(name, labels, value) for (name, labels), value in samples]
+        for collector in list(self.collectors):
+            try:
+                samples += collector()
+            except RuntimeError:    # state changed under a scrape; skip it
+                pass
+        samples += [(name, labels, hist.snapshot()) for (name, labels), hist in histograms]
+        return samples
+
+    # render()
+    # returns every metric in the Prometheus text exposition format
+    def render(self):
+        by_name = {}
+        for name, labels, value in self.collect():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            full_name = PREFIX + name
+            type, help = HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {type}")
+            for labels, value in by_name[name]:
+                if not isinstance(value, Histogram):
+                    lines.append(f"{full_name}{format_labels(labels)} {value}")
+                    continue
+                seen = 0
+                for bound, num in zip(value.bounds + ("+Inf",), value.counts):
+                    seen += num
+                    le = labels + (("le", str(bound)),)
+                    lines.append(f"{full_name}_bucket{format_labels(le)} {seen}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {value.sum}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    # summary()
+    # returns one line per metric, for the admin console; histograms are
+    # summed up as count, mean and approximate p50 / p99
+    def summary(self):
+        lines = []
+        for name, labels, value in sorted(self.collect(), key=lambda s: (s[0], s[1])):
+            if isinstance(value, Histogram):
+                if value.count == 0:
+                    continue
+                mean_ms = value.sum / value.count * 1000
+                value = (f"n={value.count} mean={mean_ms:.2f}ms "
+                         f"p50<={value.quantile(0.5) * 1000:g}ms "
+                         f"p99<={value.quantile(0.99) * 1000:g}ms")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        return lines
+
+    # serve()
+    # serves render() at http://127.0.0.1:port/metrics on a daemon thread
+    def serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass    # keep scrapes off the server console
+
+        try:
+            self.http = ThreadingHTTPServer((METRICS_HOST, port), Handler)
+        except OSError as e:
+            print(f"Couldn't serve metrics on port {port}: {e}")
+            return
+        self.http.daemon_threads = True
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+
+
+# format_labels()
+# formats (label, value) pairs as {label="value",...}
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+METRICS = None
+
+# get_metrics()
+# returns the process's shared Metrics registry
+def get_metrics():
+    global METRICS
+    if METRICS is None:
+        METRICS = Metrics()
+    return METRICS
@@ -0,0 +1,77 @@
+#
+# PACER.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Wall-clock pacing for a Channel's audio frames. Each Channel owns a Pacer
+# holding a monotonic-clock deadline for its next frame; the server asks
+# how many frames are due instead of sleeping a fixed delay after every
+# tick, so time spent in the loop body never slows playback down.
+#
+
+import time
+
+import Packet as pack
+
+MAX_BURST = 8   # frames one channel may send back to back to catch up
+MAX_LAG = 0.5   # seconds behind after which a channel resyncs to now
+
+
+# class Pacer
+# tracks when a channel's next frame is due, given the byte rate of the
+# song it is playing
+#
+class Pacer:
+    frame_time: float   # seconds of audio in one pack.AUDIO_PACK frame
+    deadline: float     # monotonic time the next frame is due, or None
+    skipped: int        # frames skipped by resyncs after long stalls
+    late: float         # seconds past the deadline the last due() call was
+
+    def __init__(self, byte_rate=pack.BYTE_RATE, frame_len=pack.AUDIO_PACK):
+        self.frame_len = frame_len
+        self.frame_time = frame_len / byte_rate
+        self.deadline = None
+        self.skipped = 0
+        self.late = 0.0
+
+    # set_rate()
+    # updates the byte rate, e.g. from the "fmt " chunk of a new song
+    def set_rate(self, byte_rate):
+        self.frame_time = self.frame_len / byte_rate
+
+    # due()
+    # returns how many frames to send now, and moves the deadline past
+    # them. after a stall, catches up at most MAX_BURST frames per call;
+    # past MAX_LAG behind, the missed frames are skipped instead
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.deadline is None:
+            self.deadline = now
+
+        late = now - self.deadline
+        if late < 0:
+            return 0
+        self.late = late
+        if late > MAX_LAG:
+            self.skipped += int(late / self.frame_time)
+            self.deadline = now
+            late = 0
+
+        num_frames = min(MAX_BURST, int(late / self.frame_time) + 1)
+        self.deadline += num_frames * self.frame_time
+        return num_frames
+
+    # wait_time()
+    # seconds until the next frame is due (0 if it's already due)
+    def wait_time(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.deadline is None:
+            return 0
+        return max(0.0, self.deadline - now)
+
+    # behind()
+    # seconds the channel is behind real time (0 if it's on schedule)
+    def behind(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.deadline is None:
+            return 0
+        return max(0.0, now - self.deadline)
@@ -5,6 +5,14 @@
 #
 # Each packet is structured as follows:
 #   [ data len, DATA_BYTE bytes ] [ json data, data len bytes]
+# a data len of EXT_LEN is followed by the real length in 4 bytes, for
+# packets (like S_INIT with many usernames) too big for DATA_BYTE bytes.
+#
+# Once a client offers it in C_INIT (and the server confirms with S_YES),
+# its com socket switches to the compact binary framing (CODEC_BIN):
+#   [ version, type, flags: 1 byte each ] [ body len, 4 bytes ] [ body ]
+# with a per-type field encoding of the body (see BIN_FIELDS), or JSON if
+# flags has FLAG_JSON set.
 #
 # SERVER PACKETS:
 #   Type 1: Init / Setup. Contains list of channels:
@@ -20,13 +28,21 @@
 
 import socket
 import json
+import struct
 from math import floor
 
 
-BITRATE = 44100
+SAMPLE_RATE = 44100     # default song format: 16-bit stereo 44.1 kHz PCM
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+BYTE_RATE = SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH   # 176,400 B/s
 DATA_BYTE = 2   # number of bytes in header to describe pack length
+EXT_LEN = 2 ** (8 * DATA_BYTE) - 1  # header value marking a 4-byte length
+MAX_PACKET = 16 * 1024 * 1024   # largest control packet body accepted
+READ_BUF = 64 * 1024    # starting size of a PacketDecoder's receive buffer
+MIN_READ = 4 * 1024     # free space a PacketDecoder keeps to receive into
 AUDIO_PACK = 1024
-SEND_DELAY = (AUDIO_PACK / 8) / BITRATE
+SEND_DELAY = AUDIO_PACK / BYTE_RATE     # seconds of audio in one frame
 
 # packet types
 S_INIT = 1  # bootstrap communications: sends channel list
@@ -39,13 +55,41 @@ C_LIST = 6  # list: client request for updated list of channels
 S_LIST = 7  # list: server response with updated list of channels
 C_REQ = 8   # request: client request for song with updated vibe
 S_ERR = 9   # err: server response to a poorly formed client packet
-S_YES = 9   # err: server confirmation to a given client packet
+S_YES = 10  # yes: server confirmation to a given client packet
+S_REQ = 11  # request: how a client's vibe request is going
+S_FLUSH = 12    # flush: byte offset of the audio stream where a new channel starts
+
+# control packet codecs, most preferred first
+CODEC_JSON = "json"
+CODEC_BIN = "bin1"
+CODECS = [CODEC_BIN, CODEC_JSON]
+
+BIN_VERSION = 1
+BIN_HEADER = struct.Struct(">BBBI")     # version, type, flags, body len
+FLAG_JSON = 1   # body is JSON, for data with no compact field encoding
+
+# compact body encodings per packet type: a list of fields, each a single
+# string ("s") or a list of strings ("l"). S_INIT's dict is encoded as the
+# lists of its "c" and "n" keys. a string is its UTF-8 length and bytes; a
+# list is its item count and byte length, then its items joined by NUL, so
+# it decodes with a single split. packets whose strings contain NUL go as
+# JSON instead
+BIN_FIELDS = {
+    S_INIT: ["l", "l"], C_INIT: ["s", "s", "s"],
+    S_MSG: ["s"], C_MSG: ["s"], C_JOIN: ["s"], C_LIST: [],
+    S_LIST: ["l"], C_REQ: ["s"], S_ERR: ["s"],
+}
+STR_LEN = struct.Struct(">H")   # length prefix of each string
+LIST_LEN = struct.Struct(">II") # item count and joined length of each list
 
 
 # construct_packet()
-# given an integer type and JSON-friendly data, construct a JSON packet
-# and convert it into a byte packet
-def construct_packet(type, data):
+# given an integer type and JSON-friendly data, construct a packet in the
+# given codec and convert it into a byte packet
+def construct_packet(type, data, codec=CODEC_JSON):
+    if codec == CODEC_BIN:
+        return construct_bin(type, data)
+
     json_bytes = ""
     try:
         json_str = json.dumps({"t":type, "d":data})
@@ -55,19 +99,25 @@ def construct_packet(type, data):
         return b"\0"   # null
 
     # data is type audio bytes
-    max_bytes = (2 ** (8 * DATA_BYTE) - 1)
-    if len(json_bytes) > max_bytes:
-        print(f"Cannot send data: length {len(json_bytes)} exceeds max packet size {max_bytes}")
+    if len(json_bytes) > MAX_PACKET:
+        print(f"Cannot send data: length {len(json_bytes)} exceeds max packet size {MAX_PACKET}")
         return b"\0"   # null
 
-    len_bytes = len(json_bytes).to_bytes(DATA_BYTE, 'big')
+    if len(json_bytes) >= EXT_LEN:
+        len_bytes = EXT_LEN.to_bytes(DATA_BYTE, 'big') + len(json_bytes).to_bytes(4, 'big')
+    else:
+        len_bytes = len(json_bytes).to_bytes(DATA_BYTE, 'big')
     return len_bytes + json_bytes
 
 
 # construct_packet()
 # given a byte string type containing JSON data, deconstruct it back into
-# a JSON object, returning the "type" and "data" values from this JSON
-def deconstruct_packet(packet_bytes):
+# a JSON object, returning the "type" and "data" values from this JSON.
+# for CODEC_BIN, packet_bytes is the whole frame, header included
+def deconstruct_packet(packet_bytes, codec=CODEC_JSON):
+    if codec == CODEC_BIN:
+        return deconstruct_bin(packet_bytes)
+
     try:
         json_str = packet_bytes.decode('utf-8')
         json_data = json.loads(json_str)
@@ -77,7 +127,7 @@ def deconstruct_packet(packet_bytes):
         return -1, ""
     # packet is badly formatted
     except KeyError as ke:
-        print(f"Error: packet badly formattted. Packet: {data}")
+        print(f"Error: packet badly formattted. Packet: {packet_bytes}")
         return -1, ""
     # client connection may have dropped out
     except Exception as e:
@@ -85,36 +135,306 @@ def deconstruct_packet(packet_bytes):
         return -1, ""
 
 
+# construct_bin()
+# CODEC_BIN version of construct_packet; data that doesn't fit its type's
+# BIN_FIELDS is sent as JSON, with FLAG_JSON set
+def construct_bin(type, data):
+    flags = 0
+    try:
+        body = encode_fields(type, data)
+    except (KeyError, TypeError, ValueError, AttributeError, struct.error):
+        flags = FLAG_JSON
+        try:
+            body = json.dumps(data).encode('utf-8')
+        except TypeError:
+            print(f"Cannot send data: invalid data type for packet.")
+            return b"\0"   # null
+
+    if len(body) > MAX_PACKET:
+        print(f"Cannot send data: length {len(body)} exceeds max packet size {MAX_PACKET}")
+        return b"\0"   # null
+    return BIN_HEADER.pack(BIN_VERSION, type, flags, len(body)) + body
+
+
+# deconstruct_bin()
+# CODEC_BIN version of deconstruct_packet, given header and body
+def deconstruct_bin(frame):
+    try:
+        version, type, flags, body_len = BIN_HEADER.unpack_from(frame)
+        if version != BIN_VERSION:
+            print(f"Error: unknown packet version {version}")
+            return -1, ""
+        body = bytes(frame[BIN_HEADER.size : BIN_HEADER.size + body_len])
+        if flags & FLAG_JSON:
+            return type, json.loads(body.decode('utf-8'))
+        return type, decode_fields(type, body)
+    except Exception as e:
+        print(f"Error: cannot process packet. Source: {e}.")
+        return -1, ""
+
+
+# encode_fields()
+# encodes data by its type's BIN_FIELDS; raises if data doesn't fit them
+def encode_fields(type, data):
+    fields = BIN_FIELDS[type]
+    if type == S_INIT:
+        values = [data["c"], data["n"]]
+    elif len(fields) == 1:
+        values = [data]
+    elif len(fields) == 0:
+        values = [] if data in ("", None) else None
+    else:
+        values = data
+    if values is None or len(values) != len(fields):
+        raise ValueError("data doesn't fit packet fields")
+
+    parts = []
+    for field, value in zip(fields, values):
+        if field == "s":
+            if not isinstance(value, str):
+                raise TypeError("packet field is not a string")
+            value_bytes = value.encode('utf-8')
+            parts.append(STR_LEN.pack(len(value_bytes)))
+            parts.append(value_bytes)
+        else:
+            joined = "\0".join(value)     # TypeError if not strings
+            if joined.count("\0") != max(0, len(value) - 1):
+                raise ValueError("list item contains NUL")
+            joined = joined.encode('utf-8')
+            parts.append(LIST_LEN.pack(len(value), len(joined)))
+            parts.append(joined)
+    return b"".join(parts)
+
+
+# decode_fields()
+# decodes a body encoded by encode_fields back into the packet's data
+def decode_fields(type, body):
+    fields = BIN_FIELDS[type]
+    values = []
+    pos = 0
+    for field in fields:
+        if field == "s":
+            (value_len,) = STR_LEN.unpack_from(body, pos)
+            pos += STR_LEN.size
+            values.append(body[pos : pos + value_len].decode('utf-8'))
+            pos += value_len
+        else:
+            count, joined_len = LIST_LEN.unpack_from(body, pos)
+            pos += LIST_LEN.size
+            joined = body[pos : pos + joined_len].decode('utf-8')
+            pos += joined_len
+            values.append(joined.split("\0") if count else [])
+
+    if type == S_INIT:
+        return {"c": values[0], "n": values[1]}
+    elif len(fields) == 1:
+        return values[0]
+    elif len(fields) == 0:
+        return ""
+    return values
+
+
+# header_len()
+# returns the number of header bytes to read before a codec's packet
+# length is known (the JSON header may extend by 4 more, see body_len)
+def header_len(codec):
+    return BIN_HEADER.size if codec == CODEC_BIN else DATA_BYTE
+
+
+# body_len()
+# given a packet's header, returns (extra header bytes still to read,
+# body length); JSON's extended-length header needs 4 more bytes
+def body_len(header, codec):
+    if codec == CODEC_BIN:
+        return 0, BIN_HEADER.unpack_from(header)[3]
+    if len(header) == DATA_BYTE:
+        packet_len = int.from_bytes(header, 'big')
+        return (4, 0) if packet_len == EXT_LEN else (0, packet_len)
+    return 0, int.from_bytes(header[DATA_BYTE:], 'big')
+
+
 # read_packet()
 # reads a single frame from server on a given socket, this_sock; then,
-# returns the recieved packet's type and payload
-def read_packet(this_sock):
+# returns the recieved packet's type and payload. it reads exactly one
+# packet and blocks until it has; connections that carry more than one
+# packet use a PacketDecoder instead
+def read_packet(this_sock, codec=CODEC_JSON):
     if not isinstance(this_sock, socket.socket):
         print(f"Error: socket {this_sock} not initialized")
         return -1, ""
 
     try:    # first, read the packet from stream
-        frame = this_sock.recv(DATA_BYTE)
+        frame = this_sock.recv(header_len(codec))
         if len(frame) == 0: # no data recieved at this moment, return
             return 0, ""
 
         # recieve full header
-        while len(frame) < DATA_BYTE:
-            frame += this_sock.recv(DATA_BYTE - len(frame))
-
-        packet_len = int.from_bytes(frame, 'big')
+        while len(frame) < header_len(codec):
+            frame += this_sock.recv(header_len(codec) - len(frame))
+        extra, packet_len = body_len(frame, codec)
+        if extra > 0:
+            frame += recv_exactly(this_sock, extra)
+            extra, packet_len = body_len(frame, codec)
+        if packet_len > MAX_PACKET:
+            print(f"Error: packet length {packet_len} exceeds max packet size {MAX_PACKET}")
+            return -1, ""
 
         # now, read packet in entirety
-        packet_bytes =  this_sock.recv(packet_len)
-        while len(packet_bytes) < packet_len:
-            packet_bytes += this_sock.recv(packet_len - len(packet_bytes))  
+        packet_bytes = recv_exactly(this_sock, packet_len)
 
     except Exception as e:
         print(f"Error: can not read packet. Source: {str(e)}.")
         return -1, ""
 
-    # now, decode the packet into JSON; returns type, data
-    return deconstruct_packet(packet_bytes)
+    # now, decode the packet; returns type, data
+    if codec == CODEC_BIN:
+        return deconstruct_packet(frame + packet_bytes, codec)
+    return deconstruct_packet(packet_bytes, codec)
+
+
+# recv_exactly()
+# reads exactly num bytes from this_sock
+def recv_exactly(this_sock, num):
+    data = bytearray()
+    while len(data) < num:
+        chunk = this_sock.recv(num - len(data))
+        if len(chunk) == 0:
+            raise ConnectionError("connection closed mid-packet")
+        data += chunk
+    return bytes(data)
+
+
+# class PacketDecoder
+# per-connection stream decoder. each recv() reads whatever the socket has
+# into one reusable buffer, and packets() then yields every complete packet
+# in it; a partial packet stays buffered until the rest arrives, so reading
+# never waits on a slow sender. frames larger than max_packet close the
+# decoder, since the stream can't be resynced after one
+#
+class PacketDecoder:
+    codec: str      # codec of the packets still to decode
+    closed: bool    # True once the peer hung up or sent a bad frame
+
+    def __init__(self, codec=CODEC_JSON, max_packet=MAX_PACKET):
+        self.codec = codec
+        self.max_packet = max_packet
+        self.buf = bytearray(READ_BUF)
+        self.start = 0  # first byte not yet decoded
+        self.end = 0    # end of the bytes received
+        self.need = 0   # bytes the next frame needs from start, once known
+        self.closed = False
+
+    # space()
+    # returns a view of the free end of the buffer to receive into; the
+    # caller must release() it before the decoder is used again
+    def space(self):
+        pending = self.end - self.start
+        if pending == 0 and len(self.buf) > READ_BUF:
+            self.buf = bytearray(READ_BUF)  # done with a big frame
+            self.start = self.end = 0
+        elif self.start > 0 and len(self.buf) - self.end < MIN_READ:
+            self.buf[:pending] = self.buf[self.start : self.end]
+            self.start, self.end = 0, pending
+
+        size = self.start + max(self.need, pending + MIN_READ)
+        if size > len(self.buf):
+            self.buf.extend(bytes(size - len(self.buf)))
+        return memoryview(self.buf)[self.end:]
+
+    # received()
+    # records num bytes received into the view from space(); 0 means the
+    # peer hung up
+    def received(self, num):
+        self.end += num
+        if num == 0:
+            self.closed = True
+
+    # feed()
+    # adds bytes received some other way, e.g. handed over with a socket
+    def feed(self, data):
+        if len(data) == 0:
+            return
+        self.need = max(self.need, self.end - self.start + len(data))
+        view = self.space()
+        view[: len(data)] = data
+        view.release()
+        self.end += len(data)
+
+    # pending()
+    # returns the bytes received but not yet decoded
+    def pending(self):
+        return bytes(self.buf[self.start : self.end])
+
+    # recv()
+    # reads whatever this_sock has ready, with a single recv_into
+    def recv(self, this_sock):
+        view = self.space()
+        try:
+            num = this_sock.recv_into(view)
+        except (BlockingIOError, InterruptedError):
+            return  # nothing ready after all
+        except ConnectionError:
+            num = 0     # peer hung up
+        except OSError as e:
+            print(f"Error: can not read packet. Source: {str(e)}.")
+            num = 0
+        finally:
+            view.release()
+        self.received(num)
+
+    # packets()
+    # yields (type, data) for each complete packet received so far. the
+    # codec is checked per packet, so a switch made while handling one
+    # packet applies to the next
+    def packets(self):
+        while not self.closed:
+            packet = self.next_packet()
+            if packet is None:
+                return
+            yield packet
+
+    # next_packet()
+    # decodes the packet at the front of the buffer, or returns None if it
+    # hasn't fully arrived
+    def next_packet(self):
+        codec = self.codec
+        pending = self.end - self.start
+        head = header_len(codec)
+        if pending < head:
+            self.need = head
+            return None
+        extra, packet_len = body_len(self.buf[self.start : self.start + head], codec)
+        if extra > 0:
+            head += extra
+            if pending < head:
+                self.need = head
+                return None
+            extra, packet_len = body_len(self.buf[self.start : self.start + head], codec)
+        if packet_len > self.max_packet:
+            print(f"Error: packet length {packet_len} exceeds max packet size {self.max_packet}")
+            self.closed = True
+            return None
+        if pending < head + packet_len:
+            self.need = head + packet_len
+            return None
+
+        # CODEC_BIN decodes the whole frame, JSON just the body
+        body_start = self.start if codec == CODEC_BIN else self.start + head
+        frame = bytes(self.buf[body_start : self.start + head + packet_len])
+        self.start += head + packet_len
+        self.need = 0
+        return deconstruct_packet(frame, codec)
+
+    # read_packet()
+    # blocking read of the next packet, for callers that wait on a reply;
+    # returns (0, "") once the peer hangs up
+    def read_packet(self, this_sock):
+        while True:
+            for packet in self.packets():
+                return packet
+            if self.closed:
+                return 0, ""
+            self.recv(this_sock)
 
 
 # write_packet()
@@ -122,12 +442,12 @@ def read_packet(this_sock):
 # until all data is sent
 # returns True if packets are transmitted successfully, False otherwise
 #
-def write_packet(this_sock, type, data):
+def write_packet(this_sock, type, data, codec=CODEC_JSON):
     if not isinstance(this_sock, socket.socket):
         print(f"Error: socket {this_sock} not initialized")
         return False
 
-    packet_bytes = construct_packet(type, data)
+    packet_bytes = construct_packet(type, data, codec)
     if packet_bytes == b"\0":
         return False
 
@@ -0,0 +1,232 @@
+#
+# PREFETCH.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Background song fetching for Channels. Channels ask the FetchScheduler to
+# keep a number of songs ready ahead of need; a pool of worker threads runs
+# the searches, downloads and store ingests off the audio loop, always
+# picking the most urgent channel first: the one with the most listeners
+# and the least time left in its current song. The pool size caps how many
+# fetches run at once, and a token bucket caps their total bandwidth.
+# Requests from channels paused for lack of listeners wait, and a fetch
+# stops early if its channel goes idle, until someone listens again
+# (channels still warming up fetch their first songs regardless).
+# Channels waiting on the same query (up to case, punctuation and word
+# order, see query_key()) are served by one fetch, which downloads each
+# song once and hands it to all of them.
+#
+
+import re
+import time
+import threading
+
+import SongFetcher as sf
+from SongStore import get_store
+from StreamIngest import stream_song, STREAM_EXT
+from Metrics import get_metrics
+
+WORKERS = 4                     # fetches running at once, server-wide
+BANDWIDTH = 4 * 1024 * 1024     # bytes/sec all fetches may download
+BURST = 16 * 1024 * 1024        # bytes of bandwidth that may be saved up
+READY_AHEAD = 2                 # unplayed songs each channel keeps ready
+REQUEST_READY = 1               # songs of a requested vibe ready before switching to it
+SEARCH_SLACK = 3                # extra search results, to skip songs we have
+STREAM_NEW = True               # play new downloads while they're decoding
+
+
+# class TokenBucket
+# bandwidth budget shared by the workers. a finished download is charged
+# after the fact, so the bucket can go into debt; workers wait for it to
+# refill before starting their next fetch
+#
+class TokenBucket:
+    def __init__(self, rate=BANDWIDTH, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # charge()
+    # spends num_bytes of the budget
+    def charge(self, num_bytes):
+        with self.lock:
+            self.refill()
+            self.tokens -= num_bytes
+
+    # wait()
+    # blocks until the budget is out of debt
+    def wait(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 0:
+                    return
+                delay = -self.tokens / self.rate
+            time.sleep(delay)
+
+
+# query_key()
+# normalizes a query, so near-identical ones ("Lo-Fi beats", "beats lofi")
+# are fetched once
+def query_key(query):
+    return " ".join(sorted(re.sub(r"[^\w\s]", "", query.lower()).split()))
+
+
+# class FetchScheduler
+# pending fetch requests, at most one per channel, and the worker pool
+# that serves them in order of urgency, coalescing channels that want the
+# same query
+#
+class FetchScheduler:
+    pending: dict   # channel -> number of unplayed songs it wants ready
+    running: set    # channels a worker is currently fetching for
+
+    def __init__(self, workers=WORKERS, bandwidth=BANDWIDTH):
+        self.pending = {}
+        self.running = set()
+        self.bucket = TokenBucket(bandwidth)
+        self.cond = threading.Condition()
+        self.workers = [threading.Thread(target=self.work, daemon=True)
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    # request()
+    # asks for channel to have num_ready unplayed songs on disk
+    def request(self, channel, num_ready=READY_AHEAD):
+        with self.cond:
+            if channel.needed(num_ready) <= 0:
+                return
+            self.pending[channel] = max(num_ready, self.pending.get(channel, 0))
+            self.cond.notify()
+
+    # queue_depth()
+    # number of channels waiting for a worker
+    def queue_depth(self):
+        with self.cond:
+            return len(self.pending)
+
+    # take()
+    # blocks until a playing channel no worker is serving has a pending
+    # request, then returns the most urgent one with every other waiting
+    # channel fetching the same query, and the largest of their requests
+    def take(self):
+        with self.cond:
+            while True:
+                waiting = [c for c in self.pending
+                           if c not in self.running and not c.fetches_paused()]
+                if waiting:
+                    break
+                self.cond.wait()
+
+            channel = max(waiting, key=urgency)
+            key = query_key(channel.fetch_query())
+            group = [c for c in waiting if query_key(c.fetch_query()) == key]
+            self.running.update(group)
+            return group, max(self.pending.pop(c) for c in group)
+
+    # work()
+    # worker thread: serves requests until the process exits
+    def work(self):
+        fetch_time = get_metrics().histogram("fetch_seconds")
+        while True:
+            self.bucket.wait()
+            group, num_ready = self.take()
+            query = group[0].fetch_query()
+            if len(group) > 1:
+                get_metrics().inc("fetches_coalesced_total", len(group) - 1)
+            start = time.monotonic()
+            try:
+                self.fetch(group, query, num_ready)
+            except Exception as e:
+                print(f"Fetch for channel {query} failed: {e}")
+                get_metrics().inc("fetch_failures_total")
+            finally:
+                fetch_time.observe(time.monotonic() - start)
+                for channel in group:
+                    channel.fetch_ended(query)
+                with self.cond:
+                    self.running.difference_update(group)
+                    self.cond.notify()
+
+    # fetch()
+    # searches query, then downloads and stores results until every
+    # channel in group has num_ready unplayed songs of it. songs are handed
+    # over through channel.deliver(), and dropped there if the channel's
+    # query has changed in the meantime
+    def fetch(self, group, query, num_ready):
+        key = query_key(query)
+        limit = max(len(c.songs) for c in group) + num_ready + SEARCH_SLACK
+        for result in sf.search(query, limit):
+            wanting = [c for c in group if c.wants(key, num_ready)]
+            if not wanting:
+                return
+
+            song = sf.get_cache().lookup(result["id"])
+            if song is None and STREAM_NEW:
+                self.stream(wanting, query, result)
+                continue
+
+            before = sf.fetched_bytes()
+            if song is None:
+                song = sf.download_song(result)
+            self.bucket.charge(sf.fetched_bytes() - before)
+            wanting = [c for c in wanting if song is not None and not c.has_song(song)]
+            if not wanting:
+                continue
+            try:
+                get_store().ingest(song)
+            except (ValueError, OSError) as e:
+                print(f"Couldn't store song {song}: {e}")
+                continue
+            # another worker may have evicted the song since; once delivered
+            # it's pinned, so nothing can evict it in between
+            with sf.get_cache().lock:
+                if not get_store().has(song):
+                    continue
+                for channel in wanting:
+                    channel.deliver(query, song)
+
+    # stream()
+    # streams a track that isn't cached: the channels get it as soon as
+    # its first StreamIngest.START_SECONDS are decoded, and the worker
+    # stays busy with it until it's fully stored
+    def stream(self, channels, query, track):
+        name = f"{track['id']}{STREAM_EXT}"
+        channels = [c for c in channels if not c.has_song(name)]
+        if not channels:
+            return
+        song = stream_song(track)
+        if song is None:
+            return
+
+        song.started.wait()
+        if not song.failed:
+            for channel in channels:
+                channel.deliver(query, song.name)
+        song.done.wait()
+        self.bucket.charge(song.fetched)
+
+
+# urgency()
+# how badly a channel needs its songs: more listeners and less time left
+# in the current song come first
+def urgency(channel):
+    return (len(channel.clients) + 1) / (channel.remaining() + 1)
+
+
+SCHEDULER = None
+
+# get_scheduler()
+# returns the server's shared FetchScheduler, starting it on first use
+def get_scheduler():
+    global SCHEDULER
+    if SCHEDULER is None:
+        SCHEDULER = FetchScheduler()
+    return SCHEDULER
@@ -0,0 +1,129 @@
+#
+# RESAMPLE.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Per-listener audio variants. A client can ask at C_INIT for a sample
+# rate (one of RATES) and mono or stereo instead of the songs' own format,
+# to save bandwidth on a slow link. Each Channel keeps one Resampler per
+# variant its listeners asked for, in its Variants: every frame is
+# converted once per variant and shared by everyone who chose it, and a
+# variant's Resampler is built on first use and dropped as soon as nobody
+# on the channel listens to it. Resampling is vectorized with NumPy: a
+# windowed-sinc low-pass FIR (when downsampling) then linear
+# interpolation, carrying filter history and the fractional read
+# position from one frame to the next, so frames join seamlessly.
+#
+
+import numpy as np
+
+import Packet as pack
+
+RATES = [44100, 32000, 22050]   # sample rates a client may ask for
+CHANNEL_COUNTS = [2, 1]         # stereo or mono
+FIR_TAPS = 31                   # low-pass filter length, when downsampling
+CUTOFF = 0.9                    # low-pass cutoff, as a fraction of the new Nyquist rate
+PCM_MIN, PCM_MAX = -32768, 32767
+
+
+# pick()
+# returns the variant, (rate, channels), a client's C_INIT options ask
+# for, or None to get the songs as they are; unsupported values fall back
+# to the default format
+def pick(options):
+    rate = options.get("rate")
+    channels = options.get("channels")
+    if rate is None and channels is None:
+        return None
+    return (rate if rate in RATES else pack.SAMPLE_RATE,
+            channels if channels in CHANNEL_COUNTS else pack.CHANNELS)
+
+
+# lowpass()
+# windowed-sinc FIR taps passing frequencies below cutoff (cycles/sample)
+def lowpass(cutoff, taps=FIR_TAPS):
+    n = np.arange(taps) - (taps - 1) / 2
+    fir = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (fir / fir.sum()).astype(np.float32)
+
+
+# class Resampler
+# converts consecutive frames of 16-bit PCM from one (rate, channels) to
+# another
+#
+class Resampler:
+    source: tuple       # (rate, channels) frames come in
+    channels: int       # channels frames go out with
+    step: float         # input samples per output sample
+
+    def __init__(self, source, variant):
+        self.source = source
+        rate, self.channels = variant
+        self.step = source[0] / rate
+        self.fir = None
+        if rate < source[0]:
+            self.fir = lowpass(CUTOFF * rate / source[0] / 2)
+            self.history = np.zeros((len(self.fir) - 1, self.channels), np.float32)
+        self.prev = np.zeros((1, self.channels), np.float32)  # last sample of the last frame
+        self.pos = 0.0      # next output sample's position, counting prev as 0
+
+    # convert()
+    # returns one frame of PCM in the variant's format
+    def convert(self, frame):
+        pcm = np.frombuffer(frame, np.int16).reshape(-1, self.source[1]).astype(np.float32)
+        if self.channels < self.source[1]:
+            pcm = pcm.mean(axis=1, keepdims=True)
+        elif self.channels > self.source[1]:
+            pcm = np.repeat(pcm, self.channels, axis=1)
+        if self.step == 1.0:
+            return self.pack(pcm)
+
+        if self.fir is not None:
+            padded = np.concatenate([self.history, pcm])
+            self.history = padded[len(pcm):]
+            pcm = np.stack([np.convolve(padded[:, c], self.fir, "valid")
+                            for c in range(self.channels)], axis=1)
+
+        # interpolate output samples between prev and this frame's samples
+        samples = np.concatenate([self.prev, pcm])
+        last = len(samples) - 1
+        count = max(0, int((last - self.pos) // self.step) + 1)
+        t = self.pos + self.step * np.arange(count)
+        i = t.astype(np.intp)
+        frac = (t - i).astype(np.float32)[:, None]
+        out = samples[i] * (1 - frac) + samples[np.minimum(i + 1, last)] * frac
+        self.pos += self.step * count - last
+        self.prev = samples[last:]
+        return self.pack(out)
+
+    # pack()
+    # rounds float samples back to 16-bit PCM bytes
+    def pack(self, pcm):
+        return np.clip(np.rint(pcm), PCM_MIN, PCM_MAX).astype(np.int16).tobytes()
+
+
+# class Variants
+# one channel's Resamplers, by variant
+#
+class Variants:
+    resamplers: dict    # (rate, channels) -> Resampler
+
+    def __init__(self):
+        self.resamplers = {}
+
+    # convert()
+    # returns a frame of PCM in source format (rate, channels) converted to
+    # variant; call once per frame per variant, since resamplers carry
+    # state from frame to frame
+    def convert(self, frame, variant, source):
+        if variant is None or variant == source:
+            return frame
+        resampler = self.resamplers.get(variant)
+        if resampler is None or resampler.source != source:
+            resampler = self.resamplers[variant] = Resampler(source, variant)
+        return resampler.convert(frame)
+
+    # keep()
+    # drops the resamplers of variants no longer listened to
+    def keep(self, variants):
+        for variant in [v for v in self.resamplers if v not in variants]:
+            del self.resamplers[variant]
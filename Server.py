@@ -18,11 +18,23 @@ import select
 import SongFetcher as sf
 from SongFetcher import SONG_DIR
 import Packet as pack 
+import AudioCodec as ac
+import Dsp as dsp
+import Resample
+import Snapshot
+from Pacer import Pacer
+from SongStore import get_store, StoredSong
+from Prefetch import get_scheduler, query_key, READY_AHEAD, REQUEST_READY
+from StreamIngest import GrowingSong, open_stream, resolve, stream_failed
+from FanOut import FanOut, FrameRing, SLOW_POLICIES, POLICY_DROP, MAX_BEHIND_MS
+from Session import ClientSession, Sessions
+from Metrics import get_metrics
+import Prefetch
 
 import random
 import time
-from io import BufferedReader
 import json
+from collections import deque
 
 SELF = "127.0.0.1"  # loopback for hosting oneself
 
@@ -35,6 +47,18 @@ SEED_FILE = "seeds.txt"
 LOBBY_QUERY = "PokéCenter" 
 CLOSE = "exit"
 SONG_LIST_SIZE = 2
+REQUEST_DEBOUNCE = 0.75 # seconds a vibe request waits for one that replaces it
+CUT_SECONDS = 0.5       # fade-out of a song cut short for a new vibe without a head
+WARM_POLL = 0.05        # seconds between checks for a warming channel's first song
+SERVER_FLAGS = ["async", "slow", "slow-ms", "cache-mb", "shards", "metrics-port"]
+    # --async: run on the asyncio engine
+    # --slow=drop|skip|disconnect: policy for listeners that fall behind
+    # --slow-ms=N: how far behind (ms) a listener may fall before --slow applies
+    # --cache-mb=N: disk budget of the downloaded songs and their store copies
+    # --shards=N: split the channels over N worker processes. each worker
+    #   keeps its songs and snapshot in songs/shard<k>, so changing N starts
+    #   over with an empty cache and fresh channels
+    # --metrics-port=N: serve Prometheus metrics on localhost port N
 
 
 # get_seeds()
@@ -53,61 +77,514 @@ def get_seeds(num_seeds):
 
 # class Channel
 # records a list of current listening clients, and a queue of songs
-# (filenames). maintains a non-empty playlist of songs; on next(), the 
-# next song is opened as BufferedReader open_file
+# (filenames): songs[0] is playing, the rest are up next. on next(), the 
+# next song is opened from the SongStore as song, and read frame by frame
+# from byte offset pos. its Pacer decides when the next frame is due.
+# new songs are fetched in the background by the Prefetch scheduler and
+# handed over through the ready queue, so next() never waits on the network.
+# songs crossfade into each other through a bridge mixed from the faded
+# tail and head stored with them (see Dsp.py). a channel nobody listens to
+# is paused: it reads nothing and fetches nothing, and only remembers when
+# it went idle, so the first listener back can be dropped in where the
+# stream would be had it played on all along (its virtual playhead).
+# a vibe request (C_REQ) doesn't change the query at once: it waits out
+# REQUEST_DEBOUNCE for a request replacing it, is fetched in the
+# background, and the channel plays on until REQUEST_READY songs of it are
+# ready, then cuts over to them. the requesters hear how it's going
+# through updates, which the server sends as S_REQ. a new channel starts
+# with the songs its snapshot left in the store, if any, and warms up in
+# the background: it plays once its first song arrives
 #
 class Channel:
     songs: list     # maintained list of songs
     query: str      # current query to SoundCloud 
-    clients: list   # current clients: (comm sock, aud sock)
-    open_file: BufferedReader   # current open song file
+    clients: set    # ClientSessions listening, kept by Sessions
+    song: StoredSong    # current song's PCM data (or a GrowingSong stream)
+    pos: int        # byte offset of the next frame in song
+    pacer: Pacer    # deadline for this channel's next frame
+    ready: deque    # songs fetched for this channel, not yet in songs
+    played: set     # songs this channel has played for its query
+    bridge: memoryview  # crossfade into song playing before it, or None
+    variants: Resample.Variants # resamplers for listeners' audio variants
+    recent: FrameRing   # last frames sent, for listeners who join
+    idle_since: float   # monotonic time the channel was paused, or None
+    pending_query: str  # vibe requested but not playing yet, or None
+    request_at: float   # when pending_query's fetch may start, or None once it has
+    incoming: deque     # songs fetched for pending_query
+    requesters: list    # com sockets of the clients who asked for pending_query
+    updates: deque      # (com sockets, S_REQ data) for the server to send
+    frames_sent: int    # frames fanned out to listeners
+    bytes_sent: int     # audio bytes written to listeners
 
-    def __init__(self, query, num_songs=SONG_LIST_SIZE):
+    def __init__(self, query, num_songs=SONG_LIST_SIZE, state=None):
         self.songs = []
         self.query = query
-        self.clients = []
-        self.open_file = None
+        self.clients = set()
+        self.song = None
+        self.pos = 0
+        self.pacer = Pacer()
+        self.ready = deque()
+        self.played = set()
+        self.bridge = None
+        self.bridge_pos = 0
+        self.variants = Resample.Variants()
+        self.recent = FrameRing()
+        self.idle_since = None
+        self.pending_query = None
+        self.request_at = None
+        self.incoming = deque()
+        self.requesters = []
+        self.updates = deque()
+        self.reported = 0
+        self.request_failed = False
+        self.frames_sent = 0
+        self.bytes_sent = 0
         print(f"new channel: {query}")
-        
+
+        pos = 0
+        if state is not None:
+            pos = self.restore(state)
         self.fill(num_songs)
 
         if len(self.songs) > 0:
-            next_song = self.songs[0]
-            self.open_file = open(os.path.join(SONG_DIR, next_song), "rb")
-            # throw out wav header
-            _ = self.open_file.read(44)
-    
-    def __del__(self):
-        if self.open_file:
-            self.open_file.close()
+            self.open_song(self.songs[0])
+            align = self.song.fmt.block_align
+            self.pos = min(pos, len(self.song)) // align * align
 
 
     # fill()
-    # for each song retrieved from SongFetcher query, download its audio
-    # byte data and append it to songs list 
+    # asks the Prefetch scheduler for the songs the channel is missing to
+    # have num_songs; doesn't wait for them, so building a channel never
+    # blocks on the network
     def fill(self, num_songs=SONG_LIST_SIZE):
-        search_results = sf.search(self.query, num_songs)
-        for result in search_results:
-            song = sf.download_song(result)
-            if song is None:
-                continue
-            self.songs.append(song)
-    
+        get_scheduler().request(self, num_songs)
+
+
+    # restore()
+    # takes back the song list of a snapshot's state (see state()), minus
+    # songs no longer in the store; returns the offset to play the first
+    # song from, or 0 if it's gone
+    def restore(self, state):
+        store = get_store()
+        saved = state.get("songs", [])
+        self.songs = [song for song in saved if isinstance(song, str) and store.has(song)]
+        if len(self.songs) > 0 and self.songs[0] == saved[0]:
+            return state.get("pos", 0)
+        return 0
+
+
+    # state()
+    # what a snapshot keeps of the channel: its query, its song list (by
+    # the names streamed songs are stored under) and its current song's
+    # playhead. streams still decoding aren't stored yet, so they're left
+    # out; a stored stream's playhead skips the silence the store trimmed
+    def state(self):
+        songs = [resolve(song) for song in self.songs]
+        pos = self.pos
+        if self.song is None or (len(songs) > 0 and songs[0] is None):
+            pos = 0
+        elif isinstance(self.song, GrowingSong):
+            pos = max(0, pos - self.song.lead)
+        return {"query": self.query, "songs": [song for song in songs if song is not None],
+                "pos": pos}
+
+
+    # start()
+    # opens a warming channel's first song once a fetch has delivered it;
+    # False while there's none yet
+    def start(self):
+        self.take_ready()
+        if len(self.songs) == 0:
+            return False
+        self.open_song(self.songs[0])
+        print(f"Channel {self.query} is ready.")
+        return True
 
+
+    # next()
+    # switches to the next song on disk. the finished song is looped only
+    # while there aren't SONG_LIST_SIZE songs to play; with nothing else on
+    # disk, the current song restarts. streams discarded since they were
+    # delivered are dropped; with no song left, the channel warms up again
     def next(self):
-        if self.open_file:
-            self.open_file.close()
-        
+        self.take_ready()
+        finished = self.songs.pop(0)
+        self.played.add(finished)
+        if len(self.songs) < SONG_LIST_SIZE:
+            self.songs.append(finished)
+        if any(stream_failed(song) for song in self.songs):
+            self.songs = [song for song in self.songs if not stream_failed(song)]
+
+        get_scheduler().request(self, READY_AHEAD)
         if len(self.songs) == 0:
-            self.fill()
+            self.song = None
+            return
+        self.open_song(self.songs[0])
+
+
+    # request_query()
+    # queues a vibe request from the client on com_sock. a request made
+    # before the last one's fetch has started replaces it, so a burst of
+    # requests costs one fetch
+    def request_query(self, query, com_sock, now):
+        get_metrics().inc("vibe_requests_total")
+        key = query_key(query)
+        if self.pending_query is None and key == query_key(self.query):
+            self.updates.append(([com_sock], {"q": self.query, "s": "done"}))
+            return
+        if self.pending_query is not None and key == query_key(self.pending_query):
+            if com_sock not in self.requesters:     # already on its way
+                self.requesters.append(com_sock)
+            self.updates.append(([com_sock], self.progress("queued")))
+            return
+
+        if self.pending_query is not None:
+            get_metrics().inc("vibe_requests_replaced_total")
+            self.report("replaced")
+        self.pending_query = query
+        self.request_at = now + REQUEST_DEBOUNCE
+        self.incoming.clear()
+        self.requesters = [com_sock]
+        self.reported = 0
+        self.request_failed = False
+        self.report("queued")
+
+
+    # report()
+    # queues an update on pending_query for everyone who asked for it
+    def report(self, status):
+        self.updates.append((list(self.requesters), self.progress(status)))
+
+
+    # progress()
+    # S_REQ data telling requesters where pending_query stands
+    def progress(self, status):
+        return {"q": self.pending_query, "s": status,
+                "n": len(self.incoming), "of": REQUEST_READY}
+
+
+    # poll_request()
+    # moves pending_query along, on the audio loop: starts its fetch once
+    # the debounce is over, reports songs as they arrive, and switches to
+    # it once enough are ready, or gives up if its fetch found nothing
+    def poll_request(self, now):
+        if self.request_at is not None:
+            if now < self.request_at:
+                return
+            self.request_at = None
+            self.report("fetching")
+            get_scheduler().request(self, READY_AHEAD)
+
+        if len(self.incoming) > self.reported:
+            self.reported = len(self.incoming)
+            self.report("fetching")
+        if len(self.incoming) >= REQUEST_READY:
+            self.set_query()
+        elif self.request_failed:
+            self.report("failed")
+            self.pending_query = None
+            self.requesters = []
+
+
+    # set_query()
+    # switches the channel to pending_query and its fetched songs, cutting
+    # the current song short; songs queued for the old query are dropped.
+    # if every fetched song was a stream since discarded, it fetches again
+    def set_query(self):
+        songs = [song for song in self.incoming if not stream_failed(song)]
+        if len(songs) == 0:
+            self.incoming.clear()
+            self.reported = 0
+            get_scheduler().request(self, REQUEST_READY)
+            return
+        self.report("done")
+        self.query = self.pending_query
+        self.songs = songs
+        self.pending_query = None
+        self.requesters = []
+        self.incoming.clear()
+        self.ready.clear()
+        self.played = set()
+        self.cut_to(self.songs[0])
+        get_scheduler().request(self, READY_AHEAD)
+
+
+    # cut_to()
+    # switches to song mid-song: the current song fades out under song's
+    # faded-in head, or over CUT_SECONDS if it has none
+    def cut_to(self, song):
+        finished, pos = self.song, self.pos
+        self.bridge = None
+        self.open_song(song)
+        if finished is None or finished.fmt != self.song.fmt or not dsp.supports(finished.fmt):
+            return
+        fmt = finished.fmt
+        length = len(self.song.head) or int(fmt.byte_rate * CUT_SECONDS)
+        tail = finished.read(pos, min(length, len(finished) - pos))
+        tail = tail[:len(tail) - len(tail) % fmt.block_align]
+        if len(tail) == 0:
+            return
+        faded = dsp.fade(dsp.samples(tail, fmt.channels), False).tobytes()
+        mix, used = dsp.crossfade(faded, self.song.head)
+        self.bridge = memoryview(mix)
+        self.bridge_pos = 0
+        self.pos = used
+
+
+    # fetch_query()
+    # the query background fetches are for: a pending vibe request's, or
+    # the channel's own
+    def fetch_query(self):
+        return self.query if self.pending_query is None else self.pending_query
+
+
+    # wants()
+    # True if a fetch for the query with key should go on for this channel
+    def wants(self, key, num_ready):
+        return (query_key(self.fetch_query()) == key and not self.fetches_paused()
+                and self.needed(num_ready) > 0)
+
+
+    # fetch_ended()
+    # called by fetch workers when a fetch for query is over; a vibe
+    # request whose fetch ended without a song has failed
+    def fetch_ended(self, query):
+        pending = self.pending_query
+        if (pending is not None and self.request_at is None and not self.fetches_paused()
+                and not self.incoming and query_key(query) == query_key(pending)):
+            self.request_failed = True
+
+
+    # deliver()
+    # called by fetch workers with a stored song for query; dropped if
+    # the channel's query has changed since the fetch started
+    def deliver(self, query, song):
+        key = query_key(query)
+        if self.pending_query is not None:
+            if key == query_key(self.pending_query):
+                self.incoming.append(song)
+        elif key == query_key(self.query):
+            self.ready.append(song)
+
+
+    # take_ready()
+    # moves delivered songs onto the song list; runs on the audio loop, so
+    # only it ever modifies songs
+    def take_ready(self):
+        while self.ready:
+            # onto songs before off ready, so songs_in_use() never misses it
+            song = self.ready[0]
+            if song not in self.songs and not stream_failed(song):
+                self.songs.append(song)
+            self.ready.popleft()
 
-        # Rotate song list
-        self.songs = self.songs[1:] + self.songs[:1]
 
-        next_song = self.songs[0]
-        self.open_file = open(os.path.join(SONG_DIR, next_song), "rb")
-        # Throw out wav header
-        _ = self.open_file.read(44)
+    # needed()
+    # how many more unplayed songs the channel needs to have num_ready; of
+    # a pending vibe request's once its fetch may start
+    def needed(self, num_ready=READY_AHEAD):
+        if self.pending_query is not None:
+            return 0 if self.request_at is not None else num_ready - len(self.incoming)
+        unplayed = [s for s in self.songs[1:] if s not in self.played]
+        return num_ready - len(unplayed) - len(self.ready)
+
+
+    # has_song()
+    # True if song is already queued or delivered for this channel
+    def has_song(self, song):
+        if self.pending_query is not None:
+            return song in self.incoming
+        return song in self.songs or song in self.played or song in self.ready
+
+
+    # remaining()
+    # seconds left in the current song
+    def remaining(self):
+        if self.song is None:
+            return 0
+        return (len(self.song) - self.pos) / self.song.fmt.byte_rate
+
+
+    # open_song()
+    # switches to a stored song (or one still streaming in) from its start,
+    # and paces the channel at the byte rate given in the song's fmt chunk
+    def open_song(self, song):
+        self.song = open_stream(song)
+        if self.song is None:
+            self.song = get_store().open(resolve(song))
+        self.pos = 0
+        self.pacer.set_rate(self.song.fmt.byte_rate)
+        sf.get_cache().touch(resolve(song))
+
+
+    # read_frame()
+    # returns the next frame_len bytes of audio, rolling over to the next
+    # song when the current one runs out. within a song the frame is a
+    # zero-copy view of the store; only frames spanning two songs or a
+    # crossfade are copied. a song still streaming in that hasn't decoded
+    # the next frame yet gets silence, without moving the playhead
+    def read_frame(self, frame_len=pack.AUDIO_PACK):
+        if self.ready:
+            self.take_ready()
+        if self.song is None:
+            return bytes(frame_len)
+        if self.bridge is None:
+            frame = self.song.read(self.pos, min(frame_len, self.stop() - self.pos))
+            if len(frame) == frame_len:
+                self.pos += frame_len
+                return frame
+            if not self.song.complete:
+                return bytes(frame_len)
+
+        parts = []
+        missing = frame_len
+        switches = 0
+        while missing > 0:
+            if self.bridge is not None:
+                part = self.bridge[self.bridge_pos : self.bridge_pos + missing]
+                self.bridge_pos += len(part)
+                if self.bridge_pos >= len(self.bridge):
+                    self.bridge = None
+            else:
+                part = self.song.read(self.pos, min(missing, self.stop() - self.pos))
+                self.pos += len(part)
+                if len(part) == 0:
+                    # try each song once, in case every song on the list is empty
+                    if not self.song.complete or switches > len(self.songs):
+                        break
+                    self.switch()
+                    switches += 1
+                    if self.song is None:
+                        break
+                    continue
+            parts.append(part)
+            missing -= len(part)
+        parts.append(bytes(missing))
+        return b"".join(parts)
+
+
+    # stop()
+    # byte offset where the current song hands over to the next: where its
+    # crossfade tail starts, or its end if it has none
+    def stop(self):
+        return len(self.song) - len(self.song.tail)
+
+
+    # switch()
+    # moves on from a song that has played to its stop(). the next song
+    # starts with a crossfade: the finished song's faded-out tail summed
+    # with the next song's faded-in head, both precomputed at ingest, after
+    # which the next song carries on past its head. songs in different
+    # formats can't be mixed, so the tail is cut instead
+    def switch(self):
+        finished = self.song
+        self.next()
+        if self.song is None:
+            return
+        if len(finished.tail) > 0 and finished.fmt == self.song.fmt:
+            mix, used = dsp.crossfade(finished.tail, self.song.head)
+            self.bridge = memoryview(mix)
+            self.bridge_pos = 0
+            self.pos = used
+
+
+    # behind()
+    # seconds this channel's stream is behind real time
+    def behind(self):
+        return self.pacer.behind()
+
+
+    # due()
+    # how many frames the channel should send now. a channel without
+    # listeners is paused instead, and sends nothing until one joins
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        if not self.clients:
+            self.pause(now)
+            return 0
+        if self.idle_since is not None:
+            self.resume(now)
+        if self.pending_query is not None:
+            self.poll_request(now)
+        if self.song is None and not self.start():
+            return 0
+        return self.pacer.due(now)
+
+
+    # wait_time()
+    # seconds until the channel next needs the server loop: until its next
+    # frame is due, or its next check for a first song while it warms up
+    def wait_time(self):
+        if self.song is None:
+            return WARM_POLL
+        return self.pacer.wait_time()
+
+
+    # idle()
+    # True while the channel is paused for lack of listeners
+    def idle(self):
+        return self.idle_since is not None
+
+
+    # fetches_paused()
+    # True if background fetches should wait for this channel: it's idle,
+    # and has a song to resume with. a channel still warming up goes on
+    # fetching its first songs, listeners or not
+    def fetches_paused(self):
+        return self.idle() and self.song is not None
+
+
+    # pause()
+    # stops the channel's stream, remembering when
+    def pause(self, now):
+        if self.idle_since is None:
+            self.idle_since = now
+            self.pacer.deadline = None
+            self.recent.clear()
+
+
+    # resume()
+    # restarts a paused channel at its virtual playhead: the position it
+    # would have reached had it played through the time it was idle,
+    # switching songs as it would have. once its song list only loops,
+    # whole laps are skipped at once, so this takes at most a few song
+    # switches however long the channel sat idle
+    def resume(self, now):
+        ahead = now - self.idle_since
+        self.idle_since = None
+        self.bridge = None
+        whole = False   # the song playing was played from its start
+        lapped = False  # whole laps have been skipped
+        lap = 0.0       # seconds per pass through a looping song list
+        lap_songs = 0
+        while ahead > 0 and self.song is not None:
+            rate = self.song.fmt.byte_rate
+            left = max(0, self.stop() - self.pos) / rate
+            if ahead < left or not self.song.complete:
+                step = min(int(ahead * rate), max(0, len(self.song) - self.pos))
+                self.pos += step - step % self.song.fmt.block_align
+                break
+
+            finished = self.song
+            self.next()
+            played = left
+            if len(finished.tail) > 0 and finished.fmt == self.song.fmt:
+                self.pos = min(len(finished.tail), len(self.song.head))
+                played += len(finished.tail) / rate
+            ahead -= played
+
+            if whole and not lapped and len(self.songs) <= SONG_LIST_SIZE and not self.ready:
+                lap += played
+                lap_songs += 1
+                if lap_songs == len(self.songs):
+                    if lap <= 0:
+                        break   # every song is empty
+                    ahead %= lap
+                    lapped = True
+            else:
+                lap, lap_songs = 0.0, 0     # the song list changed: start over
+            whole = True
+        get_scheduler().request(self, READY_AHEAD)
 
 
 # class Server
@@ -115,15 +592,27 @@ class Channel:
 #
 class Server:
     host_s: socket.socket
-    clients: list[socket.socket]
+    clients: set[socket.socket]
     channels: list[Channel]
+    sessions: Sessions  # paired clients, by socket, name and channel
+    fanout: FanOut  # per-listener audio outboxes
 
-    def __init__(self, host_port):
+    def __init__(self, host_port, slow_policy=POLICY_DROP, max_behind_ms=MAX_BEHIND_MS):
         self.host_s = 0
-        self.clients = [] # list of client sockets
+        self.clients = set() # client sockets, paired or not
         self.channels = [] # list of channels
-        self.client_map = {}    # maps client com c_s's to audio c_s's
-        self.name_map = {}     # maps client audio c_s's to their name
+        self.sessions = Sessions()
+        self.fanout = FanOut(slow_policy, max_behind_ms)
+        self.decoders = {}  # maps client c_s's to their PacketDecoder
+        self.audio_formats = {} # maps unpaired com c_s's to their audio format
+        self.audio_variants = {}    # ...and to their Resample variant
+        self.metrics = get_metrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        self.fanout_time = self.metrics.histogram("fanout_seconds")
+        self.loop_lag = self.metrics.histogram("loop_lag_seconds")
+        self.snapshot_at = None # monotonic time of the next channel snapshot
+        if host_port is None:   # clients are handed over, not accepted
+            return
 
         print("About to open the server socket.")
         # basic server functionality
@@ -138,18 +627,21 @@ class Server:
 
 
     def __del__(self):
-        self.host_s.close()
+        if isinstance(self.host_s, socket.socket):
+            self.host_s.close()
 
 
     # move_client()
-    # moves client from their current channel to new channel, new_ch
-    def move_client(self, client, new_ch: Channel):
-        # TODO: make faster
-        for channel in self.channels:
-            if client in channel.clients:
-                channel.clients.remove(client)
-        new_ch.clients.append(client)
-        
+    # moves a client from their current channel to new channel, new_ch
+    def move_client(self, session, new_ch: Channel):
+        if session.channel is not new_ch:
+            session.joins += 1
+            self.sessions.move(session, new_ch)
+            start = self.fanout.join(session.aud, new_ch.recent, switch=True,
+                                     variants=new_ch.variants)
+            if start is not None:
+                self.send_packet(session.com, pack.S_FLUSH, start)
+
         print(f"Client moved to channel {new_ch.query}")
         self.print_channels()
 
@@ -159,76 +651,197 @@ class Server:
     def print_channels(self):
         for channel in self.channels:
             # TODO: not printing out length of channel?
-            print(f"Channel {channel.query}: {len(channel.clients)} clients")
+            if channel.idle():
+                print(f"Channel {channel.query}: idle")
+                continue
+            lag_ms = channel.behind() * 1000
+            print(f"Channel {channel.query}: {len(channel.clients)} clients, {lag_ms:.0f} ms behind")
         print("-" * 20)
 
 
+    # collect_metrics()
+    # Metrics collector: reads the figures channels, outboxes, sessions and
+    # caches keep anyway, as (name, labels, value). may run on the metrics
+    # endpoint's thread, so live containers are copied before iterating
+    def collect_metrics(self):
+        sessions = list(self.sessions.by_name.values())
+        samples = [("clients", (), len(sessions))]
+        for index, channel in enumerate(list(self.channels)):
+            labels = (("channel", index), ("query", channel.query))
+            samples += [
+                ("channel_frames_sent_total", labels, channel.frames_sent),
+                ("channel_bytes_sent_total", labels, channel.bytes_sent),
+                ("channel_listeners", labels, len(channel.clients)),
+                ("channel_variants", labels, len(channel.variants.resamplers)),
+                ("channel_idle", labels, int(channel.idle())),
+                ("channel_behind_seconds", labels, round(channel.behind(), 4)),
+                ("channel_skipped_frames_total", labels, channel.pacer.skipped),
+            ]
+        for session in sessions:
+            labels = (("client", session.name),)
+            samples.append(("client_packets_total", labels, session.packets))
+            outbox = self.fanout.outboxes.get(session.aud)
+            if outbox is None:
+                continue
+            samples += [
+                ("client_bytes_sent_total", labels, outbox.sent),
+                ("client_frames_sent_total", labels, outbox.frames_sent),
+                ("client_partial_writes_total", labels, outbox.partials),
+                ("client_dropped_frames_total", labels, outbox.dropped),
+                ("client_queued_bytes", labels, outbox.queued),
+            ]
+
+        if Prefetch.SCHEDULER is not None:
+            samples.append(("fetch_queue_depth", (), Prefetch.SCHEDULER.queue_depth()))
+        if sf.CACHE is not None:    # not opened yet, e.g. in a shard supervisor
+            samples += [("song_cache_hits_total", (), sf.CACHE.hits),
+                        ("song_cache_misses_total", (), sf.CACHE.misses)]
+        samples += [("search_cache_hits_total", (), sf.SEARCHES.hits),
+                    ("search_cache_misses_total", (), sf.SEARCHES.misses)]
+        return samples
+
+
+    # songs_in_use()
+    # returns the set of songs on any channel's song list, or delivered to
+    # a channel but not yet on its list. called from fetch workers while the
+    # audio loop changes these lists, so each is copied (atomically) first
+    def songs_in_use(self):
+        in_use = set()
+        for channel in self.channels:
+            in_use.update(resolve(song) for song in list(channel.songs))
+            in_use.update(resolve(song) for song in channel.ready.copy())
+            in_use.update(resolve(song) for song in channel.incoming.copy())
+        return in_use
+
+
+    # send_packet()
+    # writes a control packet to one client socket; engines that don't own
+    # blocking sockets override this to queue the packet instead
+    def send_packet(self, this_sock, type, data):
+        return pack.write_packet(this_sock, type, data, self.codec(this_sock))
+
+
+    # codec()
+    # returns the packet codec a client socket uses, both ways
+    def codec(self, this_sock):
+        decoder = self.decoders.get(this_sock)
+        return pack.CODEC_JSON if decoder is None else decoder.codec
+
+
+    # negotiate()
+    # picks the first packet codec and audio format in the client's C_INIT
+    # options that this server supports, and the sample rate and channels
+    # it asked for, if any, and confirms them with S_YES (still in JSON).
+    # the codec is used on this socket from the next packet on, the audio
+    # format and variant once the client's audio socket pairs
+    def negotiate(self, this_sock, options):
+        if not isinstance(options, dict):
+            options = {}
+        offered = options.get("codecs", [])
+        codec = next((c for c in offered if c in pack.CODECS), pack.CODEC_JSON)
+        audio = ac.pick(options.get("audio", []))
+        variant = Resample.pick(options)
+        reply = {"codec": codec, "audio": audio}
+        if variant is not None:
+            reply["rate"], reply["channels"] = variant
+        self.send_packet(this_sock, pack.S_YES, reply)
+        self.decoders[this_sock].codec = codec
+        self.audio_formats[this_sock] = audio
+        self.audio_variants[this_sock] = variant
+
+
     # write_song_packets()
-    # constructs and writes a packet of audio data to each client in the channel
+    # reads one frame of the channel's current song, and fans it out to
+    # every client in the channel without blocking on any of them
     def write_song_packets(self, channel):
         # create a packet of data for this channel's current song
-        data = channel.open_file.read(pack.AUDIO_PACK)
-
-        while len(data) < pack.AUDIO_PACK:
-            channel.next()
-            data += channel.open_file.read(pack.AUDIO_PACK - len(data))
-        
-        # write packet to each client on this channel
-        for (com_sock, aud_sock) in channel.clients:
-            try:
-                num_sent = aud_sock.send(data)
-                return num_sent
-            except Exception:
-                print(f"Client disconnected")
-                self.disconnect_client(channel, com_sock)
-                self.print_channels()
-
-
-    def broadcast_chat(self, msg, client_socks):
-        sender_name = self.name_map[client_socks[1]]
-        # TODO: make faster
-        for channel in self.channels:
-            if client_socks in channel.clients:     # broadcast to this Channel
-                for (c_s, a_s) in channel.clients:
-                    full_msg = f"<{sender_name}> {msg}"
-                    pack.write_packet(c_s, pack.S_MSG, full_msg)
-                break
+        data = channel.read_frame(pack.AUDIO_PACK)
+        if channel.song is None:    # ran out of songs: warming up again
+            return
+
+        start = time.perf_counter()
+        sent = self.fanout.bytes_sent
+        fmt = channel.song.fmt
+        gone = self.fanout.broadcast(data, channel.clients, channel.pacer.frame_time,
+                                     channel.variants, (fmt.sample_rate, fmt.channels),
+                                     channel.recent)
+        self.fanout_time.observe(time.perf_counter() - start)
+        channel.frames_sent += 1
+        channel.bytes_sent += self.fanout.bytes_sent - sent
+        for session in gone:
+            self.disconnect_client(session)
+        if len(gone) > 0:
+            self.print_channels()
+
+
+    # broadcast_chat()
+    # sends a chat message to everyone on the sender's channel
+    def broadcast_chat(self, msg, session):
+        session.chats += 1
+        full_msg = f"<{session.name}> {msg}"
+        for member in list(session.channel.clients):
+            self.send_packet(member.com, pack.S_MSG, full_msg)
 
 
     # help_handle_cinit
     # handles C_INIT packet
     def help_handle_cinit(self, data, this_sock):
-        # data[0] is "com" or "aud", data[1] is temp nonce, data[2] is name
-        if data[1] == "com" and data[2] in self.name_map.values():
-            pack.write_packet(this_sock, S_ERR, "Username " + data[2] + " already taken.")
+        # data[0] is "com" or "aud", data[1] is temp nonce, data[2] is name,
+        # data[3] (optional, com only) is the client's options, e.g. codecs
+        if data[0] == "com" and self.name_taken(data[2]):
+            self.send_packet(this_sock, pack.S_ERR, "Username " + data[2] + " already taken.")
             return  # don't save if name taken, force client to resend
+        if data[0] == "com" and len(data) > 3:
+            self.negotiate(this_sock, data[3])
 
         nonce = data[1]
         name = data[2]
-        # if nonce value is in map, finish the com : audio mapping
-        if nonce in self.client_map:
-            # if com socket connected first
-            aud_sock = 0
-            com_sock = 0
-            if self.client_map[nonce][0] == "com":
-                com_sock = self.client_map[nonce][1]
-                # map com sock to audio sock
-                self.client_map[com_sock] = this_sock
-                aud_sock = this_sock
-
-            elif self.client_map[nonce][0] == "aud":
-                aud_sock = self.client_map[nonce][1]
-                # map com sock to audio sock
-                self.client_map[this_sock] = aud_sock
-
-            self.client_map.pop(nonce)
-            # add client's audio socket to lobby channel
-            self.channels[0].clients.append((com_sock, aud_sock))
-            self.name_map[aud_sock] = name
-            self.print_channels()
-        else:
-            # map nonce to first socket, and type of first socket
-            self.client_map[nonce] = [data[0], this_sock]
+        # if nonce value is pending, the other socket already sent C_INIT
+        first = self.sessions.pending.pop(nonce, None)
+        if first is None:
+            # remember the first socket, and its type, until the other arrives
+            self.sessions.pending[nonce] = (data[0], this_sock)
+            return
+        com_sock, aud_sock = (first[1], this_sock) if first[0] == "com" else (this_sock, first[1])
+
+        # another client may have paired with the same name since this one's
+        # com C_INIT was accepted: reject it, and let the client resend
+        if self.name_taken(name):
+            self.send_packet(com_sock, pack.S_ERR, "Username " + name + " already taken.")
+            self.drop_socket(aud_sock)
+            return
+        self.add_client(com_sock, aud_sock, name)
+
+
+    # add_client()
+    # starts streaming to a client whose com and audio sockets have paired,
+    # from the lobby channel
+    def add_client(self, com_sock, aud_sock, name):
+        audio = self.audio_formats.pop(com_sock, ac.FORMAT_PCM)
+        variant = self.audio_variants.pop(com_sock, None)
+        session = ClientSession(com_sock, aud_sock, name, audio, variant)
+        self.fanout.add(aud_sock, audio, variant)
+        self.sessions.add(session, self.channels[0])
+        self.fanout.join(aud_sock, self.channels[0].recent, variants=self.channels[0].variants)
+        self.print_channels()
+
+
+    # name_taken()
+    # True if a connected client already uses name
+    def name_taken(self, name):
+        return name in self.sessions.by_name
+
+
+    # client_names()
+    # names of every connected client, for S_INIT
+    def client_names(self):
+        return list(self.sessions.by_name)
+
+
+    # channel_list()
+    # queries of every channel, for S_INIT and S_LIST
+    def channel_list(self):
+        return [channel.query for channel in self.channels]
 
 
     # server_handle_packet()
@@ -236,125 +849,287 @@ class Server:
     def server_handle_packet(self, type, data, com_sock):
         if type == pack.C_INIT:
             self.help_handle_cinit(data, com_sock)
+            return
+
+        session = self.sessions.get(com_sock)
+        if session is None:     # hasn't finished C_INIT
+            return
+        session.packets += 1
 
-        elif type == pack.C_JOIN:
-            aud_sock = self.client_map[com_sock]
+        if type == pack.C_JOIN:
             for channel in self.channels:
                 if channel.query == data:
-                    self.move_client((com_sock, aud_sock), channel)
+                    self.move_client(session, channel)
                     return
                     
         elif type == pack.C_LIST:
             # send list of channels to client
-            pack.write_packet(com_sock, pack.S_LIST, [channel.query for channel in self.channels])
+            self.send_packet(com_sock, pack.S_LIST, self.channel_list())
 
         elif type == pack.C_REQ:
             # No request query given
             if len(data) == 0:
                 return
-            aud_sock = self.client_map[com_sock]
-            for channel in self.channels:
-                if (com_sock, aud_sock) in channel.clients:
-                    channel.query = data
-                    channel.songs = []
-                    channel.next()
-                    break
-            pack.write_packet(com_sock, pack.S_LIST, [channel.query for channel in self.channels])
-            self.print_channels()
+            session.channel.request_query(data, com_sock, time.monotonic())
 
         elif type == pack.C_MSG:
-            self.broadcast_chat(data, (com_sock, self.client_map[com_sock]))
+            self.broadcast_chat(data, session)
+
+    # send_updates()
+    # sends a channel's vibe request updates to the requesters still
+    # connected; once a request is done, they get the new channel list too
+    def send_updates(self, channel):
+        while channel.updates:
+            socks, data = channel.updates.popleft()
+            socks = [s for s in socks if s in self.clients]
+            for com_sock in socks:
+                self.send_packet(com_sock, pack.S_REQ, data)
+            if data["s"] == "done":
+                self.query_changed(channel)
+                for com_sock in socks:
+                    self.send_packet(com_sock, pack.S_LIST, self.channel_list())
+
+
+    # query_changed()
+    # called once a channel has switched to a requested vibe
+    def query_changed(self, channel):
+        self.print_channels()
+
 
     # disconnect_client
-    # removes a client from the given channel, and from the server
-    def disconnect_client(self, channel, com_sock):
-        # Try to find socket in client_map
-        aud_sock = self.client_map[com_sock]
-        channel.clients.remove((com_sock, aud_sock))
-        self.clients.remove(com_sock)
-        self.clients.remove(aud_sock)
-        self.client_map.pop(com_sock)
-        self.name_map.pop(aud_sock)
-
-        com_sock.close()
-        aud_sock.close()
+    # removes a client from their channel, and from the server
+    def disconnect_client(self, session):
+        self.forget_client(session)
+        session.com.close()
+        session.aud.close()
         # remove client if they disconnect
         print(f"Client disconnected")
 
 
+    # forget_client()
+    # removes every trace of a client from their channel and the server,
+    # without closing its sockets
+    def forget_client(self, session):
+        self.sessions.remove(session)
+        for this_sock in (session.com, session.aud):
+            self.clients.discard(this_sock)
+            self.decoders.pop(this_sock, None)
+        self.fanout.remove(session.aud)
+
+
+    # drop_socket()
+    # removes a socket whose peer hung up; paired clients are disconnected
+    # from their channel, unpaired sockets are just closed
+    def drop_socket(self, this_sock):
+        session = self.sessions.get(this_sock)
+        if session is not None:
+            self.disconnect_client(session)
+            self.print_channels()
+            return
+
+        # never paired: forget any half-finished C_INIT for this socket
+        self.sessions.forget_pending(this_sock)
+        self.decoders.pop(this_sock, None)
+        self.audio_formats.pop(this_sock, None)
+        self.audio_variants.pop(this_sock, None)
+        self.clients.discard(this_sock)
+        this_sock.close()
+
+
+    # handle_packets()
+    # handles every complete packet received on a client socket so far;
+    # returns False once the socket should be dropped
+    def handle_packets(self, this_sock):
+        decoder = self.decoders[this_sock]
+        for type, data in decoder.packets():
+            if type != -1:
+                self.server_handle_packet(type, data, this_sock)
+            else:
+                self.metrics.inc("packet_decode_errors_total")
+            if self.decoders.get(this_sock) is not decoder:
+                return True     # handed off or dropped by that packet
+        return not decoder.closed
+
+
     # connect_new_client()
     # accept a new client, add them to the lobby channel, and send them the
     # initial setup packet (before writing any audio data to them)
     def connect_new_client(self):
         new_c_s, c_addr = self.host_s.accept()
-        self.clients.append(new_c_s)    # add new client com socket
+        self.register_client(new_c_s)
+
+
+    # register_client()
+    # tracks an accepted client socket and sends it the S_INIT packet
+    def register_client(self, new_c_s):
+        self.clients.add(new_c_s)    # add new client com socket
+        self.decoders[new_c_s] = pack.PacketDecoder()
 
         # write setup packet to client, containing list of channel names
         # and list of current client usernames
-        names = list(self.name_map.values())
-        data = {"c":[c.query for c in self.channels], "n":names}
-        pack.write_packet(new_c_s, pack.S_INIT, data)
+        names = self.client_names()
+        data = {"c":self.channel_list(), "n":names}
+        self.send_packet(new_c_s, pack.S_INIT, data)
 
 
-    # run_server()
-    # given a port, runs ( name ) server: writes file in pack.AUDIO_PACK
-    # packets to client
-    def run_server(self, num_channels=4):
-        bitrate = 44100
-        send_delay = (pack.AUDIO_PACK / 8) / bitrate
+    # handle_admin_input()
+    # handles one line typed on the server's stdin console; returns False
+    # once the server should shut down
+    def handle_admin_input(self, str_in):
+        if str_in == CLOSE:
+            return False
+        elif str_in == "cache":
+            print("songs: " + " ".join(f"{k}={v}" for k, v in sf.get_cache().stats().items()))
+            print("search: " + " ".join(f"{k}={v}" for k, v in sf.SEARCHES.stats().items()))
+        elif str_in == "stats":
+            print("\n".join(self.metrics.summary()))
+        elif str_in == "clients":
+            for session in self.sessions:
+                print(f"{session.name}: " + " ".join(f"{k}={v}" for k, v in session.stats().items()))
+            print(f"{len(self.sessions)} clients")
+        return True
 
-        print("We've initialized our server.")
+
+    # build_channels()
+    # builds the lobby, then one channel per seed; seeds whose channel
+    # comes up with no songs are dropped
+    def build_channels(self, num_channels):
         # Build list of playlists
         # Each playlist will be used for a channel
         # The first channel will be the lobby
-        self.channels.append(Channel(LOBBY_QUERY, 1))
-        for seed in get_seeds(num_channels):
-            new_channel = Channel(seed, SONG_LIST_SIZE)
-            if len(new_channel.songs) == 0:
-                print(f"Channel failed to construct: {seed}")
-                continue
-            self.channels.append(new_channel)
-        # self.channels.extend([Channel(seed, 2) for seed in get_seeds(num_channels)])
+        # channels are restored from the last snapshot where there is one,
+        # and warm up in the background, so this doesn't wait on the network
+        sf.get_cache().pinned = self.songs_in_use   # never evict playing songs
+        states = Snapshot.load()
+        for index, query in enumerate([LOBBY_QUERY] + get_seeds(num_channels)):
+            state = states.get(index)
+            if state is not None:
+                query = state["query"]
+            num_songs = 1 if index == 0 else SONG_LIST_SIZE
+            self.channels.append(Channel(query, num_songs, state))
 
         self.print_channels()
 
+
+    # indexed_channels()
+    # (index, channel) for every channel this server plays, numbered as in
+    # snapshots
+    def indexed_channels(self):
+        return list(enumerate(self.channels))
+
+
+    # save_snapshot()
+    # snapshots every channel, and schedules the next snapshot
+    def save_snapshot(self):
+        Snapshot.save(self.indexed_channels())
+        self.snapshot_at = time.monotonic() + Snapshot.SNAPSHOT_INTERVAL
+
+
+    # run_server()
+    # given a port, runs ( name ) server: writes file in pack.AUDIO_PACK
+    # packets to client
+    def run_server(self, num_channels=4):
+        print("We've initialized our server.")
+        self.build_channels(num_channels)
+        self.snapshot_at = time.monotonic() + Snapshot.SNAPSHOT_INTERVAL
+
         # TODO: while server doesn't recieve shutdown signal on STDIN
         while True:
+            now = time.monotonic()
             for channel in self.channels:
-                self.write_song_packets(channel)
+                num_due = channel.due(now)
+                if num_due > 0:
+                    self.loop_lag.observe(channel.pacer.late)
+                for _ in range(num_due):
+                    self.write_song_packets(channel)
+                if channel.updates:
+                    self.send_updates(channel)
+            if now >= self.snapshot_at:
+                self.save_snapshot()
 
-            # check for new clients and data from clients
-            choices = [self.host_s, sys.stdin] + self.clients
-            rlist, _, _ = select.select(choices, [], [], 0)
+            # check for new clients and data from clients, waiting no
+            # longer than until the next playing channel's frame is due
+            waits = [c.wait_time() for c in self.channels if not c.idle()]
+            timeout = min(waits + [pack.SEND_DELAY]) if waits else None
+            rlist, _, _ = select.select(self.watched(), [], [], timeout)
 
             for s in rlist:
-                # Server socket is ready to accept a new client
-                if s is self.host_s:
-                    self.connect_new_client()
-                # if CLOSE_SERVER is entered on comand line, kill server
-                elif s is sys.stdin:
-                    str_in = sys.stdin.readline().lower()[:-1]
-                    if str_in == CLOSE:
-                        return
-                else:
-                    type, data = pack.read_packet(s)  # read packet from s
-                    if type != -1:
-                        self.server_handle_packet(type, data, s)
-            
-            time.sleep(pack.SEND_DELAY)
-
-
-print("We're about to enter main.")
+                if not self.handle_readable(s):
+                    self.save_snapshot()
+                    return
+
+
+    # watched()
+    # the sockets and files run_server waits on
+    def watched(self):
+        return [self.host_s, sys.stdin] + list(self.clients)
+
+
+    # handle_readable()
+    # handles one readable socket or file from watched(); returns False
+    # once the server should shut down
+    def handle_readable(self, s):
+        # Server socket is ready to accept a new client
+        if s is self.host_s:
+            self.connect_new_client()
+        # if CLOSE_SERVER is entered on comand line, kill server
+        elif s is sys.stdin:
+            str_in = sys.stdin.readline().lower()[:-1]
+            return self.handle_admin_input(str_in)
+        # read whatever s has; a partial packet waits for the rest
+        elif s in self.decoders:
+            self.decoders[s].recv(s)
+            if not self.handle_packets(s):
+                self.drop_socket(s)
+        return True
+
+
 #
 # MAIN: get cmd-line arguments and run server
 #
-if len(sys.argv) != 2:
-    print("Usage: python3 Server.py <host port>")
-    quit()
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = dict((arg[2:].split("=", 1) + [""])[:2]
+                 for arg in sys.argv[1:] if arg.startswith("--"))
+    if (len(args) != 1 or any(flag not in SERVER_FLAGS for flag in flags)
+            or flags.get("slow", POLICY_DROP) not in SLOW_POLICIES
+            or ("shards" in flags and "async" in flags)):
+        print("Usage: python3 Server.py <host port> [--async | --shards=N] "
+              "[--slow=drop|skip|disconnect] [--slow-ms=N] [--metrics-port=N]")
+        quit()
+
+    host_port = int(args[0])
+    slow_policy = flags.get("slow", POLICY_DROP)
+    max_behind_ms = int(flags.get("slow-ms", MAX_BEHIND_MS))
+    cache_budget = None
+    if "cache-mb" in flags:
+        cache_budget = int(flags["cache-mb"]) * 1024 * 1024
+    metrics_port = int(flags["metrics-port"]) if "metrics-port" in flags else None
+    if "shards" in flags:
+        # each worker opens its own song cache once it has forked
+        from Shard import Supervisor
+        server = Supervisor(host_port, int(flags["shards"]), slow_policy,
+                            max_behind_ms, cache_budget=cache_budget,
+                            metrics_port=metrics_port)
+        if metrics_port is not None:
+            get_metrics().serve(metrics_port)
+        server.run_server()
+        print("Thank you for running the Server.")
+        return
+
+    if cache_budget is not None:
+        sf.get_cache().budget = cache_budget
+    if "async" in flags:
+        from AsyncServer import AsyncServer
+        server = AsyncServer(host_port, slow_policy, max_behind_ms)
+    else:
+        server = Server(host_port, slow_policy, max_behind_ms)
+    if metrics_port is not None:
+        get_metrics().serve(metrics_port)
 
-host_port = sys.argv[1]
-server = Server(int(host_port))
+    server.run_server()
+    print("˖⁺｡˚⋆˙" * 10)
+    print("Thank you for running the Server.")
 
-server.run_server()
-print("˖⁺｡˚⋆˙" * 10)
-print("Thank you for running the Server.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
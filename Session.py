@@ -0,0 +1,104 @@
+#
+# SESSION.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Registry of the clients connected to a Server. Each paired client is one
+# ClientSession, holding both its sockets, its name, its channel and a few
+# counters. Sessions are indexed by socket (com and audio), by name, and by
+# channel (each Channel's clients set), so finding, moving or dropping a
+# client never scans the channel list or every connected client. Clients
+# whose com and audio sockets haven't both sent C_INIT yet wait in pending,
+# by nonce.
+#
+
+import time
+
+
+# class ClientSession
+# one connected client; __slots__ keeps the per-client footprint small
+#
+class ClientSession:
+    __slots__ = ("com", "aud", "name", "audio", "variant", "channel",
+                 "connected", "packets", "chats", "joins")
+
+    def __init__(self, com, aud, name, audio, variant=None):
+        self.com = com          # control socket
+        self.aud = aud          # audio socket
+        self.name = name
+        self.audio = audio      # AudioCodec format of the audio socket
+        self.variant = variant  # Resample variant (rate, channels), or None
+        self.channel = None     # Channel the client listens to
+        self.connected = time.monotonic()
+        self.packets = 0        # control packets handled
+        self.chats = 0          # C_MSGs sent
+        self.joins = 0          # C_JOINs that changed channel
+
+    # stats()
+    # returns the session's counters, for the admin console
+    def stats(self):
+        return {
+            "channel": None if self.channel is None else self.channel.query,
+            "audio": self.audio, "variant": self.variant, "packets": self.packets,
+            "chats": self.chats, "joins": self.joins,
+            "up_s": round(time.monotonic() - self.connected),
+        }
+
+
+# class Sessions
+# socket -> session and name -> session indexes over every session, plus
+# each session's place in its channel's clients set
+#
+class Sessions:
+    by_sock: dict   # com or audio socket -> ClientSession
+    by_name: dict   # name -> ClientSession
+    pending: dict   # C_INIT nonce -> (socket type, socket) of the first half
+
+    def __init__(self):
+        self.by_sock = {}
+        self.by_name = {}
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __iter__(self):
+        return iter(self.by_name.values())
+
+    # get()
+    # returns the session a com or audio socket belongs to, or None
+    def get(self, this_sock):
+        return self.by_sock.get(this_sock)
+
+    # add()
+    # registers a paired client, listening to channel
+    def add(self, session, channel):
+        self.by_sock[session.com] = session
+        self.by_sock[session.aud] = session
+        self.by_name[session.name] = session
+        self.move(session, channel)
+
+    # move()
+    # moves a session from its channel (if any) to channel
+    def move(self, session, channel):
+        if session.channel is not None:
+            session.channel.clients.discard(session)
+        session.channel = channel
+        channel.clients.add(session)
+
+    # remove()
+    # forgets a session in every index
+    def remove(self, session):
+        if session.channel is not None:
+            session.channel.clients.discard(session)
+            session.channel = None
+        self.by_sock.pop(session.com, None)
+        self.by_sock.pop(session.aud, None)
+        if self.by_name.get(session.name) is session:
+            del self.by_name[session.name]
+
+    # forget_pending()
+    # drops a half-finished C_INIT for a socket that hung up
+    def forget_pending(self, this_sock):
+        for nonce, (_, sock) in list(self.pending.items()):
+            if sock is this_sock:
+                self.pending.pop(nonce)
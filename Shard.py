@@ -0,0 +1,469 @@
+#
+# SHARD.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Multi-process engine for the ( name ) server, selected with Server.py
+# --shards=N, so the server isn't capped at one core. A Supervisor process
+# accepts clients and runs the S_INIT / C_INIT handshake, then hands each
+# client's com and audio sockets (their file descriptors, passed over a
+# Unix socket) to one of N ShardWorker processes. Each worker owns a
+# disjoint set of channels, channel i living on worker i % N, and runs the
+# usual select loop over them and their clients. A client that joins a
+# channel on another worker is migrated: its worker hands its sockets back
+# to the supervisor, which passes them on to the channel's worker.
+#
+# The same Unix sockets are the control bus for everything else that
+# crosses processes: channel queries changed by C_REQ (for S_INIT and
+# S_LIST), the names of connected clients (for S_INIT and the duplicate
+# name check), and admin console commands. Chat stays on one worker,
+# since a channel's listeners all live on the worker that owns it. Each
+# worker keeps its own song cache and store under SONG_DIR/shard<n>, so
+# no two processes write the same index or segment files.
+#
+
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import traceback
+
+import SongFetcher as sf
+import SongStore
+import Metrics
+import Packet as pack
+import AudioCodec as ac
+import Snapshot
+from Session import ClientSession
+from Server import (Server, Channel, get_seeds, CLOSE, LOBBY_QUERY,
+                    SONG_LIST_SIZE)
+
+BUS_MAX = 256 * 1024    # largest control bus message
+BUS_FDS = 2             # most file descriptors sent with one message
+
+
+# class Bus
+# one end of a SOCK_SEQPACKET Unix socket pair between the supervisor and
+# a worker: each message is a JSON dict, with any sockets sent along
+#
+class Bus:
+    def __init__(self, sock):
+        self.sock = sock
+
+    # fileno()
+    # lets select() watch the bus
+    def fileno(self):
+        return self.sock.fileno()
+
+    # send()
+    # sends msg, passing the file descriptors of socks with it
+    def send(self, msg, socks=()):
+        data = json.dumps(msg).encode('utf-8')
+        if len(data) > BUS_MAX:
+            raise ValueError(f"bus message of {len(data)} bytes exceeds {BUS_MAX}")
+        socket.send_fds(self.sock, [data], [s.fileno() for s in socks])
+
+    # recv()
+    # returns the next message and the sockets sent with it; the message
+    # is None once the other process has gone
+    def recv(self):
+        data, fds, _, _ = socket.recv_fds(self.sock, BUS_MAX, BUS_FDS)
+        socks = [socket.socket(fileno=fd) for fd in fds]
+        if len(data) == 0:
+            return None, socks
+        return json.loads(data), socks
+
+
+# encode_bytes() / decode_bytes()
+# carry raw bytes (undecoded packets, part-sent audio) in bus messages
+def encode_bytes(data):
+    return base64.b64encode(data).decode('ascii')
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+
+# class ShardWorker
+# Server for one worker process: streams the channels it owns to the
+# clients the supervisor hands it, and hands clients back when they join
+# a channel owned by another worker
+#
+class ShardWorker(Server):
+    queries: dict   # global channel index -> query, on every worker
+    indexes: dict   # Channel owned here -> its global index
+
+    def __init__(self, shard, num_shards, bus, *args):
+        super().__init__(None, *args)
+        self.shard = shard
+        self.num_shards = num_shards
+        self.bus = bus
+        self.queries = {}
+        self.indexes = {}
+
+
+    # all_queries()
+    # global channel index -> query for every worker's channels, with this
+    # worker's own up to date
+    def all_queries(self):
+        queries = dict(self.queries)
+        for channel, index in self.indexes.items():
+            queries[index] = channel.query
+        return queries
+
+
+    # channel_list()
+    # every worker's channel queries, in channel order
+    def channel_list(self):
+        queries = self.all_queries()
+        return [queries[index] for index in sorted(queries)]
+
+
+    # print_channels()
+    # prints the channels this worker owns
+    def print_channels(self):
+        print(f"Shard {self.shard}:")
+        super().print_channels()
+
+
+    # build_channels()
+    # builds the channels the supervisor assigns this worker, restoring
+    # them from this worker's last snapshot where it has one, and reports
+    # back their queries
+    def build_channels(self, num_channels):
+        sf.get_cache().pinned = self.songs_in_use   # never evict playing songs
+        msg, _ = self.bus.recv()
+        states = Snapshot.load()
+        built = []
+        for index, query, num_songs in msg["channels"]:
+            state = states.get(index)
+            if state is not None:
+                query = state["query"]
+            channel = Channel(query, num_songs, state)
+            self.channels.append(channel)
+            self.indexes[channel] = index
+            built.append([index, query])
+
+        self.bus.send({"t": "built", "channels": built})
+        self.print_channels()
+
+
+    # indexed_channels()
+    # this worker's channels, by their global index
+    def indexed_channels(self):
+        return [(index, channel) for channel, index in self.indexes.items()]
+
+
+    # watched()
+    # the bus and this worker's clients; only the supervisor reads stdin
+    def watched(self):
+        return [self.bus] + list(self.clients)
+
+
+    # handle_readable()
+    # handles a message from the supervisor, or a client socket
+    def handle_readable(self, s):
+        if s is self.bus:
+            return self.handle_bus()
+        return super().handle_readable(s)
+
+
+    # handle_bus()
+    # handles one message from the supervisor; returns False once the
+    # worker should shut down
+    def handle_bus(self):
+        msg, socks = self.bus.recv()
+        if msg is None:
+            return False    # supervisor is gone
+        elif msg["t"] == "client":
+            self.adopt(msg, socks)
+        elif msg["t"] == "queries":
+            self.queries = {index: query for index, query in msg["channels"]}
+        elif msg["t"] == "admin":
+            return self.handle_admin_input(msg["line"])
+        return True
+
+
+    # adopt()
+    # takes over a client handed over by the supervisor, in the state its
+    # last owner left it: packet codec, audio format, bytes it had sent
+    # but not yet been handled, and the rest of a part-sent audio frame
+    def adopt(self, msg, socks):
+        com_sock, aud_sock = socks
+        channel = next((c for c, i in self.indexes.items() if i == msg["index"]), None)
+        if channel is None:
+            print(f"Shard {self.shard} doesn't own channel {msg['index']}")
+            self.bus.send({"t": "gone", "name": msg["name"]})
+            com_sock.close()
+            aud_sock.close()
+            return
+
+        self.clients.update((com_sock, aud_sock))
+        self.decoders[com_sock] = pack.PacketDecoder(msg["codec"])
+        self.decoders[com_sock].feed(decode_bytes(msg["pending"]))
+        self.decoders[aud_sock] = pack.PacketDecoder()
+        variant = None if msg.get("variant") is None else tuple(msg["variant"])
+        self.fanout.add(aud_sock, msg["audio"], variant, msg.get("sent", 0))
+        session = ClientSession(com_sock, aud_sock, msg["name"], msg["audio"], variant)
+        self.sessions.add(session, channel)
+        start = self.fanout.join(aud_sock, channel.recent, switch=msg["switch"],
+                                 partial=decode_bytes(msg["partial"]), variants=channel.variants)
+        if msg["switch"] and start is not None:
+            self.send_packet(com_sock, pack.S_FLUSH, start)
+
+        print(f"Client moved to channel {channel.query}")
+        self.print_channels()
+        if not self.handle_packets(com_sock):
+            self.drop_socket(com_sock)
+
+
+    # hand_off()
+    # migrates a client to the worker that owns channel index: it leaves
+    # this worker's state, and its sockets go to the supervisor
+    def hand_off(self, session, index):
+        outbox = self.fanout.outboxes.get(session.aud)
+        partial = b""
+        sent = 0 if outbox is None else outbox.sent
+        if outbox is not None and outbox.offset > 0:
+            partial = bytes(outbox.frames[0][outbox.offset:])
+        msg = {
+            "t": "client", "index": index, "name": session.name,
+            "codec": self.codec(session.com), "audio": session.audio,
+            "variant": session.variant,
+            "pending": encode_bytes(self.decoders[session.com].pending()),
+            "partial": encode_bytes(partial), "sent": sent, "switch": True,
+        }
+
+        self.forget_client(session)
+        try:
+            self.bus.send(msg, [session.com, session.aud])
+        except (ValueError, OSError) as e:
+            print(f"Couldn't migrate client {msg['name']}: {e}")
+            self.bus.send({"t": "gone", "name": msg["name"]})
+        session.com.close()    # the supervisor holds its own copies now
+        session.aud.close()
+        self.print_channels()
+
+
+    # server_handle_packet()
+    # C_JOIN to a channel on another worker migrates the client there;
+    # everything else is handled as usual
+    def server_handle_packet(self, type, data, com_sock):
+        if type == pack.C_JOIN:
+            index = next((i for i, query in sorted(self.all_queries().items()) if query == data), None)
+            session = self.sessions.get(com_sock)
+            if (session is not None and index is not None
+                    and index % self.num_shards != self.shard):
+                self.hand_off(session, index)
+                return
+
+        super().server_handle_packet(type, data, com_sock)
+
+
+    # query_changed()
+    # shares a channel's new vibe with the other workers
+    def query_changed(self, channel):
+        queries = [[index, owned.query] for owned, index in self.indexes.items()]
+        self.bus.send({"t": "queries", "channels": queries})
+        super().query_changed(channel)
+
+
+    # disconnect_client()
+    # also tells the supervisor the client's name is free again
+    def disconnect_client(self, session):
+        super().disconnect_client(session)
+        self.bus.send({"t": "gone", "name": session.name})
+
+
+# class Supervisor
+# Server that owns the listening socket: runs each client's handshake,
+# then hands it to the worker owning the lobby, and routes migrations and
+# control bus messages between workers
+#
+class Supervisor(Server):
+    buses: list     # Bus to each worker, by shard number
+    queries: dict   # global channel index -> query
+    names: set      # names of the clients on every worker
+
+    def __init__(self, host_port, num_shards, *args, cache_budget=None, metrics_port=None):
+        super().__init__(host_port, *args)
+        self.buses = []
+        self.pids = []
+        self.queries = {}
+        self.names = set()
+
+        for shard in range(num_shards):
+            mine, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                mine.close()
+                self.host_s.close()
+                for bus in self.buses:
+                    bus.sock.close()
+                run_worker(shard, num_shards, Bus(theirs), args, cache_budget, metrics_port)
+            theirs.close()
+            self.buses.append(Bus(mine))
+            self.pids.append(pid)
+
+
+    # channel_list()
+    # every worker's channel queries, in channel order
+    def channel_list(self):
+        return [self.queries[index] for index in sorted(self.queries)]
+
+
+    # save_snapshot()
+    # the supervisor owns no channels: each worker snapshots its own in
+    # its songs/shard<n>, so there's nothing to save here (saving would
+    # overwrite the snapshot a run without shards restores from)
+    def save_snapshot(self):
+        self.snapshot_at = time.monotonic() + Snapshot.SNAPSHOT_INTERVAL
+
+
+    # print_channels()
+    # prints each channel and the worker that owns it
+    def print_channels(self):
+        for index in sorted(self.queries):
+            print(f"Channel {self.queries[index]}: shard {index % len(self.buses)}")
+        print("-" * 20)
+
+
+    # build_channels()
+    # assigns the lobby and seed channels to workers, which build them in
+    # parallel; keeps the ones that came up with songs
+    def build_channels(self, num_channels):
+        plans = [[] for _ in self.buses]
+        for index, query in enumerate([LOBBY_QUERY] + get_seeds(num_channels)):
+            num_songs = 1 if index == 0 else SONG_LIST_SIZE
+            plans[index % len(self.buses)].append([index, query, num_songs])
+        for bus, plan in zip(self.buses, plans):
+            bus.send({"t": "build", "channels": plan})
+
+        for bus in self.buses:
+            msg, _ = bus.recv()
+            self.queries.update({index: query for index, query in msg["channels"]})
+        self.share_queries()
+        self.print_channels()
+
+
+    # share_queries()
+    # sends every worker the current channel queries
+    def share_queries(self):
+        channels = [[index, query] for index, query in self.queries.items()]
+        for bus in self.buses:
+            bus.send({"t": "queries", "channels": channels})
+
+
+    # name_taken()
+    # True if a client on any worker already uses name
+    def name_taken(self, name):
+        return name in self.names
+
+
+    # client_names()
+    # names of the clients on every worker
+    def client_names(self):
+        return list(self.names)
+
+
+    # add_client()
+    # hands a client whose handshake is done to the lobby's worker
+    def add_client(self, com_sock, aud_sock, name):
+        self.names.add(name)
+        msg = {
+            "t": "client", "index": 0, "name": name,
+            "codec": self.codec(com_sock),
+            "audio": self.audio_formats.get(com_sock, ac.FORMAT_PCM),
+            "variant": self.audio_variants.get(com_sock),
+            "pending": encode_bytes(self.decoders[com_sock].pending()),
+            "partial": "", "switch": False,
+        }
+
+        for this_sock in (com_sock, aud_sock):
+            self.clients.discard(this_sock)
+            self.decoders.pop(this_sock, None)
+        self.audio_formats.pop(com_sock, None)
+        self.audio_variants.pop(com_sock, None)
+
+        self.buses[0].send(msg, [com_sock, aud_sock])
+        com_sock.close()    # the worker holds its own copies now
+        aud_sock.close()
+
+
+    # watched()
+    # the listening socket, admin console, workers and unpaired clients
+    def watched(self):
+        return [self.host_s, sys.stdin] + self.buses + list(self.clients)
+
+
+    # handle_readable()
+    # handles a message from a worker, or anything the base server watches
+    def handle_readable(self, s):
+        if s in self.buses:
+            return self.handle_bus(s)
+        return super().handle_readable(s)
+
+
+    # handle_bus()
+    # handles one message from a worker
+    def handle_bus(self, bus):
+        msg, socks = bus.recv()
+        if msg is None:
+            print(f"Shard {self.buses.index(bus)} exited.")
+            return False
+        elif msg["t"] == "client":  # migrating to another worker
+            self.buses[msg["index"] % len(self.buses)].send(msg, socks)
+            for this_sock in socks:
+                this_sock.close()
+        elif msg["t"] == "gone":
+            self.names.discard(msg["name"])
+        elif msg["t"] == "queries":
+            self.queries.update({index: query for index, query in msg["channels"]})
+            self.share_queries()
+        return True
+
+
+    # handle_admin_input()
+    # passes each admin command on to every worker; on exit, waits for
+    # them to finish
+    def handle_admin_input(self, str_in):
+        for bus in self.buses:
+            bus.send({"t": "admin", "line": str_in})
+        if str_in == CLOSE:
+            for pid in self.pids:
+                os.waitpid(pid, 0)
+            return False
+        return True
+
+
+# run_worker()
+# body of a forked worker process: keeps its songs under its own
+# directory (the cache and store are written by whoever fetches, so
+# workers can't share one), and its metrics on the port after the
+# supervisor's (plus its shard number), runs a ShardWorker until told to
+# stop, then exits
+def run_worker(shard, num_shards, bus, args, cache_budget, metrics_port):
+    shard_dir = os.path.join(sf.SONG_DIR, f"shard{shard}")
+    sf.SONG_DIR = shard_dir
+    SongStore.STORE_DIR = os.path.join(shard_dir, "store")
+    Metrics.METRICS = None  # not the supervisor's
+
+    status = 0
+    try:
+        cache = sf.get_cache()
+        cache.budget = (cache_budget or cache.budget) // num_shards
+        worker = ShardWorker(shard, num_shards, bus, *args)
+        if metrics_port is not None:
+            Metrics.get_metrics().serve(metrics_port + 1 + shard)
+        worker.run_server()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(status)
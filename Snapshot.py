@@ -0,0 +1,63 @@
+#
+# SNAPSHOT.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Channel snapshots, so a restarted server picks up where it left off. The
+# server saves every channel's state (its query, its song list and where
+# in the current song it is, see Channel.state()) every SNAPSHOT_INTERVAL
+# seconds and on exit, to SNAPSHOT_FILE in the song directory. On startup
+# channels are rebuilt from it: songs still in the SongStore are played
+# straight from disk, and only the ones missing are fetched again.
+#
+
+import os
+import json
+import time
+
+import SongFetcher as sf
+
+SNAPSHOT_FILE = "channels.json"
+SNAPSHOT_INTERVAL = 30.0    # seconds between snapshots
+VERSION = 1
+
+
+# snapshot_path()
+# where the snapshot lives; looked up on each call, since shard workers
+# move SONG_DIR once they start
+def snapshot_path():
+    return os.path.join(sf.SONG_DIR, SNAPSHOT_FILE)
+
+
+# save()
+# writes the state of every (index, channel) pair. the file is replaced
+# atomically, so a crash mid-write leaves the last snapshot intact
+def save(channels):
+    snapshot = {
+        "version": VERSION,
+        "saved": time.time(),
+        "channels": {str(index): channel.state() for index, channel in channels},
+    }
+    path = snapshot_path()
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Couldn't save channel snapshot: {e}")
+
+
+# load()
+# returns the last snapshot's channel states by channel index, or an empty
+# dict if there's none (or it can't be read)
+def load():
+    try:
+        with open(snapshot_path(), "r") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Couldn't load channel snapshot: {e}")
+        return {}
+    if snapshot.get("version") != VERSION:
+        return {}
+    return {int(index): state for index, state in snapshot["channels"].items()}
@@ -0,0 +1,192 @@
+#
+# SONGCACHE.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Size-bounded LRU cache manager for the downloaded songs in SONG_DIR.
+# Songs are written to a temp file and renamed into place once complete,
+# so a half-written download is never served. Files are named by content
+# hash, so duplicate uploads of a track share one file. A persistent index
+# records which track ids map to which file, in least-recently-used order;
+# once the songs plus their SongStore copies exceed the disk budget, the
+# oldest songs that no Channel is using are evicted.
+#
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+CACHE_BUDGET = 2 * 1024 * 1024 * 1024   # bytes of songs to keep on disk
+INDEX_FILE = "cache.json"
+PART_EXT = ".part"  # suffix of songs still being written
+HASH_CHUNK = 1024 * 1024
+
+
+# file_hash()
+# returns the SHA-1 hex digest of a file's contents
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# class SongCache
+# tracks every complete song in song_dir, evicting the least recently used
+# unpinned songs once their total size passes budget
+#
+class SongCache:
+    files: OrderedDict  # filename -> {"hash", "size", "ids"}, oldest first
+    tracks: dict        # track id -> filename
+    pinned: callable    # returns the set of filenames currently in use
+    stored: callable    # returns bytes the SongStore's segments take on disk
+    on_evict: list      # callbacks given each evicted filename
+
+    def __init__(self, song_dir, budget=CACHE_BUDGET):
+        self.song_dir = song_dir
+        self.budget = budget
+        self.files = OrderedDict()
+        self.tracks = {}
+        self.pinned = lambda: set()
+        self.stored = lambda: 0
+        self.on_evict = []
+        self.lock = threading.RLock()
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(song_dir, exist_ok=True)
+        self.load()
+
+    # load()
+    # reads the persistent index, dropping entries whose files are gone,
+    # and deletes partial downloads left by a crash
+    def load(self):
+        for name in os.listdir(self.song_dir):
+            if name.endswith(PART_EXT):
+                os.remove(os.path.join(self.song_dir, name))
+
+        index_path = os.path.join(self.song_dir, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "r") as f:
+            files = json.load(f)
+
+        for filename, entry in files:
+            if os.path.exists(os.path.join(self.song_dir, filename)):
+                self.files[filename] = entry
+                self.size += entry["size"]
+                for id in entry["ids"]:
+                    self.tracks[id] = filename
+
+    # save()
+    # writes the index atomically, in LRU order
+    def save(self):
+        index_path = os.path.join(self.song_dir, INDEX_FILE)
+        with open(index_path + PART_EXT, "w") as f:
+            json.dump(list(self.files.items()), f)
+        os.replace(index_path + PART_EXT, index_path)
+
+    # part_path()
+    # returns the temp path to download a track's file of the given
+    # extension to, before handing it to add(); unique per thread, so two
+    # workers fetching the same track don't write over each other
+    def part_path(self, id, ext):
+        name = f"{id}.{threading.get_ident()}.{ext}{PART_EXT}"
+        return os.path.join(self.song_dir, name)
+
+    # lookup()
+    # returns the filename of a cached track and marks it recently used,
+    # or None on a miss
+    def lookup(self, id):
+        with self.lock:
+            filename = self.tracks.get(str(id))
+            if filename is None or not os.path.exists(os.path.join(self.song_dir, filename)):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.files.move_to_end(filename)
+            return filename
+
+    # touch()
+    # marks a cached file as recently used, e.g. when a Channel plays it
+    def touch(self, filename):
+        with self.lock:
+            if filename in self.files:
+                self.files.move_to_end(filename)
+
+    # add()
+    # moves a completely written file at part_path into the cache under its
+    # content hash, sharing it if an identical file is already cached
+    # returns the song's filename
+    def add(self, id, part_path, ext="wav"):
+        hash = file_hash(part_path)
+        filename = f"{hash[:20]}.{ext}"
+
+        with self.lock:
+            if filename in self.files:
+                os.remove(part_path)    # duplicate track: share the file
+            else:
+                size = os.path.getsize(part_path)
+                os.replace(part_path, os.path.join(self.song_dir, filename))
+                self.files[filename] = {"hash": hash, "size": size, "ids": []}
+                self.size += size
+
+            entry = self.files[filename]
+            if str(id) not in entry["ids"]:
+                entry["ids"].append(str(id))
+            self.tracks[str(id)] = filename
+            self.files.move_to_end(filename)
+
+            self.evict(keep=filename)
+            self.save()
+        return filename
+
+    # fit()
+    # evicts songs until the cache fits its budget again, e.g. once the
+    # store has grown; never evicts keep
+    def fit(self, keep=None):
+        with self.lock:
+            before = self.evictions
+            self.evict(keep)
+            if self.evictions != before:
+                self.save()
+
+    # evict()
+    # removes least recently used files until the cache fits its budget,
+    # skipping pinned files and keep. evicted songs leave the store too
+    # (see on_evict), so the store's bytes are looked at again each time
+    def evict(self, keep=None):
+        if self.size + self.stored() <= self.budget:
+            return
+        pinned = self.pinned()
+        for filename in list(self.files):
+            if self.size + self.stored() <= self.budget:
+                break
+            if filename == keep or filename in pinned:
+                continue
+
+            entry = self.files.pop(filename)
+            for id in entry["ids"]:
+                self.tracks.pop(id, None)
+            self.size -= entry["size"]
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.song_dir, filename))
+            except FileNotFoundError:
+                pass
+            for callback in self.on_evict:
+                callback(filename)
+
+    # stats()
+    # returns the cache's counters
+    def stats(self):
+        return {
+            "hits": self.hits, "misses": self.misses,
+            "evictions": self.evictions, "files": len(self.files),
+            "bytes": self.size, "stored": self.stored(), "budget": self.budget,
+        }
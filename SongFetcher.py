@@ -7,23 +7,63 @@
 
 import requests
 import os
+import time
+import threading
 import dotenv
 from pydub import AudioSegment
 import ffmpeg
 from urllib.parse import urlencode
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from SongCache import SongCache
 
 SONG_DIR = "songs"
 MAX_RETRIES = 5
+CACHE = None    # SongCache of downloaded songs, see get_cache()
+COUNTERS = threading.local()    # per-thread count of bytes fetched
+
+SEGMENT_WORKERS = 6     # HLS segments of one song fetched in parallel
+POOL_SIZE = 32          # kept-alive connections per host
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.1 Safari/605.1.15"
+
+# shared HTTP session: connections (and their TLS handshakes) are pooled
+# and reused across requests and threads
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = USER_AGENT
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE))
+SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE))
+SEGMENT_POOL = ThreadPoolExecutor(max_workers=SEGMENT_WORKERS * 2)
+
+# where the API and the site the client ID is scraped from live; point
+# both at a FakeSoundCloud to run offline
+API_BASE = os.environ.get("SOUNDCLOUD_API", "https://api-v2.soundcloud.com")
+SITE_BASE = os.environ.get("SOUNDCLOUD_SITE", "https://soundcloud.com")
+
+SEARCH_TTL = 300        # seconds a search result stays cached
+SEARCH_ENTRIES = 256    # most search results kept cached
+
+CLIENT_ID = None        # memoized SoundCloud client ID, see get_client_id()
+CLIENT_ID_LOCK = threading.Lock()
+
+
+# get_cache()
+# returns the SongCache managing SONG_DIR, opening it on first use
+def get_cache():
+    global CACHE
+    if CACHE is None:
+        CACHE = SongCache(SONG_DIR)
+    return CACHE
 
 # stubborn_get()
 # Given a url for a GET req, attempts up to MAX_RETRIES GET requests for
 # a successful response
 def stubborn_get(url):
-    response = requests.get(url, timeout=5)
+    response = SESSION.get(url, timeout=5)
     retries = 0
 
     while response.status_code != 200 and retries < MAX_RETRIES:
-        response = requests.get(url, timeout=5)
+        response = SESSION.get(url, timeout=5)
         retries += 1
         if response.status_code != 200:
             print(f"Failed to get {url}, retrying")
@@ -32,38 +72,130 @@ def stubborn_get(url):
 
         # bad authentication: try to regenerate the CLIENT_ID key
         if response.status_code == 401:
-            dotenv.unset_key(".env", "CLIENT_ID", quote_mode='always', encoding='utf-8')
-            get_client_id()     # re-get client ID, scraped from SoundCloud
+            refresh_client_id(CLIENT_ID)
+
+
+# fetched_bytes()
+# returns the number of response bytes the calling thread has fetched
+def fetched_bytes():
+    return getattr(COUNTERS, "bytes", 0)
 
 
 # sneaky_get()
 # Given a url for a GET request, makes a GET request to that url with a fake
-# user agent to avoid being blocked by SoundCloud ()
+# user agent to avoid being blocked by SoundCloud (), over the shared
+# connection pool
 def sneaky_get(url):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.1 Safari/605.1.15",
-    }
-    response = requests.get(url, headers=headers, timeout=5)
+    response = SESSION.get(url, timeout=5)
     retries = 0
 
     while response.status_code != 200 and retries < MAX_RETRIES:
         print(f"Failed to get {url} after {retries} retries, trying again")
-        # bad authentication: try to regenerate the CLIENT_ID key
+        # bad authentication: try to regenerate the CLIENT_ID key, and
+        # retry with the new one
         if response.status_code == 401:
-            dotenv.unset_key(".env", "CLIENT_ID", quote_mode='always', encoding='utf-8')
-            get_client_id()     # re-get client ID, scraped from SoundCloud
+            old_id = CLIENT_ID
+            new_id = refresh_client_id(old_id)
+            if old_id:
+                url = url.replace(f"client_id={old_id}", f"client_id={new_id}")
         
-        response = requests.get(url, timeout=5)
+        response = SESSION.get(url, timeout=5)
         retries += 1
 
+    COUNTERS.bytes = fetched_bytes() + len(response.content)
     return response
 
 
+# class SearchCache
+# TTL / LRU cache of search results, keyed on the normalized (query, limit,
+# genre). concurrent identical searches are coalesced: the first caller
+# makes the request, and the rest wait for its result
+#
+class SearchCache:
+    results: OrderedDict    # key -> (expiry time, results), oldest first
+    inflight: dict          # key -> threading.Event set once it's cached
+
+    def __init__(self, ttl=SEARCH_TTL, max_entries=SEARCH_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # searches that waited on an identical one
+
+    # get()
+    # returns the cached results for key, calling fetch() to fill the
+    # cache on a miss
+    def get(self, key, fetch):
+        while True:
+            with self.lock:
+                entry = self.results.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self.hits += 1
+                    self.results.move_to_end(key)
+                    return list(entry[1])
+
+                waiting = self.inflight.get(key)
+                if waiting is None:
+                    self.misses += 1
+                    done = self.inflight[key] = threading.Event()
+                    break
+                self.coalesced += 1
+            waiting.wait()
+            # loop: take the leader's result from the cache, or lead a
+            # retry if its search failed
+
+        results = None
+        try:
+            results = fetch()
+        finally:
+            with self.lock:
+                if results:     # failed searches aren't cached
+                    self.results[key] = (time.monotonic() + self.ttl, results)
+                    self.results.move_to_end(key)
+                    while len(self.results) > self.max_entries:
+                        self.results.popitem(last=False)
+                self.inflight.pop(key)
+            done.set()
+        return list(results)
+
+    # stats()
+    # returns the cache's counters, for sizing it
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits, "misses": self.misses,
+                "coalesced": self.coalesced, "entries": len(self.results),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+SEARCHES = SearchCache()
+
+
+# search_key()
+# normalizes a search, so queries differing only in case and spacing share
+# a cache entry
+def search_key(query, limit, genre):
+    return (" ".join(query.lower().split()), limit, " ".join(genre.lower().split()))
+
+
 # search()
 # given a search query and limit on max # of results to return, makes a GET
-# req to the SoundCloud API
+# req to the SoundCloud API, unless the same search was made recently
 # returns a JSON response with elements:
 def search(query, limit=10, genre=""):
+    return SEARCHES.get(search_key(query, limit, genre),
+                        lambda: fetch_search(query, limit, genre))
+
+
+# fetch_search()
+# makes the search request behind search()
+def fetch_search(query, limit, genre):
     q_params = {
         "q": query,
         "limit": limit,
@@ -71,7 +203,7 @@ def search(query, limit=10, genre=""):
         "filter.duration": "short",
         "client_id": get_client_id(),
     }
-    url = f"https://api-v2.soundcloud.com/search/tracks?" + urlencode(q_params)
+    url = f"{API_BASE}/search/tracks?" + urlencode(q_params)
     response = sneaky_get(url)
 
     if response.status_code != 200:
@@ -80,24 +212,59 @@ def search(query, limit=10, genre=""):
 
 
 # download_song()
-# 
+# downloads a track and converts it to wav in the song cache
+# returns the cached wav's filename, or None if the download failed
 def download_song(track):
-    if not os.path.exists(SONG_DIR):
-        os.mkdir(SONG_DIR)
+    cache = get_cache()
     
-    # Use the track's id as the filename
     title = track["title"]
     id = track["id"]
-    filename = f"{id}.mp3"
-    filename_wav = f"{id}.wav"
 
     # print(f"Downloading: {title} ({id})")
 
-    # Immediately return if the file was already downloaded
-    if os.path.exists(os.path.join(SONG_DIR, filename)):
-        # print(f"File {filename} already downloaded")
+    # Immediately return if the song was already downloaded
+    filename_wav = cache.lookup(id)
+    if filename_wav is not None:
         return filename_wav
 
+    # download and convert under temp names, so the cache only ever holds
+    # complete songs
+    part_mp3 = cache.part_path(id, "mp3")
+    part_wav = cache.part_path(id, "wav")
+
+    segments = segment_urls(track)
+    if segments is None:
+        return None
+
+    # Merge all the segments into one file
+    with open(part_mp3, "wb") as f:
+        failed = fetch_segments(segments, f)
+    # a song with segments missing is never cached as if it were complete
+    if failed > 0:
+        print(f"Failed to download {id}: {failed} segments missing")
+        os.remove(part_mp3)
+        return None
+    
+    # Convert the file to wav
+    try:
+        mp3_data = AudioSegment.from_mp3(part_mp3)
+        mp3_data.export(part_wav, format="wav")
+    except Exception as e:
+        print(f"Failed to convert {id} to wav: {e}")
+        if os.path.exists(part_wav):
+            os.remove(part_wav)
+        return None
+    finally:
+        os.remove(part_mp3)
+    
+    print("Done")
+    return cache.add(id, part_wav)
+
+
+# segment_urls()
+# resolves a track's HLS playlist through its transcoding url
+# returns the playlist's segment urls, or None if it couldn't be fetched
+def segment_urls(track):
     q_params = {
         "client_id": get_client_id(),
     }
@@ -113,34 +280,101 @@ def download_song(track):
     
     # Each playlist item is a different line in the response
     playlist = response.content.split(b"\n")
-    
-    # Merge all the segments into one file
-    with open(os.path.join(SONG_DIR, filename), "wb") as f:
-        for segment in playlist:
-            # Skip lines that start with a #
-            # These are comments
-            if segment.startswith(b"#"):
-                continue
-            response = sneaky_get(segment)
-            if response.status_code == 200:
-                f.write(response.content)
-    
-    # Convert the file to wav
-    mp3_data = AudioSegment.from_mp3(os.path.join(SONG_DIR, filename))
-    mp3_data.export(os.path.join(SONG_DIR, filename_wav), format="wav")
-    
-    print("Done")
-    return filename_wav
+    # Skip blank lines, and lines that start with a #
+    # These are comments
+    return [s.decode() for s in playlist if s.strip() and not s.startswith(b"#")]
+
+
+# fetch_segment()
+# fetches one HLS segment, retrying it on its own if the request fails
+# returns the segment's bytes, or None after MAX_RETRIES failures
+def fetch_segment(url):
+    for _ in range(MAX_RETRIES):
+        try:
+            response = sneaky_get(url)
+        except requests.RequestException as e:
+            print(f"Failed to get segment {url}: {e}, retrying")
+            continue
+        if response.status_code == 200:
+            return response.content
+    return None
+
+
+# fetch_segments()
+# fetches a song's HLS segments, at most workers at a time, and writes
+# them to f in playlist order as they arrive. only a window of workers
+# segments is held in memory at once
+# returns the number of segments that failed and were left out
+def fetch_segments(urls, f, workers=SEGMENT_WORKERS):
+    urls = iter(urls)
+    window = deque()
+    failed = 0
+
+    # bytes fetched by the pool's threads are counted for the caller
+    def fetch_counted(url):
+        before = fetched_bytes()
+        return fetch_segment(url), fetched_bytes() - before
+
+    for url in urls:
+        window.append(SEGMENT_POOL.submit(fetch_counted, url))
+        if len(window) < workers:
+            continue
+        failed += write_segment(window.popleft().result(), f)
+    while window:
+        failed += write_segment(window.popleft().result(), f)
+
+    return failed
+
+
+# write_segment()
+# writes a (content, bytes fetched) result of fetch_segments to f
+# returns 1 if the segment failed, 0 otherwise
+def write_segment(result, f):
+    content, num_bytes = result
+    COUNTERS.bytes = fetched_bytes() + num_bytes
+    if content is None:
+        print("Segment failed after retries, skipping it")
+        return 1
+    f.write(content)
+    return 0
+
 
 def append_to_env(key, value):
     with open(".env", "a") as f:
         f.write(f"{key}={value}\n")
 
+# get_client_id()
+# returns the SoundCloud client ID, loading it only the first time; it is
+# kept until a request gets a 401, see refresh_client_id()
+def get_client_id():
+    global CLIENT_ID
+    client_id = CLIENT_ID
+    if client_id:
+        return client_id
+    with CLIENT_ID_LOCK:
+        if not CLIENT_ID:
+            CLIENT_ID = load_client_id()
+        return CLIENT_ID
+
+
+# refresh_client_id()
+# called after a 401 on a request made with client ID bad_id: forgets it,
+# and loads a new one. requests failing together only refresh it once
+# returns the new client ID
+def refresh_client_id(bad_id):
+    global CLIENT_ID
+    with CLIENT_ID_LOCK:
+        if CLIENT_ID == bad_id:
+            dotenv.unset_key(".env", "CLIENT_ID", quote_mode='always', encoding='utf-8')
+            CLIENT_ID = None
+    return get_client_id()
+
+
 # Attempts to retreive a SoundCloud client ID
 # First checks the .env file for a CLIENT_ID key
 # If that fails, it attempts to scrape a client_id from the SoundCloud website
 # If all fails, it will throw an exception
-def get_client_id():
+def load_client_id():
     # Try to get the client ID from the .env file
     client_id = dotenv.get_key(".env", "CLIENT_ID")
     if client_id:
@@ -148,7 +382,7 @@ def get_client_id():
     print("Trying to scrape client ID from SoundCloud")
     
     # Fall back to scraping the client ID from the SoundCloud website
-    res = requests.get("https://soundcloud.com")
+    res = requests.get(SITE_BASE)
 
     # The link to the JS file with the client ID looks like this:
 	# <script crossorigin src="https://a-v2.sndcdn.com/assets/sdfhkjhsdkf.js"></script
@@ -0,0 +1,289 @@
+#
+# SONGSTORE.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Packed PCM song store. WAVs produced by SongFetcher.download_song are
+# ingested into large append-only segment files, with an index of track id
+# -> (segment, offset, length, format, frame count). Channels read frames
+# as zero-copy memoryview slices of a read-only mmap of the segment, so
+# per-frame reads don't touch the file system or allocate, and switching
+# songs or seeking is O(1). Songs are trimmed and levelled on the way in
+# (see Dsp.py), and keep a faded head and tail next to them for crossfades.
+# Segment bytes count against the SongCache's disk budget. Songs evicted
+# from the cache leave holes in their segment; once more than COMPACT_DEAD
+# of a segment is holes, its remaining songs are copied into a new segment
+# and the old one is deleted.
+#
+
+import os
+import json
+import mmap
+import threading
+
+import numpy as np
+
+import Packet as pack
+import Wav as wav
+import Dsp as dsp
+from SongFetcher import SONG_DIR, get_cache
+
+STORE_DIR = os.path.join(SONG_DIR, "store")
+INDEX_FILE = "index.json"
+SEGMENT_MAX = 512 * 1024 * 1024     # start a new segment past this size
+COPY_CHUNK = 1024 * 1024
+COMPACT_DEAD = 0.5  # fraction of a segment evicted songs may leave behind
+PROCESS = True      # trim, level and prepare crossfades on ingest (Dsp.py)
+
+
+# track_id()
+# given a song filename from a Channel's song list (the SongCache's
+# "{content hash}.wav"), returns the track id it is stored under
+def track_id(song):
+    return os.path.splitext(os.path.basename(song))[0]
+
+
+# class StoredSong
+# one track's PCM data, as a read-only memoryview over its segment's mmap
+#
+class StoredSong:
+    __slots__ = ("track", "view", "fmt", "frames", "head", "tail")
+    complete = True     # stored songs are never still streaming in
+
+    def __init__(self, track, view, fmt, frames, head=b"", tail=b""):
+        self.track = track
+        self.view = view
+        self.fmt = fmt          # wav.WavFormat
+        self.frames = frames    # number of pack.AUDIO_PACK frames
+        self.head = head        # faded-in copy of the start, for crossfades
+        self.tail = tail        # faded-out copy of the end
+
+    def __len__(self):
+        return len(self.view)
+
+    # read()
+    # returns up to num bytes starting at byte pos, without copying
+    def read(self, pos, num):
+        return self.view[pos : pos + num]
+
+
+# entry_bytes()
+# bytes an index entry takes in its segment: the song, then its head and tail
+def entry_bytes(entry):
+    return entry["len"] + entry.get("head", 0) + entry.get("tail", 0)
+
+
+# class SongStore
+# append-only segment files plus their index
+#
+class SongStore:
+    index: dict     # track id -> {"seg", "off", "len", "fmt", "frames"}
+    maps: dict      # segment number -> (mmap, mapped length)
+    disk: int       # bytes of segment files on disk
+
+    def __init__(self, store_dir=STORE_DIR):
+        self.store_dir = store_dir
+        self.index = {}
+        self.maps = {}
+        self.lock = threading.Lock()        # held while segments are written
+        self.map_lock = threading.RLock()   # held while segments are mapped or moved
+        self.disk = 0
+
+        os.makedirs(store_dir, exist_ok=True)
+        index_path = os.path.join(store_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+
+        # segments nothing is indexed in were left by a crash
+        used = {entry["seg"] for entry in self.index.values()}
+        for name in os.listdir(store_dir):
+            if name.startswith("seg-") and name.endswith(".pcm"):
+                path = os.path.join(store_dir, name)
+                if int(name[4:-4]) in used:
+                    self.disk += os.path.getsize(path)
+                else:
+                    os.remove(path)
+
+    # has()
+    # True if the song is already in the store
+    def has(self, song):
+        return track_id(song) in self.index
+
+    # ingest()
+    # copies the PCM data chunk of the cached song onto the end of the active
+    # segment and indexes it; does nothing if the track is already stored.
+    # 16-bit songs pass through Dsp on the way: trimmed and levelled, with
+    # their crossfade head and tail stored right after them
+    # raises ValueError if the file isn't a PCM WAV
+    def ingest(self, song):
+        track = track_id(song)
+        with self.lock:
+            if track in self.index:
+                return
+
+            path = os.path.join(get_cache().song_dir, song)
+            with open(path, "rb") as src:
+                fmt, data_len = wav.read_wav_header(src)
+                data_off = src.tell()
+                # truncated file: keep what's there, in whole samples only,
+                # so frames stay sample-aligned
+                data_len = min(data_len, os.fstat(src.fileno()).st_size - data_off)
+                data_len -= data_len % fmt.block_align
+
+                seg = self.active_segment()
+                with open(self.segment_path(seg), "ab") as dst:
+                    off = dst.tell()
+                    if PROCESS and dsp.supports(fmt) and data_len > 0:
+                        pcm = np.memmap(path, np.int16, "r", data_off,
+                                        (data_len // fmt.block_align, fmt.channels))
+                        done = dsp.process(pcm, fmt.sample_rate, dst.write)
+                        del pcm
+                    else:
+                        done = dsp.Processed(0.0, 0, data_len // fmt.block_align, 0, 0)
+                        copied = 0
+                        while copied < data_len:
+                            chunk = src.read(min(COPY_CHUNK, data_len - copied))
+                            dst.write(chunk)
+                            copied += len(chunk)
+                    self.disk += dst.tell() - off
+
+            length = done.length * fmt.block_align
+            self.index[track] = {
+                "seg": seg, "off": off, "len": length, "fmt": list(fmt),
+                "frames": -(-length // pack.AUDIO_PACK), "gain": done.gain,
+                "lead": done.lead * fmt.block_align,
+                "head": done.head * fmt.block_align,
+                "tail": done.tail * fmt.block_align,
+            }
+            self.save_index()
+        get_cache().fit(keep=song)  # the store grew: the cache may be over budget
+
+    # open()
+    # returns the song as a StoredSong, or None if it isn't stored
+    def open(self, song):
+        track = track_id(song)
+        with self.map_lock:     # so a compaction can't move the song meanwhile
+            entry = self.index.get(track)
+            if entry is None:
+                return None
+            end = entry["off"] + entry["len"]
+            head_end = end + entry.get("head", 0)
+            tail_end = head_end + entry.get("tail", 0)
+            view = memoryview(self.segment_map(entry["seg"], tail_end))
+        return StoredSong(track, view[entry["off"] : end],
+                          wav.WavFormat(*entry["fmt"]), entry["frames"],
+                          view[end:head_end], view[head_end:tail_end])
+
+    # lead()
+    # bytes of silence trimmed from the start of a stored song
+    def lead(self, song):
+        entry = self.index.get(track_id(song))
+        return 0 if entry is None else entry.get("lead", 0)
+
+    # gain()
+    # dB of gain a stored song was levelled by
+    def gain(self, song):
+        entry = self.index.get(track_id(song))
+        return 0.0 if entry is None else entry.get("gain", 0.0)
+
+    # disk_bytes()
+    # bytes the store's segments take on disk, holes included
+    def disk_bytes(self):
+        return self.disk
+
+    # forget()
+    # drops an evicted song from the index. a segment none of whose songs
+    # remain is deleted, and one that is mostly holes is compacted
+    def forget(self, song):
+        with self.lock:
+            with self.map_lock:
+                entry = self.index.pop(track_id(song), None)
+            if entry is None:
+                return
+            seg = entry["seg"]
+            live = sum(entry_bytes(e) for e in self.index.values() if e["seg"] == seg)
+            size = os.path.getsize(self.segment_path(seg))
+            if live == 0:
+                self.remove_segment(seg)
+            elif size - live > COMPACT_DEAD * size:
+                self.compact(seg)
+            self.save_index()
+
+    # compact()
+    # copies the songs left in a segment into a new segment, which becomes
+    # the active one, and deletes the old segment
+    def compact(self, seg):
+        new = max(e["seg"] for e in self.index.values()) + 1
+        while os.path.exists(self.segment_path(new)):
+            new += 1
+        src = self.segment_map(seg, max(e["off"] + entry_bytes(e)
+                                        for e in self.index.values() if e["seg"] == seg))
+        moved = {}
+        with open(self.segment_path(new), "wb") as dst:
+            for track, entry in self.index.items():
+                if entry["seg"] != seg:
+                    continue
+                moved[track] = dict(entry, seg=new, off=dst.tell())
+                for pos in range(entry["off"], entry["off"] + entry_bytes(entry), COPY_CHUNK):
+                    dst.write(src[pos : min(pos + COPY_CHUNK, entry["off"] + entry_bytes(entry))])
+            self.disk += dst.tell()
+        with self.map_lock:
+            self.index.update(moved)
+            self.remove_segment(seg)
+
+    # remove_segment()
+    # deletes a segment file; open songs keep reading its old mmap
+    def remove_segment(self, seg):
+        with self.map_lock:
+            self.maps.pop(seg, None)    # live frames keep the old mmap alive
+            path = self.segment_path(seg)
+            self.disk -= os.path.getsize(path)
+            os.remove(path)
+
+    # segment_map()
+    # returns a read-only mmap of a segment covering at least end bytes,
+    # remapping the segment if it has grown since it was last mapped
+    def segment_map(self, seg, end):
+        with self.map_lock:
+            mapped = self.maps.get(seg)
+            if mapped is None or mapped[1] < end:
+                # the old mmap stays alive while frames still reference it
+                with open(self.segment_path(seg), "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    mapped = (mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ), size)
+                self.maps[seg] = mapped
+            return mapped[0]
+
+    # active_segment()
+    # returns the number of the segment new songs are appended to
+    def active_segment(self):
+        seg = max([entry["seg"] for entry in self.index.values()], default=0)
+        path = self.segment_path(seg)
+        if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_MAX:
+            seg += 1
+        return seg
+
+    def segment_path(self, seg):
+        return os.path.join(self.store_dir, f"seg-{seg:04d}.pcm")
+
+    # save_index()
+    # writes the index atomically, so a crash never leaves it half-written
+    def save_index(self):
+        index_path = os.path.join(self.store_dir, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+STORE = None
+
+# get_store()
+# returns the server's shared SongStore, opening it on first use; songs
+# evicted from the SongCache are dropped from the store as well
+def get_store():
+    global STORE
+    if STORE is None:
+        STORE = SongStore(STORE_DIR)
+        get_cache().on_evict.append(STORE.forget)
+        get_cache().stored = STORE.disk_bytes
+    return STORE
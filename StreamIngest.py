@@ -0,0 +1,267 @@
+#
+# STREAMINGEST.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Streaming ingest: a song can start playing before it has been fully
+# downloaded and decoded. HLS segments are piped, in order, into an ffmpeg
+# subprocess as they arrive, and the PCM it decodes is appended to a
+# growing WAV file in the song cache. A GrowingSong is readable as soon as
+# START_SECONDS of audio are decoded; memory use stays bounded by the
+# segment window and pipe buffers instead of the whole decoded track. Once
+# decoding ends, the WAV is added to the SongCache and SongStore like any
+# other download, and the GrowingSong switches to reading from the store.
+# The store's copy is levelled by Dsp, but the raw stream played until then
+# wasn't: so listeners don't hear the level jump at the switch, the stored
+# audio is played back at the stream's level at first, then ramped to its
+# own over RAMP_SECONDS. Positions keep counting the silence Dsp trimmed
+# off the start, so the switch doesn't move a listener's playhead. A stream
+# with a segment missing, or whose decoder fails, is discarded instead,
+# like a partial download; channels playing it skip to their next song.
+#
+
+import os
+import struct
+import threading
+import subprocess
+
+import numpy as np
+
+import Packet as pack
+import Wav as wav
+import SongFetcher as sf
+from SongStore import get_store
+
+START_SECONDS = 3.0     # audio decoded before a stream may start playing
+READ_CHUNK = 64 * 1024  # bytes of PCM read from ffmpeg at a time
+STREAM_EXT = ".stream"  # suffix of the song names of GrowingSongs
+
+# decoded format: 16-bit stereo 44.1 kHz PCM, like the rest of the server
+FORMAT = wav.WavFormat(pack.CHANNELS, pack.SAMPLE_RATE, pack.BYTE_RATE,
+                       pack.CHANNELS * pack.SAMPLE_WIDTH, 8 * pack.SAMPLE_WIDTH)
+WAV_HEADER = 44         # bytes of the header written before the PCM
+RAMP_SECONDS = 2.0      # time taken to ramp from the stream's level to the store's
+
+STREAMS = {}            # song name -> GrowingSong, until decoding ends
+FINISHED = {}           # song name -> filename once stored, or None if the stream failed
+STREAMS_LOCK = threading.Lock()
+
+
+# wav_header()
+# returns a canonical 44-byte WAV header for data_len bytes of FORMAT PCM
+def wav_header(data_len):
+    return (b"RIFF" + struct.pack("<I", 36 + data_len) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, FORMAT.channels,
+                FORMAT.sample_rate, FORMAT.byte_rate, FORMAT.block_align, FORMAT.bits)
+            + b"data" + struct.pack("<I", data_len))
+
+
+# class GrowingSong
+# a song still being decoded. reads past what has been decoded so far come
+# back short; complete is set once decoding has ended
+#
+class GrowingSong:
+    name: str           # song name used in Channel song lists
+    available: int      # bytes of PCM decoded so far
+    complete: bool      # True once decoding has ended
+    final: str          # cache filename once the song is stored, or None
+    head = tail = b""   # streams play without crossfades (see Dsp.py)
+
+    def __init__(self, track_id, part_path):
+        self.name = f"{track_id}{STREAM_EXT}"
+        self.track_id = track_id
+        self.fmt = FORMAT
+        self.part_path = part_path
+        self.fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, wav_header(0))
+
+        self.available = 0
+        self.complete = False
+        self.final = None
+        self.stored = None  # StoredSong once finalized
+        self.lead = 0       # bytes of silence the store trimmed off the start
+        self.gain = 1.0     # linear gain the store levelled the song by
+        self.ramp_at = None # position of the first read from the store
+        self.lock = threading.Lock()    # keeps reads off fd once it's closed
+        self.failed = False
+        self.fetched = 0    # bytes of segments downloaded
+        self.started = threading.Event()    # START_SECONDS decoded (or done)
+        self.done = threading.Event()       # decoding ended and finalized
+
+    def __len__(self):
+        if self.stored is not None:
+            return self.lead + len(self.stored)
+        return self.available
+
+    # read()
+    # returns up to num bytes of PCM starting at byte pos. once stored,
+    # positions still count the silence the store trimmed, so a channel
+    # playing the stream carries on where it was
+    def read(self, pos, num):
+        if self.stored is not None:
+            return self.read_stored(pos, num)
+        num = max(0, min(num, self.available - pos))
+        if num == 0:
+            return b""
+        with self.lock:
+            if self.stored is not None:
+                return self.read_stored(pos, num)
+            if self.failed:
+                return b""
+            return os.pread(self.fd, num, WAV_HEADER + pos)
+
+    # read_stored()
+    # read() from the stored copy, with silence for the trimmed lead
+    def read_stored(self, pos, num):
+        if pos < self.lead:
+            return bytes(min(num, self.lead - pos))
+        data = self.stored.read(pos - self.lead, num)
+        if self.gain == 1.0:
+            return data
+        if self.ramp_at is None:
+            self.ramp_at = pos
+        return self.ramp(data, pos)
+
+    # ramp()
+    # undoes the store's gain on data read from pos, fully before ramp_at
+    # and less and less over the RAMP_SECONDS after it
+    def ramp(self, data, pos):
+        ramp_len = RAMP_SECONDS * self.fmt.byte_rate
+        if pos >= self.ramp_at + ramp_len or len(data) == 0:
+            return data
+        align = self.fmt.block_align
+        whole = len(data) - len(data) % align
+        pcm = np.frombuffer(data, np.int16, count=whole // 2)
+        pcm = pcm.reshape(-1, self.fmt.channels).astype(np.float32)
+        at = pos + align * np.arange(len(pcm))
+        t = np.clip((at - self.ramp_at) / ramp_len, 0.0, 1.0)
+        pcm *= (1 / self.gain + (1 - 1 / self.gain) * t)[:, None].astype(np.float32)
+        pcm = np.clip(np.rint(pcm), -32768, 32767).astype(np.int16)
+        return pcm.tobytes() + data[whole:]
+
+    # append()
+    # writes decoded PCM to the end of the song
+    def append(self, data):
+        os.pwrite(self.fd, data, WAV_HEADER + self.available)
+        self.available += len(data)
+        if self.available >= START_SECONDS * self.fmt.byte_rate:
+            self.started.set()
+
+    # finish()
+    # completes the WAV header, and moves the song into the cache and store,
+    # or discards it if it failed; either way it's no longer a stream
+    def finish(self):
+        # keep whole samples only
+        self.available -= self.available % self.fmt.block_align
+        os.ftruncate(self.fd, WAV_HEADER + self.available)
+        os.pwrite(self.fd, wav_header(self.available), 0)
+
+        if self.failed or self.available == 0:
+            self.failed = True
+            os.remove(self.part_path)
+        else:
+            # readers keep using fd until the stored copy is in place
+            self.final = sf.get_cache().add(self.track_id, self.part_path)
+            get_store().ingest(self.final)
+            with self.lock:
+                self.lead = get_store().lead(self.final)
+                self.gain = 10 ** (get_store().gain(self.final) / 20)
+                self.stored = get_store().open(self.final)
+        with self.lock:
+            os.close(self.fd)
+
+        self.complete = True
+        with STREAMS_LOCK:
+            STREAMS.pop(self.name, None)
+            FINISHED[self.name] = self.final
+        self.started.set()
+        self.done.set()
+
+
+# stream_song()
+# starts fetching and decoding a track in the background
+# returns its GrowingSong, or None if the track's playlist can't be fetched
+def stream_song(track):
+    segments = sf.segment_urls(track)
+    if segments is None:
+        return None
+
+    # the decoder is started first, so there's nothing to undo if it can't be
+    try:
+        decoder = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "error", "-i", "pipe:0",
+             "-f", "s16le", "-ar", str(FORMAT.sample_rate),
+             "-ac", str(FORMAT.channels), "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError as e:
+        print(f"Couldn't start decoder for track {track['id']}: {e}")
+        return None
+
+    part_path = sf.get_cache().part_path(track["id"], "wav")
+    song = GrowingSong(track["id"], part_path)
+    with STREAMS_LOCK:
+        STREAMS[song.name] = song
+
+    threading.Thread(target=feed, args=(song, segments, decoder), daemon=True).start()
+    threading.Thread(target=decode, args=(song, decoder), daemon=True).start()
+    return song
+
+
+# feed()
+# thread: pipes the track's segments into the decoder in playlist order
+def feed(song, segments, decoder):
+    before = sf.fetched_bytes()
+    try:
+        failed = sf.fetch_segments(segments, decoder.stdin)
+        if failed > 0:
+            print(f"Stream {song.track_id} failed: {failed} segments missing")
+            song.failed = True
+    except (BrokenPipeError, OSError) as e:
+        print(f"Stream decoder closed early: {e}")
+        song.failed = True
+    finally:
+        song.fetched = sf.fetched_bytes() - before
+        try:
+            decoder.stdin.close()
+        except OSError:
+            pass
+
+
+# decode()
+# thread: appends the decoder's PCM output to the song as it arrives
+def decode(song, decoder):
+    while True:
+        data = decoder.stdout.read(READ_CHUNK)
+        if len(data) == 0:
+            break
+        song.append(data)
+
+    if decoder.wait() != 0:
+        print(f"Decoder failed for track {song.track_id}")
+        song.failed = True
+    song.finish()
+
+
+# open_stream()
+# returns the GrowingSong for a song name, or None if it isn't a stream
+def open_stream(name):
+    with STREAMS_LOCK:
+        return STREAMS.get(name)
+
+
+# resolve()
+# given a song name from a Channel song list, returns the cache filename
+# it is stored under (streams are named differently), or None for a stream
+# not stored yet, or never to be
+def resolve(name):
+    with STREAMS_LOCK:
+        song = STREAMS.get(name)
+        if song is not None:
+            return song.final
+        return FINISHED.get(name, name)
+
+
+# stream_failed()
+# True if the song name is a stream that was discarded
+def stream_failed(name):
+    with STREAMS_LOCK:
+        return name in FINISHED and FINISHED[name] is None
@@ -56,20 +56,64 @@ def test_packet(port):
 
     close_client_server(c_s, s_s, s_to_c)
 
+def test_switch_flush():
+    # a pcm16 listener switching channels: whether S_FLUSH arrives before or
+    # after the audio it points at, the client plays none of the old
+    # channel's audio it had buffered, and starts on the new channel's
+    import types
+    import AudioCodec as ac
+    from FanOut import FanOut, FrameRing
+    from JitterBuffer import JitterBuffer
+
+    for flush_first in (True, False):
+        fanout = FanOut()
+        c_s, s_to_c = socket.socketpair()
+        fanout.add(s_to_c, ac.FORMAT_PCM)
+        client = types.SimpleNamespace(aud=s_to_c)
+        old = bytes([0x11]) * packet.AUDIO_PACK
+        new = bytes([0x22]) * packet.AUDIO_PACK
+
+        ring = FrameRing()
+        for _ in range(20):
+            fanout.broadcast(old, [client], packet.SEND_DELAY)
+            fanout.broadcast(new, [], packet.SEND_DELAY, ring=ring)
+        start = fanout.join(s_to_c, ring, switch=True)
+
+        jitter = JitterBuffer()
+        if flush_first:
+            jitter.flush(start)
+        c_s.setblocking(False)
+        while True:
+            try:
+                if not jitter.recv_into(c_s):
+                    break
+            except BlockingIOError:
+                break
+        if not flush_first:
+            jitter.flush(start)
+
+        out = bytearray(packet.AUDIO_PACK)
+        jitter.fill(out)
+        played = bytes(out).strip(b"\x00")
+        print(f"flush {'before' if flush_first else 'after'} audio: offset {start}, "
+              f"plays {'new' if played and set(played) == {0x22} else 'OLD'} channel")
+        assert played and set(played) == {0x22}
+        c_s.close()
+        s_to_c.close()
+
 def spawn_multi_clients():
-    # Fork 10 child processes to test packet sending
-    import os
-    for _ in range(10):
-        pid = os.fork()
-        if pid == 0:
-            # Run Client.py
-            os.execlp("python3", "python3", "Client.py", sys.argv[1], sys.argv[2])
-        else:
-            print(f"Started child process {pid}")
+    # Simulate 10 headless clients for 30 seconds (see LoadGen.py)
+    import json
+    import LoadGen
+    summary = LoadGen.run_load(sys.argv[1], int(sys.argv[2]), num_clients=10)
+    print(json.dumps(summary, indent=2))
 
 def main():
+    if sys.argv[1:] == ["flush"]:
+        test_switch_flush()
+        return
     if len(sys.argv) != 3:
-        print("Usage: python3 Test.py <server address> <port>")
+        print("Usage: python3 Test.py <server address> <port>, or python3 Test.py flush")
         quit()
 
     spawn_multi_clients()
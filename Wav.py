@@ -0,0 +1,58 @@
+#
+# WAV.PY
+# (Soundcloud / Application name ) CS112, Fall 2022
+#
+# Minimal RIFF / WAVE header parser. Walks the file's chunks instead of
+# assuming a fixed 44-byte header, so WAVs with LIST or other extra chunks
+# are read correctly, and reports the PCM format from the "fmt " chunk.
+#
+
+import struct
+from collections import namedtuple
+
+# PCM layout of a song, taken from its "fmt " chunk
+WavFormat = namedtuple("WavFormat",
+    ["channels", "sample_rate", "byte_rate", "block_align", "bits"])
+
+CHUNK_HEAD = 8      # 4-byte chunk id + 4-byte little-endian chunk size
+FMT_LEN = 16        # bytes of the "fmt " chunk we use
+
+
+# read_wav_header()
+# reads RIFF chunks from an open binary file up to the "data" chunk, leaving
+# the file positioned on the first PCM byte
+# returns (WavFormat, length of PCM data in bytes); raises ValueError if the
+# file isn't a PCM WAV
+def read_wav_header(f):
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE file")
+
+    fmt = None
+    while True:
+        head = f.read(CHUNK_HEAD)
+        if len(head) < CHUNK_HEAD:
+            raise ValueError("no data chunk in WAV file")
+        chunk_id, chunk_len = head[:4], int.from_bytes(head[4:], 'little')
+
+        if chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("data chunk before fmt chunk in WAV file")
+            return fmt, chunk_len
+
+        body = f.read(chunk_len + (chunk_len & 1))  # chunks are word-aligned
+        if chunk_id == b"fmt ":
+            if chunk_len < FMT_LEN:
+                raise ValueError("fmt chunk too short")
+            fmt = parse_fmt(body[:FMT_LEN])
+
+
+# parse_fmt()
+# given the first 16 bytes of a "fmt " chunk, returns its WavFormat
+def parse_fmt(body):
+    (audio_format, channels, sample_rate,
+        byte_rate, block_align, bits) = struct.unpack("<HHIIHH", body)
+    # 1 = integer PCM, 0xFFFE = WAVE_FORMAT_EXTENSIBLE (still PCM from pydub)
+    if audio_format not in (1, 0xFFFE):
+        raise ValueError(f"unsupported WAV encoding {audio_format}")
+    return WavFormat(channels, sample_rate, byte_rate, block_align, bits)